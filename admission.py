@@ -0,0 +1,165 @@
+import math
+import threading
+import time
+from flask import current_app, g, request
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+from auth import on_authenticated
+from metrics import ADMISSION_REJECTED
+from models import pool_capacity
+
+'''
+Admission control
+    Turns excess requests away before they queue on the connection pool.
+    Each worker runs at most ADMISSION_MAX_CONCURRENT requests at once
+    (its pool size plus overflow by default) and answers the rest with 503.
+    Once a token is verified, a token bucket per subject and route class
+    ("read" for get:* permissions, "write" otherwise) admits
+    ADMISSION_RATES[class] requests per second with bursts of up to
+    ADMISSION_BURSTS[class], and answers the rest with 429. Both carry
+    Retry-After. Buckets are kept per worker, or in Redis when
+    ADMISSION_REDIS_URL is set so the rate holds across workers.
+'''
+
+
+def reject(error_class, retry_after):
+    error = error_class()
+    error.retry_after = max(1, int(math.ceil(retry_after)))
+    raise error
+
+
+def route_class(permission):
+    return 'read' if permission.startswith('get:') else 'write'
+
+
+class MemoryBuckets:
+    """Token buckets held in this worker
+    """
+
+    def __init__(self, max_buckets=100000):
+        self.max_buckets = max_buckets
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        """Takes a token from the bucket; returns 0, or the seconds until
+        one is available
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at, _ = self._buckets.get(key, (burst, now, now))
+            tokens = min(burst, tokens + (now - updated_at) * rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            if key not in self._buckets and \
+                    len(self._buckets) >= self.max_buckets:
+                self._prune(now)
+            self._buckets[key] = (tokens, now,
+                                  now + (burst - tokens) / rate)
+        return wait
+
+    def _prune(self, now):
+        # a bucket that has refilled is the same as no bucket
+        self._buckets = {key: bucket for key, bucket in self._buckets.items()
+                         if bucket[2] > now}
+
+
+class RedisBuckets:
+    """Token buckets in Redis, shared by every worker
+    """
+
+    TAKE = '''
+        local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]),
+            tonumber(ARGV[3])
+        local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'at')
+        local tokens = tonumber(bucket[1]) or burst
+        local at = tonumber(bucket[2]) or now
+        tokens = math.min(burst, tokens + math.max(0, now - at) * rate)
+        local wait = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+        else
+            wait = (1 - tokens) / rate
+        end
+        redis.call('HMSET', KEYS[1], 'tokens', tokens, 'at', now)
+        redis.call('EXPIRE', KEYS[1], math.ceil((burst - tokens) / rate) + 1)
+        return tostring(wait)
+    '''
+
+    def __init__(self, client, prefix='casting:bucket:'):
+        self.prefix = prefix
+        self._take = client.register_script(self.TAKE)
+
+    def take(self, key, rate, burst):
+        return float(self._take(keys=[self.prefix + key],
+                                args=[rate, burst, time.time()]))
+
+
+class AdmissionController:
+
+    def __init__(self, buckets, max_concurrent, rates, bursts):
+        self.buckets = buckets
+        self.max_concurrent = max_concurrent
+        self.rates = rates
+        self.bursts = bursts
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+
+    def enter(self):
+        return self._slots.acquire(blocking=False)
+
+    def leave(self):
+        self._slots.release()
+
+    def take(self, subject, permission):
+        kind = route_class(permission)
+        return self.buckets.take('{}:{}'.format(kind, subject),
+                                 self.rates[kind], self.bursts[kind])
+
+
+def init_admission(app):
+    """Caps in-flight requests and rate limits subjects, when
+    ADMISSION_ENABLED
+    """
+    if not app.config['ADMISSION_ENABLED']:
+        return
+
+    if app.config.get('ADMISSION_REDIS_URL'):
+        import redis
+        buckets = RedisBuckets(
+            redis.StrictRedis.from_url(app.config['ADMISSION_REDIS_URL']))
+    else:
+        buckets = MemoryBuckets()
+    controller = app.extensions['admission'] = AdmissionController(
+        buckets,
+        app.config['ADMISSION_MAX_CONCURRENT'] or pool_capacity(app),
+        app.config['ADMISSION_RATES'],
+        app.config['ADMISSION_BURSTS'])
+    exempt = frozenset(app.config['ADMISSION_EXEMPT_ENDPOINTS'])
+
+    @app.before_request
+    def claim_slot():
+        if request.endpoint in exempt:
+            return
+        if not controller.enter():
+            ADMISSION_REJECTED.labels('concurrency').inc()
+            reject(ServiceUnavailable, app.config['ADMISSION_RETRY_AFTER'])
+        g.admission_slot = True
+
+    @app.teardown_request
+    def release_slot(exc):
+        if g.pop('admission_slot', False):
+            controller.leave()
+
+
+@on_authenticated
+def admit_subject(payload, permission):
+    controller = current_app.extensions.get('admission')
+    if controller is None or request.endpoint in \
+            current_app.config['ADMISSION_EXEMPT_ENDPOINTS']:
+        return
+    wait = controller.take(payload.get('sub'), permission)
+    if wait:
+        ADMISSION_REJECTED.labels('rate').inc()
+        reject(TooManyRequests, wait)
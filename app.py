@@ -1,11 +1,31 @@
 import os
 from flask import Flask, request, abort, jsonify
+from sqlalchemy.orm import joinedload, selectinload
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_cors import CORS
-from models import db, Movie, Actor, setup_db
+from models import db, Movie, Actor, Cast, CatalogStat, setup_db, \
+    insert_many, pool_stats, replace_cast, update_returning, delete_returning
+from pagination import page_args, paginate, paginate_ranked
+from search import search_movies
+from stats import catalog_stats
+from fields import requested_fields, requested_includes, select_columns, \
+    select_fields
+from filters import requested_filters, requested_sort
+from streaming import stream_list, wants_stream
 
 from auth import AuthError, requires_auth
+from conditional import conditional, row_conditional, row_etag, \
+    if_match_versions, abort_missing
+from cache import cached, init_cache
+from idempotency import idempotent, init_idempotency
+from routing import init_routing
+from groupcommit import init_group_commit
+from serialization import init_json, json_response
+from compression import init_compression
+from metrics import init_metrics
+from admission import init_admission
+from queries import init_query_recorder, query_budget
 
 
 # ----------------------------------------------------------------------------#
@@ -15,13 +35,17 @@ from auth import AuthError, requires_auth
 def create_app(test_config=None):
 
     app = Flask(__name__)
+    app.config.from_object('config')
+    if test_config:
+        app.config.update(test_config)
+    init_compression(app)
     CORS(app, resources={r"/api/*": {"origins": "*"}})
 
     @app.after_request
     def after_request(response):
         response.headers.add(
             'Access-Control-Allow-Headers',
-            'Content-Type, Authorization, true'
+            'Content-Type, Authorization, Idempotency-Key, true'
         )
         response.headers.add(
             'Access-Control-Allow-Methods',
@@ -30,8 +54,64 @@ def create_app(test_config=None):
         return response
 
     setup_db(app)
+    init_json(app)
+    init_metrics(app)
+    init_admission(app)
+    init_query_recorder(app)
+    init_cache(app)
+    init_idempotency(app)
+    init_routing(app)
+    init_group_commit(app)
+
+    def get_bulk_rows(columns, required, allow_empty=False):
+        """
+            Validates a bulk request body up front: a non-empty array of
+            objects, each carrying `required`, at most MAX_BULK_SIZE long
+        """
+        request_data = request.get_json()
+
+        if not isinstance(request_data, list) or \
+                not (request_data or allow_empty):
+            abort(422)
+        if len(request_data) > app.config['MAX_BULK_SIZE']:
+            abort(413)
+
+        rows = []
+        for item in request_data:
+            if not isinstance(item, dict) or item.get(required) is None:
+                abort(422)
+            rows.append({column: item.get(column) for column in columns})
+        return rows
+
+    def select_movies_with_cast(fields):
+        """
+            (query, serialize) for movies with their cast: the movies in
+            one query and every cast member with their actor in another
+        """
+        query = Movie.query.options(
+            selectinload(Movie.cast).joinedload(Cast.actor))
+
+        def serialize(movie):
+            data = movie.format()
+            if fields is not None:
+                data = {name: data[name] for name in fields}
+            data['cast'] = movie.format_cast()
+            return data
+
+        return query, serialize
+
+    def movie_list_tables():
+        """
+            Tables GET /movies reads: the cast and actors too only with
+            include=cast
+        """
+        if 'cast' in requested_includes('cast'):
+            return (Movie.__tablename__, Cast.__tablename__,
+                    Actor.__tablename__)
+        return (Movie.__tablename__,)
 
     @app.route('/')
+    @query_budget(0)
     def welcome():
         """
             Welcome
@@ -42,26 +122,186 @@ def create_app(test_config=None):
             'message': "welcome to capstone"
         }), 200
 
+    @app.route('/health')
+    @query_budget(0)
+    def health():
+        """
+            Liveness check with connection pool usage
+        """
+
+        return jsonify({
+            'success': True,
+            'pools': pool_stats()
+        }), 200
+
     #  Movies
     #  ----------------------------------------------------------------
 
     @app.route('/movies')
+    @query_budget(3)
     @requires_auth('get:movies')
+    @cached(movie_list_tables)
+    @conditional(movie_list_tables)
     def get_movies(payload):
         """
-            Gets all Movies
+            Gets all Movies, or one page of them when limit/cursor is sent.
+            stream=true streams the full list in chunks,
+            fields= limits the columns returned,
+            include=cast adds each movie's cast,
+            category= and title_prefix= filter and sort= orders them
+        """
+
+        fields = requested_fields(Movie)
+        include_cast = 'cast' in requested_includes('cast')
+        criteria = requested_filters(Movie)
+        sort = requested_sort(Movie)
+        limit, cursor = page_args()
+        if limit is None and wants_stream():
+            if include_cast:
+                abort(422)
+            return stream_list(
+                'all_movies',
+                select_columns(Movie, fields).filter(*criteria)
+                .order_by(*sort.order_by()),
+                app.config['STREAM_CHUNK_SIZE'])
+
+        if include_cast:
+            query, serialize = select_movies_with_cast(fields)
+        else:
+            query, serialize = select_fields(Movie, fields, sort.names)
+        query = query.filter(*criteria)
+        if limit is None:
+            query = query.order_by(*sort.order_by()).all()
+            data = [serialize(movie) for movie in query]
+
+            return json_response({
+                'success': True,
+                'all_movies': data
+            }), 200
+
+        movies, next_cursor = paginate(query, sort, limit, cursor)
+
+        return json_response({
+            'success': True,
+            'all_movies': [serialize(movie) for movie in movies],
+            'next_cursor': next_cursor
+        }), 200
+
+    @app.route('/movies/<int:movie_id>')
+    @query_budget(2)
+    @requires_auth('get:movies')
+    @cached(Movie.__tablename__)
+    @row_conditional(Movie, 'movie_id')
+    def get_movie(payload, movie_id):
+        """
+            Gets a single movie, optionally limited to ?fields=
+        """
+
+        query, serialize = select_fields(Movie, requested_fields(Movie),
+                                         version=True)
+        movie = query.filter(Movie.id == movie_id).first()
+
+        if not movie:
+            abort(404)
+
+        return json_response({
+            'success': True,
+            'movie': serialize(movie)
+        }), 200
+
+    @app.route('/movies/<int:movie_id>/cast')
+    @query_budget(2)
+    @requires_auth('get:movies')
+    @cached(Cast.__tablename__, Actor.__tablename__)
+    @conditional(Cast.__tablename__, Actor.__tablename__)
+    def get_movie_cast(payload, movie_id):
+        """
+            Gets the actors cast in a movie, with their roles
+        """
+
+        movie = Movie.query \
+            .options(joinedload(Movie.cast).joinedload(Cast.actor)) \
+            .filter(Movie.id == movie_id).first()
+
+        if not movie:
+            abort(404)
+
+        return json_response({
+            'success': True,
+            'movie_id': movie.id,
+            'cast': movie.format_cast()
+        }), 200
+
+    @app.route('/movies/<int:movie_id>/cast', methods=['PUT'])
+    @query_budget(5)
+    @requires_auth('patch:movies')
+    def replace_movie_cast(payload, movie_id):
+        """
+            Replaces the whole cast of a movie with the posted
+            [{"actor_id": ..., "role": ...}] list; [] clears it
         """
 
-        query = Movie.query.order_by(Movie.id).all()
-        data = [movie.format() for movie in query]
+        members = get_bulk_rows(['actor_id', 'role'], 'actor_id',
+                                allow_empty=True)
+        actor_ids = [member['actor_id'] for member in members]
+        if len(set(actor_ids)) != len(actor_ids) or \
+                not all(isinstance(actor_id, int) for actor_id in actor_ids):
+            abort(422)
+
+        movie = Movie.query.filter(Movie.id == movie_id).first()
+        if not movie:
+            abort(404)
+
+        actors = {}
+        if actor_ids:
+            actors = {actor.id: actor for actor in
+                      Actor.query.filter(Actor.id.in_(actor_ids))}
+        if len(actors) != len(actor_ids):
+            abort(422)
+
+        # built before the commit expires the actors
+        cast = [dict(actors[member['actor_id']].format(),
+                     role=member['role']) for member in members]
+        replace_cast(movie, members)
 
         return jsonify({
             'success': True,
-            'all_movies': data
+            'movie_id': movie_id,
+            'cast': cast
+        }), 200
+
+    @app.route('/movies/search')
+    @query_budget(2)
+    @requires_auth('get:movies')
+    @cached(Movie.__tablename__)
+    @conditional(Movie.__tablename__)
+    def search_movies_route(payload):
+        """
+            Full-text search over title, description and category,
+            best match first, paged with limit/cursor
+        """
+
+        q = request.args.get('q', '').strip()
+        if not q:
+            abort(422)
+
+        limit, cursor = page_args()
+        if limit is None:
+            limit = app.config['DEFAULT_PAGE_SIZE']
+
+        results, next_cursor = paginate_ranked(search_movies(q), limit, cursor)
+
+        return json_response({
+            'success': True,
+            'movies': [dict(movie.format(), rank=float(rank))
+                       for movie, rank in results],
+            'next_cursor': next_cursor
         }), 200
 
     @app.route('/movies/add', methods=['POST'])
+    @query_budget(4)
     @requires_auth('add:movies')
+    @idempotent
     def create_movies(payload):
         """
         Creates a new movie
@@ -90,71 +330,166 @@ def create_app(test_config=None):
             'movie': new_movie.format()
         }), 201
 
+    @app.route('/movies/bulk', methods=['POST'])
+    @query_budget(3)
+    @requires_auth('add:movies')
+    def create_movies_bulk(payload):
+        """
+        Creates many movies in a single transaction
+        """
+
+        rows = get_bulk_rows(['title', 'description', 'category'], 'title')
+        ids = insert_many(Movie, rows)
+
+        return jsonify({
+            'success': True,
+            'message': str(len(ids)) + ' movies were successfully listed',
+            'ids': ids
+        }), 201
+
     @app.route('/movies/<int:movie_id>', methods=['DELETE'])
+    @query_budget(2)
     @requires_auth('delete:movies')
     def delete_movie(payload, movie_id):
         """
-            Deletes a movie by ID
+            Deletes a movie by ID, if it is still at the If-Match version
         """
 
-        movie = Movie.query.get(movie_id)
+        versions = if_match_versions()
+        movie = delete_returning(Movie, movie_id, versions)
 
         if not movie:
-            abort(404)
-        title = movie.title
-        Movie.delete(movie)
+            abort_missing(Movie, movie_id, versions)
 
         return jsonify({
             "success": True,
-            'message': 'Movie ' + title + ' successfully deleted.'
+            'message': 'Movie ' + movie['title'] + ' successfully deleted.'
         }), 200
 
     @app.route('/movies/<int:movie_id>', methods=['PATCH'])
+    @query_budget(2)
     @requires_auth('patch:movies')
     def update_movie(payload, movie_id):
         """
-            Updates movie title
+            Updates movie title, if it is still at the If-Match version
         """
         request_data = request.get_json()
-        movie = Movie.query.get(movie_id)
 
-        if not movie:
-            abort(404)
-        setattr(movie, 'title', request_data['title'])
-        if 'description' in request_data:
-            description = request_data['description']
-            setattr(movie, 'description', description)
-        if 'category' in request_data:
-            category = request_data['category']
-            setattr(movie, 'category', category)
+        if 'title' not in request_data:
+            abort(422)
+        values = {name: request_data[name]
+                  for name in ('title', 'description', 'category')
+                  if name in request_data}
 
-        Movie.update(movie)
+        versions = if_match_versions()
+        movie = update_returning(Movie, movie_id, values, versions)
 
-        return jsonify({
+        if not movie:
+            abort_missing(Movie, movie_id, versions)
+
+        response = jsonify({
             'success': True,
-            'movie': movie.format()
-        }), 200
+            'movie': movie
+        })
+        response.set_etag(row_etag(movie['version']))
+        return response, 200
 
     #  Actors
     #  ----------------------------------------------------------------
 
     @app.route('/actors')
+    @query_budget(2)
     @requires_auth('get:actors')
+    @cached(Actor.__tablename__)
+    @conditional(Actor.__tablename__)
     def get_actors(payload):
         """
-            Gets all actors
+            Gets all actors, or one page of them when limit/cursor is sent.
+            stream=true streams the full list in chunks,
+            fields= limits the columns returned,
+            gender=, min_age=, max_age= and name_prefix= filter and sort=
+            orders them
         """
 
-        query = Actor.query.order_by(Actor.id).all()
-        data = [actor.format() for actor in query]
+        fields = requested_fields(Actor)
+        criteria = requested_filters(Actor)
+        sort = requested_sort(Actor)
+        limit, cursor = page_args()
+        if limit is None and wants_stream():
+            return stream_list(
+                'all_actors',
+                select_columns(Actor, fields).filter(*criteria)
+                .order_by(*sort.order_by()),
+                app.config['STREAM_CHUNK_SIZE'])
+
+        query, serialize = select_fields(Actor, fields, sort.names)
+        query = query.filter(*criteria)
+        if limit is None:
+            query = query.order_by(*sort.order_by()).all()
+            data = [serialize(actor) for actor in query]
+
+            return json_response({
+                'success': True,
+                'all_actors': data
+            }), 200
+
+        actors, next_cursor = paginate(query, sort, limit, cursor)
+
+        return json_response({
+            'success': True,
+            'all_actors': [serialize(actor) for actor in actors],
+            'next_cursor': next_cursor
+        }), 200
 
-        return jsonify({
+    @app.route('/actors/<int:actor_id>')
+    @query_budget(2)
+    @requires_auth('get:actors')
+    @cached(Actor.__tablename__)
+    @row_conditional(Actor, 'actor_id')
+    def get_actor(payload, actor_id):
+        """
+            Gets a single actor, optionally limited to ?fields=
+        """
+
+        query, serialize = select_fields(Actor, requested_fields(Actor),
+                                         version=True)
+        actor = query.filter(Actor.id == actor_id).first()
+
+        if not actor:
+            abort(404)
+
+        return json_response({
             'success': True,
-            'all_actors': data
+            'actor': serialize(actor)
+        }), 200
+
+    @app.route('/actors/<int:actor_id>/movies')
+    @query_budget(2)
+    @requires_auth('get:actors')
+    @cached(Movie.__tablename__, Cast.__tablename__)
+    @conditional(Movie.__tablename__, Cast.__tablename__)
+    def get_actor_movies(payload, actor_id):
+        """
+            Gets the movies an actor is cast in, with their roles
+        """
+
+        actor = Actor.query \
+            .options(joinedload(Actor.roles).joinedload(Cast.movie)) \
+            .filter(Actor.id == actor_id).first()
+
+        if not actor:
+            abort(404)
+
+        return json_response({
+            'success': True,
+            'actor_id': actor.id,
+            'movies': actor.format_movies()
         }), 200
 
     @app.route('/actors/add', methods=['POST'])
+    @query_budget(4)
     @requires_auth('add:actors')
+    @idempotent
     def create_actor(payload):
         """
         Creates a new actor
@@ -180,47 +515,86 @@ def create_app(test_config=None):
             'actor': new_actor.format()
         }), 201
 
+    @app.route('/actors/bulk', methods=['POST'])
+    @query_budget(3)
+    @requires_auth('add:actors')
+    def create_actors_bulk(payload):
+        """
+        Creates many actors in a single transaction
+        """
+
+        rows = get_bulk_rows(['name', 'age', 'gender'], 'name')
+        ids = insert_many(Actor, rows)
+
+        return jsonify({
+            'success': True,
+            'message': str(len(ids)) + ' actors were successfully listed',
+            'ids': ids
+        }), 201
+
     @app.route('/actors/<int:actor_id>', methods=['DELETE'])
+    @query_budget(2)
     @requires_auth('delete:actors')
     def delete_actor(payload, actor_id):
         """
-            Deletes a actor by ID
+            Deletes a actor by ID, if it is still at the If-Match version
         """
 
-        actor = Actor.query.get(actor_id)
+        versions = if_match_versions()
+        actor = delete_returning(Actor, actor_id, versions)
 
         if not actor:
-            abort(404)
-        name = actor.name
-
-        Actor.delete(actor)
+            abort_missing(Actor, actor_id, versions)
 
         return jsonify({
             "success": True,
-            'message': 'Actor ' + name + ' successfully deleted.'
+            'message': 'Actor ' + actor['name'] + ' successfully deleted.'
         }), 200
 
     @app.route('/actors/<int:actor_id>', methods=['PATCH'])
+    @query_budget(2)
     @requires_auth('patch:actors')
     def update_actor(payload, actor_id):
         """
-            Updates an actor
+            Updates an actor, if it is still at the If-Match version
         """
         request_data = request.get_json()
-        actor = Actor.query.get(actor_id)
 
-        if not actor:
-            abort(404)
+        if 'gender' not in request_data:
+            abort(422)
+        values = {name: request_data[name]
+                  for name in ('name', 'age', 'gender')
+                  if name in request_data}
+
+        versions = if_match_versions()
+        actor = update_returning(Actor, actor_id, values, versions)
 
-        actor.name = request_data.get("name", actor.name)
-        actor.age = request_data.get("age", actor.age)
-        setattr(actor, 'gender', request_data['gender'])
+        if not actor:
+            abort_missing(Actor, actor_id, versions)
 
-        Actor.update(actor)
+        response = jsonify({
+            'success': True,
+            'actor': actor
+        })
+        response.set_etag(row_etag(actor['version']))
+        return response, 200
+
+    @app.route('/stats')
+    @query_budget(2)
+    @requires_auth('get:stats')
+    @cached(Movie.__tablename__, Actor.__tablename__,
+            CatalogStat.__tablename__)
+    @conditional(Movie.__tablename__, Actor.__tablename__,
+                 CatalogStat.__tablename__)
+    def get_stats(payload):
+        """
+            Counts of movies per category and actors per gender and age,
+            from the summary the database keeps as rows are written
+        """
 
-        return jsonify({
+        return json_response({
             'success': True,
-            'actor': actor.format()
+            'stats': catalog_stats()
         }), 200
 
     # ----------------------------------------------------------------------------#
@@ -235,6 +609,30 @@ def create_app(test_config=None):
             "message": "Unprocessable Request"
         }), 422
 
+    @app.errorhandler(409)
+    def conflict(error):
+        return jsonify({
+            "success": False,
+            "error": 409,
+            "message": "Conflict"
+        }), 409
+
+    @app.errorhandler(412)
+    def precondition_failed(error):
+        return jsonify({
+            "success": False,
+            "error": 412,
+            "message": "Precondition Failed"
+        }), 412
+
+    @app.errorhandler(413)
+    def payload_too_large(error):
+        return jsonify({
+            "success": False,
+            "error": 413,
+            "message": "Payload Too Large"
+        }), 413
+
     @app.errorhandler(401)
     def not_authorized(error):
         return jsonify({
@@ -259,6 +657,28 @@ def create_app(test_config=None):
             "message": "Unauthorized"
         }), 403
 
+    @app.errorhandler(429)
+    def too_many_requests(error):
+        response = jsonify({
+            "success": False,
+            "error": 429,
+            "message": "Too Many Requests"
+        })
+        response.headers['Retry-After'] = str(
+            getattr(error, 'retry_after', 1))
+        return response, 429
+
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        response = jsonify({
+            "success": False,
+            "error": 503,
+            "message": "Service Unavailable"
+        })
+        response.headers['Retry-After'] = str(
+            getattr(error, 'retry_after', 1))
+        return response, 503
+
     @app.errorhandler(500)
     def internal_server_error(error):
         return jsonify({
@@ -0,0 +1,54 @@
+import asyncio
+import logging
+from asgiref.wsgi import WsgiToAsgi
+
+import auth
+from app import app as wsgi_app
+
+'''
+ASGI entry point
+    uvicorn asgi:app
+
+Serves the same create_app() application, so routes, auth and the JSON
+error envelopes are unchanged. Requests run on the event loop's thread
+pool, letting one process hold many slow client connections open without
+a worker each, and the auth key set is fetched at startup, off the event
+loop, instead of on the first request.
+
+This is only an adapter: the routes and their database calls stay
+synchronous, one pool thread per request in flight.
+'''
+
+logger = logging.getLogger(__name__)
+
+
+def warm_up():
+    try:
+        auth.key_store.refresh()
+    except Exception:
+        logger.exception('Unable to prime the JWKS key store at startup')
+
+
+class Lifespan:
+    """Handles ASGI lifespan events around the wrapped application
+    """
+
+    def __init__(self, application):
+        self.application = application
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'lifespan':
+            await self.application(scope, receive, send)
+            return
+
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await asyncio.get_event_loop().run_in_executor(None, warm_up)
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+app = Lifespan(WsgiToAsgi(wsgi_app))
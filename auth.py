@@ -1,7 +1,15 @@
+import hashlib
 import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
 from flask import request, _request_ctx_stack, abort
 from functools import wraps
-from jose import jwt
+from jose import jwk, jwt
+from jose.utils import base64url_decode
+from metrics import AUTH_SECONDS, AUTH_TOKEN_CACHE
 from urllib.request import urlopen
 
 
@@ -9,6 +17,17 @@ AUTH0_DOMAIN = 'fsndc7.auth0.com'
 ALGORITHMS = ['RS256']
 API_AUDIENCE = 'Coffee'
 
+# The key set location can be pointed at a local file (file://...) or a stub
+# server, which is what the tests and benchmarks do.
+JWKS_URL = os.environ.get(
+    'AUTH0_JWKS_URL', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+JWKS_TTL = int(os.environ.get('AUTH0_JWKS_TTL', 600))
+JWKS_MIN_REFRESH_INTERVAL = int(
+    os.environ.get('AUTH0_JWKS_MIN_REFRESH_INTERVAL', 30))
+TOKEN_CACHE_SIZE = int(os.environ.get('AUTH0_TOKEN_CACHE_SIZE', 10000))
+
+logger = logging.getLogger(__name__)
+
 # AuthError Exception
 '''
 AuthError Exception
@@ -22,6 +41,193 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+# JWKS Key Store
+'''
+JWKSKeyStore
+Process-wide cache of the identity provider's signing keys
+'''
+
+
+class JWKSKeyStore:
+    """Caches the JSON Web Key Set and the public keys built from it.
+
+    Keys are kept per `kid` as ready-to-use key objects. A stale key set is
+    refreshed in a background thread while the old keys keep serving, and
+    a token with an unknown `kid` forces a synchronous refresh at most once
+    every `min_refresh_interval` seconds.
+    """
+
+    def __init__(self, jwks_url=JWKS_URL, ttl=JWKS_TTL,
+                 min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL, timeout=5):
+        self.jwks_url = jwks_url
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self._keys = {}
+        self._fetched_at = None
+        self._last_attempt = None
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def get_key(self, kid):
+        """Returns the public key for `kid`, or None if the IdP has none
+        """
+        now = time.monotonic()
+        if self._fetched_at is None:
+            self.refresh()
+        elif now - self._fetched_at > self.ttl:
+            self._refresh_in_background(now)
+
+        key = self._keys.get(kid)
+        if key is None and self._may_refresh(now):
+            self.refresh(force=True)
+            key = self._keys.get(kid)
+        return key
+
+    def refresh(self, force=False):
+        """Fetches the key set and swaps it in, keeping the old keys on error
+        """
+        with self._lock:
+            if not force and self._fetched_at is not None and \
+                    time.monotonic() - self._fetched_at <= self.ttl:
+                return
+            self._last_attempt = time.monotonic()
+            try:
+                keys = self._load_keys()
+            except Exception:
+                if self._fetched_at is None:
+                    raise
+                logger.exception('Unable to refresh JWKS from %s',
+                                 self.jwks_url)
+                return
+            self._keys = keys
+            self._fetched_at = time.monotonic()
+
+    def clear(self):
+        with self._lock:
+            self._keys = {}
+            self._fetched_at = None
+            self._last_attempt = None
+
+    def _may_refresh(self, now):
+        return self._last_attempt is None or \
+            now - self._last_attempt >= self.min_refresh_interval
+
+    def _refresh_in_background(self, now):
+        if self._refreshing or not self._may_refresh(now):
+            return
+        self._refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=run, name='jwks-refresh', daemon=True).start()
+
+    def _load_keys(self):
+        with urlopen(self.jwks_url, timeout=self.timeout) as response:
+            jwks = json.loads(response.read())
+
+        keys = {}
+        for key in jwks['keys']:
+            if key.get('kty') != 'RSA' or key.get('use', 'sig') != 'sig':
+                continue
+            keys[key['kid']] = jwk.construct({
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key.get('use', 'sig'),
+                'n': key['n'],
+                'e': key['e']
+            }, ALGORITHMS[0])
+        return keys
+
+
+key_store = JWKSKeyStore()
+
+
+# Verified Token Cache
+'''
+VerifiedTokenCache
+Bounded LRU of payloads whose signature and claims were already verified
+'''
+
+VerifiedToken = namedtuple('VerifiedToken',
+                           ['payload', 'permissions', 'expires_at'])
+
+
+class VerifiedTokenCache:
+    """Maps a hash of the raw bearer token to its verified payload.
+
+    Entries expire at the token's `exp` claim and are never returned after
+    it, and the least recently used entry is evicted once `maxsize` is hit.
+    """
+
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode('utf-8')).digest()
+
+    def get(self, token):
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at <= time.time():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, token, payload):
+        """Stores a verified payload and returns its cache entry
+        """
+        permissions = payload.get('permissions')
+        entry = VerifiedToken(
+            payload,
+            None if permissions is None else frozenset(permissions),
+            payload.get('exp'))
+        if self.maxsize <= 0 or not isinstance(entry.expires_at, (int, float)):
+            return entry
+
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+
+token_cache = VerifiedTokenCache()
+
+
 # Auth Header
 
 
@@ -58,14 +264,16 @@ def get_token_auth_header():
     return token
 
 
-def check_permissions(permission, payload):
-    if 'permissions' not in payload:
-        raise AuthError({
-            'code': 'invalid_claims',
-            'description': 'Permissions not included in JWT.'
-        }, 400)
+def check_permissions(permission, payload, permissions=None):
+    if permissions is None:
+        if 'permissions' not in payload:
+            raise AuthError({
+                'code': 'invalid_claims',
+                'description': 'Permissions not included in JWT.'
+            }, 400)
+        permissions = payload['permissions']
 
-    if permission not in payload['permissions']:
+    if permission not in permissions:
         raise AuthError({
             'code': 'unauthorized',
             'description': 'Permission not found.'
@@ -73,34 +281,38 @@ def check_permissions(permission, payload):
     return True
 
 
+def verify_signature(token, key):
+    """Verifies the token signature against an already built public key
+    """
+    signing_input, _, encoded_signature = token.rpartition('.')
+    signature = base64url_decode(encoded_signature.encode('utf-8'))
+    return key.verify(signing_input.encode('utf-8'), signature)
+
+
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    with AUTH_SECONDS.labels('jwks').time():
+        rsa_key = key_store.get_key(unverified_header['kid'])
     if rsa_key:
+        started = time.perf_counter()
         try:
+            if unverified_header.get('alg') not in ALGORITHMS or \
+                    not verify_signature(token, rsa_key):
+                raise jwt.JWTError('Signature verification failed.')
+
             payload = jwt.decode(
                 token,
-                rsa_key,
+                None,
                 algorithms=ALGORITHMS,
                 audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
+                issuer='https://' + AUTH0_DOMAIN + '/',
+                options={'verify_signature': False}
             )
 
             return payload
@@ -121,25 +333,52 @@ def verify_decode_jwt(token):
                 'code': 'invalid_header',
                 'description': 'Unable to parse authentication token.'
             }, 400)
+        finally:
+            AUTH_SECONDS.labels('decode').observe(
+                time.perf_counter() - started)
     raise AuthError({
         'code': 'invalid_header',
                 'description': 'Unable to find the appropriate key.'
     }, 400)
 
 
+'''
+on_authenticated(callback)
+    registers callback(payload, permission), called once a request's token
+    and permission are verified and before the route runs; a callback
+    rejects the request by raising. Used by admission control
+'''
+
+_auth_hooks = []
+
+
+def on_authenticated(callback):
+    _auth_hooks.append(callback)
+    return callback
+
+
 def requires_auth(permission=""):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
             token = get_token_auth_header()
-            try:
-                payload = verify_decode_jwt(token)
-            except BaseException:
-                abort(401)
+            verified = token_cache.get(token)
+            AUTH_TOKEN_CACHE.labels(
+                'miss' if verified is None else 'hit').inc()
+            if verified is None:
+                try:
+                    payload = verify_decode_jwt(token)
+                except BaseException:
+                    abort(401)
+                verified = token_cache.put(token, payload)
 
-            check_permissions(permission, payload)
+            check_permissions(permission, verified.payload,
+                              verified.permissions)
+            _request_ctx_stack.top.current_user = verified.payload
+            for hook in _auth_hooks:
+                hook(verified.payload, permission)
 
-            return f(payload, *args, **kwargs)
+            return f(verified.payload, *args, **kwargs)
 
         return wrapper
     return requires_auth_decorator
\ No newline at end of file
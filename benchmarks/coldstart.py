@@ -0,0 +1,151 @@
+"""Time from starting gunicorn to its first fast response.
+
+    python -m benchmarks.coldstart --runs 5 --jwks-delay 0.2
+
+Starts gunicorn with gunicorn.conf.py and one worker, with and without the
+post-fork warm-up, and sends authenticated GET /movies?limit=20 requests
+back to back from the moment the process is spawned. A request is "fast"
+once its latency is within --fast-factor of the median of the last half
+of the run. A second phase runs two workers that are recycled every
+--max-requests requests under steady load, where a worker that is not
+warmed up stalls the requests it accepts first; the p99 and worst
+latency of that phase are reported too.
+The JWKS is served locally with --jwks-delay seconds added to mimic the
+round trip to the IdP. Medians over --runs are printed as JSON.
+"""
+import argparse
+import http.client
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.list_memory import seed
+from benchmarks.serving import drive, free_port, wait_until_up
+from benchmarks.tokens import LocalSigner
+
+MODES = {
+    'cold': {'GUNICORN_WARM_UP': '0'},
+    'warm': {'GUNICORN_WARM_UP': '1'},
+    'warm-no-preload': {'GUNICORN_WARM_UP': '1', 'GUNICORN_PRELOAD': '0'}
+}
+
+
+def request(port, headers, deadline):
+    """Sends one request, retrying until the master is listening
+    """
+    while True:
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        start = time.perf_counter()
+        try:
+            connection.request('GET', '/movies?limit=20', headers=headers)
+            response = connection.getresponse()
+            response.read()
+            if response.status != 200:
+                raise RuntimeError('status {}'.format(response.status))
+            return start, time.perf_counter()
+        except ConnectionError:
+            if time.perf_counter() > deadline:
+                raise
+            time.sleep(0.005)
+        finally:
+            connection.close()
+
+
+def start(env, port):
+    return subprocess.Popen(
+        [os.path.join(os.path.dirname(sys.executable), 'gunicorn'),
+         '-c', 'gunicorn.conf.py', 'benchmarks.target:app'],
+        env=dict(env, PORT=str(port)), stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+
+
+def stop(server):
+    server.terminate()
+    try:
+        server.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+
+def cold_start(env, port, headers, requests, fast_factor):
+    spawned = time.perf_counter()
+    server = start(dict(env, WEB_CONCURRENCY='1'), port)
+    try:
+        timings = [request(port, headers, spawned + 30)
+                   for _ in range(requests)]
+    finally:
+        stop(server)
+
+    latencies = [end - start for start, end in timings]
+    steady = statistics.median(latencies[len(latencies) // 2:])
+    first_fast = next(i for i, latency in enumerate(latencies)
+                      if latency <= steady * fast_factor)
+    return {
+        'first_response_ms': (timings[0][1] - spawned) * 1000,
+        'first_request_ms': latencies[0] * 1000,
+        'first_fast_request_ms': (timings[first_fast][1] - spawned) * 1000,
+        'steady_ms': steady * 1000
+    }
+
+
+def recycling(env, port, headers, max_requests, duration):
+    server = start(dict(env, WEB_CONCURRENCY='2',
+                        GUNICORN_MAX_REQUESTS=str(max_requests),
+                        GUNICORN_MAX_REQUESTS_JITTER=str(max_requests // 2)),
+                  port)
+    try:
+        wait_until_up(port)
+        request(port, headers, time.perf_counter() + 30)
+        result = drive(port, '/movies?limit=20', headers, 2, duration)
+    finally:
+        stop(server)
+    return {'recycle_p99_ms': result['p99_ms'],
+            'recycle_max_ms': result['max_ms'],
+            'recycle_errors': result['errors']}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--modes', nargs='+', default=list(MODES))
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--requests', type=int, default=40)
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--jwks-delay', type=float, default=0.2)
+    parser.add_argument('--fast-factor', type=float, default=1.5)
+    parser.add_argument('--max-requests', type=int, default=200)
+    parser.add_argument('--duration', type=float, default=5)
+    args = parser.parse_args()
+
+    signer = LocalSigner()
+    headers = {'Authorization': 'Bearer ' + signer.sign(['get:movies'])}
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        database = os.path.join(directory, 'benchmark.db')
+        seed(database, args.rows)
+        env = dict(os.environ,
+                   BENCHMARK_DATABASE_URI='sqlite:///' + database,
+                   AUTH0_JWKS_URL=signer.serve_jwks(args.jwks_delay),
+                   prometheus_multiproc_dir=directory)
+
+        for mode in args.modes:
+            mode_env = dict(env, **MODES[mode])
+            runs = [dict(cold_start(mode_env, free_port(), headers,
+                                    args.requests, args.fast_factor),
+                         **recycling(mode_env, free_port(), headers,
+                                     args.max_requests, args.duration))
+                    for _ in range(args.runs)]
+            result = {name: statistics.median(run[name] for run in runs)
+                      for name in runs[0]}
+            result['mode'] = mode
+            results.append(result)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
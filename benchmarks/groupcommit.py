@@ -0,0 +1,131 @@
+"""Write throughput of per-row commits against group commit.
+
+    python -m benchmarks.groupcommit --concurrency 1 8 32 --requests 2000
+
+For each concurrency, client threads POST /movies/add through the app
+in-process, first with one transaction per write and then with
+GROUP_COMMIT_ENABLED, against a fresh SQLite file per run (in --directory,
+so it can be put on a disk that really syncs) or --database-url. Reports
+writes per second, p50/p95 latency, database commits and the mean group
+size as JSON.
+"""
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+
+from sqlalchemy import event
+
+from benchmarks.serving import percentile
+from benchmarks.tokens import LocalSigner
+
+MODES = {
+    'per-row': {'GROUP_COMMIT_ENABLED': False},
+    'group': {'GROUP_COMMIT_ENABLED': True}
+}
+
+
+def run(database_url, mode, concurrency, requests, window_ms, headers):
+    from app import create_app
+    from models import db
+
+    app = create_app(dict(MODES[mode], **{
+        'SQLALCHEMY_DATABASE_URI': database_url,
+        'DEBUG': False,
+        'CACHE_ENABLED': False,
+        'GROUP_COMMIT_WINDOW_MS': window_ms,
+        'GROUP_COMMIT_MAX_SIZE': concurrency
+    }))
+    commits = [0]
+    with app.app_context():
+        db.create_all()
+        engine = db.engine
+
+    def count_commit(conn):
+        commits[0] += 1
+
+    event.listen(engine, 'commit', count_commit)
+    client = app.test_client()
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    remaining = [requests]
+
+    def worker():
+        own = []
+        while True:
+            with lock:
+                if remaining[0] == 0:
+                    break
+                remaining[0] -= 1
+                number = remaining[0]
+            start = time.perf_counter()
+            try:
+                response = client.post(
+                    '/movies/add', json={'title': 'Movie {}'.format(number)},
+                    headers=headers)
+                if response.status_code != 201:
+                    raise RuntimeError(response.status_code)
+            except Exception:
+                with lock:
+                    errors[0] += 1
+            own.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(own)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    event.remove(engine, 'commit', count_commit)
+
+    committer = app.extensions.get('group_commit')
+    return {
+        'mode': mode,
+        'concurrency': concurrency,
+        'requests': requests,
+        'errors': errors[0],
+        'writes_per_second': requests / elapsed,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'commits': commits[0],
+        'mean_group_size': committer.stats()['mean_group_size']
+        if committer else 1.0
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url')
+    parser.add_argument('--directory', default=None,
+                        help='where to create the SQLite file')
+    parser.add_argument('--concurrency', type=int, nargs='+',
+                        default=[1, 8, 32])
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--window-ms', type=float, default=2)
+    args = parser.parse_args()
+
+    signer = LocalSigner()
+    signer.install()
+    headers = {'Authorization': 'Bearer ' + signer.sign(['add:movies'])}
+
+    results = []
+    with tempfile.TemporaryDirectory(dir=args.directory) as directory:
+        for concurrency in args.concurrency:
+            for mode in MODES:
+                database_url = args.database_url or 'sqlite:///' + \
+                    os.path.join(directory, '{}-{}.db'.format(mode,
+                                                              concurrency))
+                results.append(run(database_url, mode, concurrency,
+                                   args.requests, args.window_ms, headers))
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
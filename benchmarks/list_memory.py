@@ -0,0 +1,95 @@
+"""Peak RSS of the buffered and streaming list modes against row count.
+
+    python -m benchmarks.list_memory --rows 10000 100000 500000
+
+Each measurement runs in a fresh interpreter against a pre-seeded SQLite
+file, and reports how much the request raised the process's peak RSS.
+Results are printed as JSON.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+
+from sqlalchemy import create_engine
+
+MODES = {
+    'buffered': '/movies',
+    'streaming': '/movies?stream=true'
+}
+
+
+def seed(path, rows):
+    from models import db
+
+    engine = create_engine('sqlite:///' + path)
+    db.metadata.create_all(engine)
+    batch = 10000
+    for start in range(0, rows, batch):
+        engine.execute(
+            'INSERT INTO "Movie" (title, description, category) '
+            'VALUES (?, ?, ?)',
+            [('Movie {}'.format(i), 'Description of movie {} '.format(i) * 4,
+              'drama') for i in range(start, min(start + batch, rows))])
+    engine.dispose()
+
+
+def measure(database, url):
+    """Runs in the child process: one request, returns the RSS increase
+    """
+    from benchmarks.tokens import LocalSigner
+    from app import create_app
+
+    signer = LocalSigner()
+    signer.install(os.path.join(tempfile.mkdtemp(), 'jwks.json'))
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + database,
+        'DEBUG': False,
+        'CACHE_ENABLED': False
+    })
+    client = app.test_client()
+    headers = {'Authorization': 'Bearer ' + signer.sign(['get:movies'])}
+    client.get('/', headers=headers)
+
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    response = client.get(url, headers=headers, buffered=False)
+    size = 0
+    for chunk in response.response:
+        size += len(chunk)
+    response.close()
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {'peak_rss_increase_kb': after - before, 'bytes': size}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, nargs='+',
+                        default=[10000, 100000, 300000])
+    parser.add_argument('--child', nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure(*args.child)))
+        return
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for rows in args.rows:
+            database = os.path.join(directory, '{}.db'.format(rows))
+            seed(database, rows)
+            for mode, url in MODES.items():
+                output = subprocess.check_output([
+                    sys.executable, '-m', 'benchmarks.list_memory',
+                    '--child', database, url])
+                result = json.loads(output.decode('utf-8').splitlines()[-1])
+                result.update({'mode': mode, 'rows': rows})
+                results.append(result)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
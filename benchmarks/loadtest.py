@@ -0,0 +1,404 @@
+"""Load test for every route in create_app, with baseline comparison.
+
+    python -m benchmarks.loadtest --output results.json \\
+        --baseline benchmarks/baseline.json
+
+benchmarks/baseline.json was recorded with the defaults (10k movies and
+actors, concurrency 1 and 8, 200 requests); compare runs made with the
+same arguments, on comparable hardware, or record a new baseline first:
+
+    python -m benchmarks.loadtest --movies 1000000 --actors 1000000 \\
+        --concurrency 1 8 32 --requests 500 --output results.json
+
+Tokens are signed with a local RSA key and verified against a JWKS served
+from a local HTTP server, so no Auth0 tenant is needed. Requests run
+in-process through the WSGI test client on `concurrency` threads, which
+keeps runs reproducible and lets each request's SQL statements be counted.
+Results are JSON; with --baseline, any route whose p95 or throughput is
+worse than the baseline by more than --tolerance is reported and the
+exit status is 1. Each result also carries the process RSS when its
+scenario started and the highest RSS sampled while it ran.
+
+With --admission, admission control is on and requests it turns away
+(429/503) are counted as "rejected" rather than errors; raising
+--concurrency past --max-concurrent shows whether admitted requests keep
+their latency while the excess is refused quickly:
+
+    python -m benchmarks.loadtest --admission --max-concurrent 4 \\
+        --rate 10000 --concurrency 4 16 64 --routes get_movies
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+from sqlalchemy import create_engine, event
+
+from benchmarks.seed import seed_catalog, CATEGORIES, GENDERS, WORDS
+from benchmarks.tokens import LocalSigner, ALL_PERMISSIONS
+
+
+class Scenarios:
+    """One request builder per endpoint, keyed by the endpoint name
+
+    Builders return (method, url, json body). Write scenarios take ids
+    from disjoint ranges so concurrent deletes never collide. Keys that
+    are not endpoints (get_movies_filtered) are extra scenarios for one.
+    """
+
+    def __init__(self, movies, actors):
+        self.movies = movies
+        self.actors = actors
+        self._delete_movie = itertools.count(1)
+        self._delete_actor = itertools.count(1)
+        self.builders = {
+            'welcome': lambda rng: ('GET', '/', None),
+            'health': lambda rng: ('GET', '/health', None),
+            'metrics': lambda rng: ('GET', '/metrics', None),
+            'get_movies': lambda rng: (
+                'GET', '/movies?limit=50&cursor=' + self.cursor(rng, movies),
+                None),
+            'get_movies_filtered': lambda rng: (
+                'GET', '/movies?limit=50&sort=title&category={}'
+                '&title_prefix={}'.format(rng.choice(CATEGORIES),
+                                          rng.choice(WORDS)[:2]), None),
+            'get_movie': lambda rng: (
+                'GET', '/movies/{}'.format(self.read_id(rng, movies)), None),
+            'get_movie_cast': lambda rng: (
+                'GET', '/movies/{}/cast'.format(self.read_id(rng, movies)),
+                None),
+            'replace_movie_cast': lambda rng: (
+                'PUT', '/movies/{}/cast'.format(self.read_id(rng, movies)),
+                [{'actor_id': actor_id, 'role': 'Lead'} for actor_id in
+                 rng.sample(range(1, max(actors // 2, 1) + 1),
+                            min(3, max(actors // 2, 1)))]),
+            'search_movies_route': lambda rng: (
+                'GET', '/movies/search?limit=20&q=' + rng.choice(WORDS),
+                None),
+            'create_movies': lambda rng: (
+                'POST', '/movies/add', {'title': 'Load test movie',
+                                        'category': 'drama'}),
+            'create_movies_bulk': lambda rng: (
+                'POST', '/movies/bulk',
+                [{'title': 'Bulk movie {}'.format(i)} for i in range(100)]),
+            'update_movie': lambda rng: (
+                'PATCH', '/movies/{}'.format(self.read_id(rng, movies)),
+                {'title': 'Patched movie'}),
+            'delete_movie': lambda rng: (
+                'DELETE', '/movies/{}'.format(self.delete_id(
+                    self._delete_movie, movies)), None),
+            'get_actors': lambda rng: (
+                'GET', '/actors?limit=50&cursor=' + self.cursor(rng, actors),
+                None),
+            'get_actors_filtered': lambda rng: (
+                'GET', '/actors?limit=50&gender={}&min_age={}&max_age={}'
+                .format(rng.choice(GENDERS), *sorted(rng.sample(
+                    range(5, 91), 2))), None),
+            'get_actor': lambda rng: (
+                'GET', '/actors/{}'.format(self.read_id(rng, actors)), None),
+            'get_actor_movies': lambda rng: (
+                'GET', '/actors/{}/movies'.format(self.read_id(rng, actors)),
+                None),
+            'create_actor': lambda rng: (
+                'POST', '/actors/add', {'name': 'Load test actor', 'age': 30,
+                                        'gender': 'female'}),
+            'create_actors_bulk': lambda rng: (
+                'POST', '/actors/bulk',
+                [{'name': 'Bulk actor {}'.format(i)} for i in range(100)]),
+            'update_actor': lambda rng: (
+                'PATCH', '/actors/{}'.format(self.read_id(rng, actors)),
+                {'name': 'Patched actor', 'gender': 'other'}),
+            'delete_actor': lambda rng: (
+                'DELETE', '/actors/{}'.format(self.delete_id(
+                    self._delete_actor, actors)), None),
+            'get_stats': lambda rng: ('GET', '/stats', None),
+        }
+
+    @staticmethod
+    def cursor(rng, count):
+        from pagination import encode_cursor
+        return encode_cursor({'id': rng.randint(0, max(count - 50, 0))})
+
+    @staticmethod
+    def read_id(rng, count):
+        # reads and patches stay in the first half, deletes use the second
+        return rng.randint(1, max(count // 2, 1))
+
+    @staticmethod
+    def delete_id(counter, count):
+        return count // 2 + next(counter)
+
+    def uncovered(self, app):
+        return sorted(rule.endpoint for rule in app.url_map.iter_rules()
+                      if rule.endpoint != 'static' and
+                      rule.endpoint not in self.builders)
+
+
+class StatementCounter:
+    """Counts SQL statements per thread
+    """
+
+    def __init__(self, engine):
+        self.local = threading.local()
+        event.listen(engine, 'before_cursor_execute', self.count)
+
+    def count(self, *args):
+        self.local.value = getattr(self.local, 'value', 0) + 1
+
+    def take(self):
+        value = getattr(self.local, 'value', 0)
+        self.local.value = 0
+        return value
+
+
+REJECTED_STATUSES = (429, 503)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def current_rss_kb():
+    """Resident set size of this process now; where /proc is missing,
+    the peak so far
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class RSSSampler(threading.Thread):
+    """Samples the process RSS every `interval` seconds until stopped
+    """
+
+    def __init__(self, interval=0.01):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.start_kb = self.peak_kb = current_rss_kb()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.peak_kb = max(self.peak_kb, current_rss_kb())
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+        self.peak_kb = max(self.peak_kb, current_rss_kb())
+
+
+def run_scenario(app, build, headers, concurrency, requests, counter):
+    """Runs `requests` requests on `concurrency` threads; thread i sends
+    headers[i % len(headers)]
+    """
+    latencies, rejected, queries, errors = [], [], [], []
+    lock = threading.Lock()
+    remaining = itertools.count()
+
+    def worker(seed):
+        rng = random.Random(seed)
+        client = app.test_client()
+        own_headers = headers[seed % len(headers)]
+        own_latencies, own_rejected, own_queries, own_errors = [], [], [], 0
+        while next(remaining) < requests:
+            method, url, body = build(rng)
+            counter.take()
+            start = time.perf_counter()
+            response = client.open(url, method=method, headers=own_headers,
+                                   json=body)
+            response.get_data()
+            elapsed = time.perf_counter() - start
+            own_queries.append(counter.take())
+            if response.status_code in REJECTED_STATUSES:
+                own_rejected.append(elapsed)
+                continue
+            own_latencies.append(elapsed)
+            if response.status_code >= 400:
+                own_errors += 1
+        with lock:
+            latencies.extend(own_latencies)
+            rejected.extend(own_rejected)
+            queries.extend(own_queries)
+            errors.append(own_errors)
+
+    rss = RSSSampler()
+    rss.start()
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(seed,))
+               for seed in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    rss.stop()
+
+    def ms(values, fraction):
+        value = percentile(values, fraction)
+        return None if value is None else value * 1000
+
+    return {
+        'requests': len(latencies) + len(rejected),
+        'errors': sum(errors),
+        'rejected': len(rejected),
+        'throughput_rps': len(latencies) / elapsed,
+        'p50_ms': ms(latencies, 0.50),
+        'p95_ms': ms(latencies, 0.95),
+        'p99_ms': ms(latencies, 0.99),
+        'rejected_p95_ms': ms(rejected, 0.95),
+        'queries_per_request': sum(queries) / len(queries),
+        'rss_start_kb': rss.start_kb,
+        'rss_peak_kb': rss.peak_kb
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Returns the results that regressed against the baseline
+    """
+    previous = {(item['endpoint'], item['concurrency']): item
+                for item in baseline['results']}
+    regressions = []
+    for item in results['results']:
+        before = previous.get((item['endpoint'], item['concurrency']))
+        if before is None or None in (item['p95_ms'], before['p95_ms']):
+            # nothing to compare when every request was rejected
+            continue
+        checks = {
+            'p95_ms': item['p95_ms'] > before['p95_ms'] * (1 + tolerance),
+            'throughput_rps': item['throughput_rps'] <
+            before['throughput_rps'] * (1 - tolerance),
+            'queries_per_request': item['queries_per_request'] >
+            before['queries_per_request']
+        }
+        for metric, regressed in checks.items():
+            if regressed:
+                regressions.append({
+                    'endpoint': item['endpoint'],
+                    'concurrency': item['concurrency'],
+                    'metric': metric,
+                    'baseline': before[metric],
+                    'current': item[metric]
+                })
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database-url',
+                        help='database to seed and test against; a '
+                             'temporary SQLite file by default')
+    parser.add_argument('--movies', type=int, default=10000)
+    parser.add_argument('--actors', type=int, default=10000)
+    parser.add_argument('--no-seed', action='store_true',
+                        help='reuse an already seeded --database-url')
+    parser.add_argument('--concurrency', type=int, nargs='+',
+                        default=[1, 8])
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per route and concurrency level')
+    parser.add_argument('--routes', nargs='+',
+                        help='only run these endpoints')
+    parser.add_argument('--cache', action='store_true',
+                        help='leave the response cache on')
+    parser.add_argument('--admission', action='store_true',
+                        help='turn admission control on')
+    parser.add_argument('--max-concurrent', type=int,
+                        help='admission cap on in-flight requests')
+    parser.add_argument('--rate', type=float,
+                        help='admission rate per subject and class, in '
+                             'requests per second; bursts are twice this')
+    parser.add_argument('--subjects', type=int, default=1,
+                        help='spread the client threads over this many '
+                             'token subjects')
+    parser.add_argument('--output', help='write the results here')
+    parser.add_argument('--baseline', help='compare against this result file')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    database_url = args.database_url or \
+        'sqlite:///' + os.path.join(directory, 'loadtest.db')
+    if not args.no_seed:
+        engine = create_engine(database_url)
+        seed_catalog(engine, args.movies, args.actors)
+        engine.dispose()
+
+    from app import create_app
+    signer = LocalSigner()
+    signer.install()
+    config = {
+        'SQLALCHEMY_DATABASE_URI': database_url,
+        'DEBUG': False,
+        'CACHE_ENABLED': args.cache,
+        'ADMISSION_ENABLED': args.admission,
+        'ADMISSION_MAX_CONCURRENT': args.max_concurrent
+    }
+    if args.rate:
+        config['ADMISSION_RATES'] = {'read': args.rate, 'write': args.rate}
+        config['ADMISSION_BURSTS'] = {'read': args.rate * 2,
+                                      'write': args.rate * 2}
+    app = create_app(config)
+    headers = [{'Authorization': 'Bearer ' + signer.sign(
+        ALL_PERMISSIONS, sub='auth0|loadtest-{}'.format(subject))}
+        for subject in range(args.subjects)]
+
+    scenarios = Scenarios(args.movies, args.actors)
+    uncovered = scenarios.uncovered(app)
+    if uncovered:
+        parser.error('no load-test scenario for: ' + ', '.join(uncovered))
+
+    with app.app_context():
+        from models import db
+        counter = StatementCounter(db.engine)
+
+    results = []
+    for endpoint, build in scenarios.builders.items():
+        if args.routes and endpoint not in args.routes:
+            continue
+        for concurrency in args.concurrency:
+            result = run_scenario(app, build, headers, concurrency,
+                                  args.requests, counter)
+            result.update({'endpoint': endpoint, 'concurrency': concurrency})
+            results.append(result)
+            print('{endpoint:22} c={concurrency:<3} {throughput_rps:8.1f} rps '
+                  'p95 {p95:>7} ms  {queries_per_request:.1f} q/req  '
+                  '{rejected} rejected  rss {rss_peak_kb} kB'.format(
+                      p95='-' if result['p95_ms'] is None else
+                      '{:.2f}'.format(result['p95_ms']), **result),
+                  file=sys.stderr)
+
+    output = {
+        'movies': args.movies,
+        'actors': args.actors,
+        'requests': args.requests,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'results': results
+    }
+    if args.baseline:
+        with open(args.baseline) as f:
+            output['regressions'] = compare(output, json.load(f),
+                                            args.tolerance)
+
+    text = json.dumps(output, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    print(text)
+
+    if output.get('regressions'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
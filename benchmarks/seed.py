@@ -0,0 +1,67 @@
+import random
+
+from models import db, Movie, Actor, Cast
+
+'''
+Synthetic catalog
+    bulk-loads a deterministic catalog of movies, actors and casts
+    through executemany in large batches, one transaction per batch
+'''
+
+CATEGORIES = ['drama', 'comedy', 'action', 'horror', 'documentary']
+GENDERS = ['female', 'male', 'other']
+WORDS = ['night', 'river', 'iron', 'last', 'city', 'dream', 'storm', 'joker',
+         'garden', 'silent', 'empire', 'summer', 'ghost', 'road', 'king']
+
+
+def movie_rows(start, stop, rng):
+    for i in range(start, stop):
+        title = ' '.join(rng.choice(WORDS) for _ in range(3)).title()
+        yield {
+            'title': '{} {}'.format(title, i),
+            'description': ' '.join(rng.choice(WORDS) for _ in range(20)),
+            'category': rng.choice(CATEGORIES)
+        }
+
+
+def actor_rows(start, stop, rng):
+    for i in range(start, stop):
+        yield {
+            'name': '{} {}'.format(rng.choice(WORDS).title(), i),
+            'gender': rng.choice(GENDERS),
+            'age': rng.randint(5, 90)
+        }
+
+
+def cast_rows(start, stop, rng, actors, cast_size):
+    for movie_id in range(start + 1, stop + 1):
+        for actor_id in rng.sample(range(1, actors + 1),
+                                   min(cast_size, actors)):
+            yield {
+                'movie_id': movie_id,
+                'actor_id': actor_id,
+                'role': rng.choice(WORDS).title()
+            }
+
+
+def seed_catalog(engine, movies, actors, batch=10000, seed=0, cast_size=3):
+    """Creates the schema on `engine` and loads the synthetic catalog,
+    with `cast_size` actors cast in every movie
+    """
+    rng = random.Random(seed)
+    db.metadata.create_all(engine)
+    for model, rows, count in ((Movie, movie_rows, movies),
+                               (Actor, actor_rows, actors)):
+        for start in range(0, count, batch):
+            with engine.begin() as connection:
+                connection.execute(
+                    model.__table__.insert(),
+                    list(rows(start, min(start + batch, count), rng)))
+    if not actors:
+        return
+    for start in range(0, movies, batch):
+        with engine.begin() as connection:
+            connection.execute(
+                Cast.__table__.insert(),
+                list(cast_rows(start, min(start + batch, movies), rng,
+                               actors, cast_size)))
@@ -0,0 +1,94 @@
+"""Cost of building a list response body from ORM instances and from rows.
+
+    python -m benchmarks.serialization --rows 10000 100000 --repeat 5
+
+For each row count, times (best of --repeat) fetching and encoding the
+GET /movies body: the previous ORM path (Movie instances, format(),
+jsonify), row tuples with Flask's encoder, and row tuples with orjson
+when installed.
+Every variant's output is checked against the ORM path. Results are
+printed as JSON.
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from benchmarks.list_memory import seed
+
+
+def variants():
+    from flask import jsonify
+    import serialization
+    from fields import select_fields
+    from models import Movie
+
+    def orm():
+        movies = Movie.query.order_by(Movie.id).all()
+        return jsonify({'success': True,
+                        'all_movies': [movie.format() for movie in movies]})
+
+    def rows():
+        query, serialize = select_fields(Movie, None)
+        return serialization.json_response({
+            'success': True,
+            'all_movies': [serialize(row) for row in query.order_by(Movie.id)]
+        })
+
+    providers = {'stdlib': serialization.StdlibProvider()}
+    if serialization.orjson is not None:
+        providers['orjson'] = serialization.OrjsonProvider()
+
+    yield 'orm+jsonify', None, orm
+    for name, provider in providers.items():
+        yield 'rows+' + name, provider, rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, nargs='+',
+                        default=[10000, 100000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    from app import create_app
+    from models import db
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for rows in args.rows:
+            database = os.path.join(directory, '{}.db'.format(rows))
+            seed(database, rows)
+            app = create_app({
+                'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + database,
+                'DEBUG': False,
+                'CACHE_ENABLED': False
+            })
+            with app.test_request_context():
+                expected = None
+                for name, provider, build in variants():
+                    if provider is not None:
+                        app.extensions['json_provider'] = provider
+                    timings = []
+                    for _ in range(args.repeat):
+                        db.session.expunge_all()
+                        start = time.perf_counter()
+                        body = build().get_data()
+                        timings.append(time.perf_counter() - start)
+                    document = json.loads(body)
+                    if expected is None:
+                        expected = document
+                    results.append({
+                        'rows': rows,
+                        'variant': name,
+                        'best_ms': min(timings) * 1000,
+                        'bytes': len(body),
+                        'matches_orm': document == expected
+                    })
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
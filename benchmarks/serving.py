@@ -0,0 +1,154 @@
+"""Throughput of the sync (gunicorn) and ASGI (uvicorn) serving modes.
+
+    python -m benchmarks.serving --concurrency 1 8 32 64 --duration 5
+
+Both servers run the same app against a seeded SQLite file with locally
+signed tokens; every client thread keeps one connection open and issues
+GET /movies?limit=20 back to back. Results are printed as JSON.
+"""
+import argparse
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks.list_memory import seed
+from benchmarks.tokens import LocalSigner
+
+SERVERS = {
+    'sync': ['gunicorn', '--workers', '{workers}', '--bind',
+             '127.0.0.1:{port}', 'benchmarks.target:app'],
+    'asgi': ['uvicorn', '--workers', '{workers}', '--loop', 'asyncio',
+             '--http', 'h11', '--host', '127.0.0.1', '--port', '{port}',
+             'benchmarks.target:asgi_app']
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_up(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('server on port {} did not start'.format(port))
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def drive(port, path, headers, concurrency, duration):
+    """Runs `concurrency` keep-alive clients for `duration` seconds
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.time() + duration
+
+    def client():
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        own = []
+        while time.time() < deadline:
+            start = time.perf_counter()
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                if response.status != 200:
+                    raise RuntimeError(response.status)
+            except Exception:
+                with lock:
+                    errors[0] += 1
+                connection.close()
+                connection = http.client.HTTPConnection('127.0.0.1', port,
+                                                        timeout=30)
+                continue
+            own.append(time.perf_counter() - start)
+        connection.close()
+        with lock:
+            latencies.extend(own)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'throughput_rps': len(latencies) / duration,
+        'p50_ms': (percentile(latencies, 0.5) or 0) * 1000,
+        'p99_ms': (percentile(latencies, 0.99) or 0) * 1000,
+        'max_ms': max(latencies, default=0) * 1000
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--modes', nargs='+', default=list(SERVERS))
+    parser.add_argument('--concurrency', type=int, nargs='+',
+                        default=[1, 8, 32, 64])
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--rows', type=int, default=1000)
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        database = os.path.join(directory, 'benchmark.db')
+        seed(database, args.rows)
+        signer = LocalSigner()
+        env = dict(os.environ,
+                   BENCHMARK_DATABASE_URI='sqlite:///' + database,
+                   AUTH0_JWKS_URL=signer.write_jwks(
+                       os.path.join(directory, 'jwks.json')))
+        headers = {'Authorization': 'Bearer ' + signer.sign(['get:movies'])}
+        bin_dir = os.path.dirname(sys.executable)
+
+        for mode in args.modes:
+            port = free_port()
+            command = [part.format(port=port, workers=args.workers)
+                       for part in SERVERS[mode]]
+            command[0] = os.path.join(bin_dir, command[0])
+            server = subprocess.Popen(command, env=env,
+                                      stdout=subprocess.DEVNULL,
+                                      stderr=subprocess.DEVNULL)
+            try:
+                wait_until_up(port)
+                drive(port, '/movies?limit=20', headers, 1, 1)
+                for concurrency in args.concurrency:
+                    result = drive(port, '/movies?limit=20', headers,
+                                   concurrency, args.duration)
+                    result.update({'mode': mode, 'concurrency': concurrency,
+                                   'workers': args.workers})
+                    results.append(result)
+            finally:
+                server.terminate()
+                try:
+                    server.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    server.kill()
+                    server.wait()
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
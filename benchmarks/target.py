@@ -0,0 +1,19 @@
+import os
+from asgiref.wsgi import WsgiToAsgi
+
+from app import create_app
+from asgi import Lifespan
+
+'''
+Server target for the serving benchmarks
+    the app pointed at BENCHMARK_DATABASE_URI, as WSGI (app) and ASGI
+    (asgi_app); AUTH0_JWKS_URL points auth at the benchmark's local keys
+    and BENCHMARK_CACHE=1 turns the response cache on
+'''
+
+app = create_app({
+    'SQLALCHEMY_DATABASE_URI': os.environ['BENCHMARK_DATABASE_URI'],
+    'DEBUG': False,
+    'CACHE_ENABLED': os.environ.get('BENCHMARK_CACHE') == '1'
+})
+asgi_app = Lifespan(WsgiToAsgi(app))
@@ -0,0 +1,97 @@
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jose import jwk, jwt
+
+import auth
+
+'''
+Offline token signing
+    a locally generated RSA key plus a matching JWKS file, so benchmarks
+    can drive @requires_auth routes without Auth0 or the network
+'''
+
+KID = 'benchmark-key'
+
+
+class LocalSigner:
+
+    def __init__(self, kid=KID):
+        self.kid = kid
+        private_key = rsa.generate_private_key(
+            public_exponent=65537, key_size=2048, backend=default_backend())
+        self.private_pem = private_key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.TraditionalOpenSSL,
+            serialization.NoEncryption()).decode('utf-8')
+
+    def jwks(self):
+        public_key = jwk.construct(self.private_pem, 'RS256') \
+            .public_key().to_dict()
+        public_key = {name: value.decode('utf-8')
+                      if isinstance(value, bytes) else value
+                      for name, value in public_key.items()}
+        return {'keys': [dict(public_key, kid=self.kid, use='sig')]}
+
+    def write_jwks(self, path):
+        """Writes the key set to `path` and returns its file:// URL
+        """
+        with open(path, 'w') as f:
+            json.dump(self.jwks(), f)
+        return 'file://' + os.path.abspath(path)
+
+    def serve_jwks(self, delay=0):
+        """Serves the key set from a local HTTP server, returns its URL;
+        `delay` seconds are added to every response to mimic a remote IdP
+        """
+        body = json.dumps(self.jwks()).encode('utf-8')
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                time.sleep(delay)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return 'http://127.0.0.1:{}/.well-known/jwks.json'.format(
+            server.server_port)
+
+    def install(self, path=None):
+        """Points the process-wide auth key store at this signer's keys,
+        written to `path` or served over HTTP when no path is given
+        """
+        auth.key_store.jwks_url = self.write_jwks(path) if path \
+            else self.serve_jwks()
+        auth.key_store.clear()
+        auth.token_cache.clear()
+
+    def sign(self, permissions, sub='auth0|benchmark', expires_in=3600):
+        now = int(time.time())
+        return jwt.encode({
+            'iss': 'https://' + auth.AUTH0_DOMAIN + '/',
+            'sub': sub,
+            'aud': auth.API_AUDIENCE,
+            'iat': now,
+            'exp': now + expires_in,
+            'permissions': list(permissions)
+        }, self.private_pem, algorithm='RS256', headers={'kid': self.kid})
+
+
+ALL_PERMISSIONS = [
+    'get:movies', 'add:movies', 'patch:movies', 'delete:movies',
+    'get:actors', 'add:actors', 'patch:actors', 'delete:actors',
+    'get:stats'
+]
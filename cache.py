@@ -0,0 +1,247 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import current_app, request, make_response
+from metrics import CACHE_BYTES_SAVED, CACHE_REQUESTS
+from models import on_commit, resolve_tables
+
+'''
+Shared response cache
+    GET responses are stored in Redis, or in a byte-bounded in-process LRU
+    when REDIS_URL is not set. Keys embed a generation number per table;
+    committing a write to a table bumps its generation, so every cached
+    response that read it stops matching at once
+'''
+
+
+class MemoryBackend:
+    """In-process LRU bounded by the total size of the stored values
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._values = OrderedDict()
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._values.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at <= time.monotonic():
+                self._remove(key)
+                return None
+            self._values.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._set(key, value, ttl)
+
+    def add(self, key, value, ttl):
+        """Stores `value` unless `key` holds a live one; True if stored
+        """
+        with self._lock:
+            item = self._values.get(key)
+            if item is not None and item[0] > time.monotonic():
+                return False
+            return self._set(key, value, ttl)
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._values:
+                self._remove(key)
+
+    def get_counters(self, names):
+        with self._lock:
+            return [self._counters.get(name, 0) for name in names]
+
+    def incr(self, name):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + 1
+
+    def _set(self, key, value, ttl):
+        if len(value) > self.max_bytes:
+            return False
+        if key in self._values:
+            self._remove(key)
+        self._values[key] = (time.monotonic() + ttl, value)
+        self.size += len(value)
+        while self.size > self.max_bytes:
+            self._remove(next(iter(self._values)))
+        return True
+
+    def _remove(self, key):
+        _, value = self._values.pop(key)
+        self.size -= len(value)
+
+
+class RedisBackend:
+    """Stores responses in Redis with native expiry, shared by all workers
+    """
+
+    def __init__(self, client, prefix='casting:'):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, value, ex=int(ttl))
+
+    def add(self, key, value, ttl):
+        return bool(self.client.set(self.prefix + key, value, ex=int(ttl),
+                                    nx=True))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def get_counters(self, names):
+        values = self.client.mget([self.prefix + name for name in names])
+        return [int(value or 0) for value in values]
+
+    def incr(self, name):
+        self.client.incr(self.prefix + name)
+
+
+class ResponseCache:
+
+    def __init__(self, backend, ttl):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    def key(self, tables, scope):
+        generations = self.backend.get_counters(
+            ['generation:' + table for table in tables])
+        args = sorted(request.args.items(multi=True))
+        digest = hashlib.sha1(json.dumps(
+            [request.path, args, sorted(scope)]).encode('utf-8')).hexdigest()
+        return 'response:{}:{}:{}'.format(
+            request.endpoint,
+            '.'.join(str(generation) for generation in generations),
+            digest)
+
+    def get_response(self, key):
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        response = load_response(value)
+        self.hits += 1
+        self.bytes_saved += len(response.get_data())
+        return response
+
+    def set_response(self, key, response, ttl=None):
+        self.backend.set(key, dump_response(response),
+                         self.ttl if ttl is None else ttl)
+
+    def invalidate(self, tables):
+        for table in tables:
+            self.backend.incr('generation:' + table)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'bytes_saved': self.bytes_saved
+        }
+
+
+def init_cache(app):
+    """Builds the response cache from the app config
+    """
+    if app.config.get('CACHE_REDIS_URL'):
+        import redis
+        backend = RedisBackend(
+            redis.StrictRedis.from_url(app.config['CACHE_REDIS_URL']))
+    else:
+        backend = MemoryBackend(app.config['CACHE_MAX_BYTES'])
+    app.extensions['response_cache'] = ResponseCache(
+        backend, app.config['CACHE_TTL'])
+
+
+@on_commit
+def invalidate_tables(tables):
+    if not current_app:
+        return
+    cache = current_app.extensions.get('response_cache')
+    if cache is not None:
+        cache.invalidate(tables)
+
+
+def dump_response(response):
+    """Serializes a response as one JSON header line followed by the body
+    """
+    head = json.dumps({
+        'status': response.status_code,
+        'headers': [[name, value] for name, value in response.headers
+                    if name in ('Content-Type', 'ETag')]
+    })
+    return head.encode('utf-8') + b'\n' + response.get_data()
+
+
+def load_response(value):
+    head, body = value.split(b'\n', 1)
+    stored = json.loads(head.decode('utf-8'))
+    response = make_response(body, stored['status'])
+    for name, value in stored['headers']:
+        response.headers[name] = value
+    return response
+
+
+def cached(*tables):
+    """Serves the route from the response cache until `tables` are written
+
+    Goes below @requires_auth; the key covers the route, its query string
+    and the caller's permissions. With replica routing, a subject pinned
+    to the primary bypasses the cache and replica reads are only kept for
+    REPLICA_CACHE_TTL seconds.
+    `tables` may be a single callable, returning the tables of the current
+    request.
+    """
+    def cached_decorator(f):
+        @wraps(f)
+        def wrapper(payload, *args, **kwargs):
+            cache = current_app.extensions.get('response_cache')
+            router = current_app.extensions.get('read_router')
+            if cache is None or not current_app.config['CACHE_ENABLED'] or \
+                    router is not None and router.current_user_pinned():
+                return f(payload, *args, **kwargs)
+
+            key = cache.key(resolve_tables(tables),
+                            payload.get('permissions', []))
+            response = cache.get_response(key)
+            if response is not None:
+                CACHE_REQUESTS.labels('hit').inc()
+                CACHE_BYTES_SAVED.inc(len(response.get_data()))
+                etag = response.get_etag()[0]
+                if etag and request.if_none_match.contains_weak(etag):
+                    response = make_response('', 304)
+                    response.set_etag(etag)
+                response.headers['X-Cache'] = 'HIT'
+                return response
+
+            CACHE_REQUESTS.labels('miss').inc()
+            response = make_response(f(payload, *args, **kwargs))
+            if response.status_code == 200 and not response.is_streamed:
+                ttl = cache.ttl
+                if router is not None and router.read_engine() is not None:
+                    ttl = min(ttl, current_app.config['REPLICA_CACHE_TTL'])
+                cache.set_response(key, response, ttl)
+            response.headers['X-Cache'] = 'MISS'
+            return response
+
+        return wrapper
+    return cached_decorator
@@ -0,0 +1,206 @@
+import zlib
+from flask import request
+from cache import MemoryBackend
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+'''
+Response compression
+    gzip, plus br and zstd when the brotli / zstandard packages are
+    installed, picked from Accept-Encoding. Bodies under COMPRESS_MIN_SIZE
+    go out as they are, streamed lists are compressed chunk by chunk, and
+    the compressed bytes of a response with an ETag are kept so the same
+    unchanged body is not compressed again
+'''
+
+
+class Gzip:
+    name = 'gzip'
+
+    def __init__(self, level):
+        self.level = level
+
+    def compressor(self):
+        return GzipStream(self.level)
+
+    def compress(self, data):
+        stream = self.compressor()
+        return stream.compress(data) + stream.finish()
+
+
+class GzipStream:
+
+    def __init__(self, level):
+        # wbits 31: a gzip header and trailer around the deflate stream
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self._compressor.compress(data) + \
+            self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class Brotli:
+    name = 'br'
+
+    def __init__(self, level):
+        self.level = level
+
+    def compressor(self):
+        return BrotliStream(self.level)
+
+    def compress(self, data):
+        return brotli.compress(data, quality=self.level)
+
+
+class BrotliStream:
+
+    def __init__(self, level):
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self._compressor.process(data) + self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+class Zstd:
+    name = 'zstd'
+
+    def __init__(self, level):
+        self._context = zstandard.ZstdCompressor(level=level)
+
+    def compressor(self):
+        return ZstdStream(self._context)
+
+    def compress(self, data):
+        return self._context.compress(data)
+
+
+class ZstdStream:
+
+    def __init__(self, context):
+        self._compressor = context.compressobj()
+
+    def compress(self, data):
+        return self._compressor.compress(data) + \
+            self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+ENCODERS = {'gzip': Gzip}
+if brotli is not None:
+    ENCODERS['br'] = Brotli
+if zstandard is not None:
+    ENCODERS['zstd'] = Zstd
+
+
+def compress_stream(chunks, compressor):
+    """Compresses a streamed body, flushing after every chunk so the client
+    keeps receiving rows as they are produced
+    """
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+class Compressor:
+    """Negotiates and applies Content-Encoding for one app
+    """
+
+    def __init__(self, app):
+        config = app.config
+        self.min_size = config['COMPRESS_MIN_SIZE']
+        self.mimetypes = frozenset(config['COMPRESS_MIMETYPES'])
+        self.ttl = config['CACHE_TTL']
+        # preference order breaks ties between equal Accept-Encoding q values
+        self.encoders = [
+            ENCODERS[name](config['COMPRESS_LEVELS'][name])
+            for name in config['COMPRESS_ALGORITHMS'] if name in ENCODERS]
+        self.store = MemoryBackend(config['COMPRESS_CACHE_MAX_BYTES'])
+
+    def negotiate(self):
+        names = [encoder.name for encoder in self.encoders]
+        best = request.accept_encodings.best_match(names)
+        return next((encoder for encoder in self.encoders
+                     if encoder.name == best), None)
+
+    def compressible(self, response):
+        return response.mimetype in self.mimetypes and \
+            200 <= response.status_code < 300 and \
+            response.status_code != 204 and \
+            'Content-Encoding' not in response.headers and \
+            not response.direct_passthrough
+
+    def __call__(self, response):
+        if response.status_code == 304:
+            response.vary.add('Accept-Encoding')
+        if not self.compressible(response):
+            return response
+        response.vary.add('Accept-Encoding')
+
+        encoder = self.negotiate()
+        if encoder is None:
+            return response
+
+        if response.is_streamed:
+            response.response = compress_stream(response.response,
+                                                encoder.compressor())
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < self.min_size:
+                return response
+            response.set_data(self.compress(encoder, data,
+                                            response.get_etag()[0]))
+
+        response.headers['Content-Encoding'] = encoder.name
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            # the compressed bytes differ, so the tag can only be weak
+            response.set_etag(etag, weak=True)
+        return response
+
+    def compress(self, encoder, data, etag):
+        if not etag:
+            return encoder.compress(data)
+        # a tag is only unique per URL, so the URL is part of the key
+        key = '{}:{}:{}:{}'.format(encoder.name, request.full_path, etag,
+                                   len(data))
+        compressed = self.store.get(key)
+        if compressed is None:
+            compressed = encoder.compress(data)
+            self.store.set(key, compressed, self.ttl)
+        return compressed
+
+
+def init_compression(app):
+    """Compresses the responses of `app`; call it before any other
+    after_request hook is registered, so compression runs last
+    """
+    if not app.config['COMPRESS_ENABLED']:
+        return
+    compressor = Compressor(app)
+    app.extensions['compressor'] = compressor
+    app.after_request(compressor)
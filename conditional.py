@@ -0,0 +1,108 @@
+import hashlib
+from functools import wraps
+from flask import abort, request, make_response
+from models import db, get_versions, resolve_tables
+
+'''
+Conditional GETs
+    list responses carry an ETag derived from the version of the tables
+    they read, so an unchanged table is answered with 304 Not Modified
+    without loading a single row. If-None-Match uses the weak comparison,
+    as compressed responses carry the tag as W/"..."
+
+    A single movie or actor is tagged with its row version and a digest of
+    its path (so rows at the same version never share a tag), which PATCH
+    and DELETE take back in If-Match to refuse a lost update with 412
+'''
+
+
+def table_etag(*tables):
+    """Builds the ETag for the current URL from the tables' versions
+    """
+    current = get_versions(*tables)
+    versions = ':'.join('{}={}'.format(table, current.get(table, 0))
+                        for table in tables)
+    digest = hashlib.sha1(
+        (request.full_path + '|' + versions).encode('utf-8')).hexdigest()
+    return digest[:32]
+
+
+def row_etag(version, path=None):
+    """The ETag of version `version` of the row at `path`, the request's
+    by default
+    """
+    path = request.path if path is None else path
+    digest = hashlib.sha1(
+        '{}|{}'.format(path, version).encode('utf-8')).hexdigest()
+    return '{}-{}'.format(version, digest[:16])
+
+
+def conditional(*tables):
+    """Answers If-None-Match with 304 while `tables` are unchanged
+
+    Goes below @requires_auth, so a 304 is only ever sent to a caller that
+    is allowed to read the resource. `tables` may be a single callable,
+    returning the tables of the current request.
+    """
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            return _not_modified_or(f, table_etag(*resolve_tables(tables)),
+                                    args, kwargs)
+
+        return wrapper
+    return conditional_decorator
+
+
+def _not_modified_or(f, etag, args, kwargs):
+    if request.if_none_match.contains_weak(etag):
+        response = make_response('', 304)
+    else:
+        response = make_response(f(*args, **kwargs))
+        if response.status_code != 200:
+            return response
+    response.set_etag(etag)
+    return response
+
+
+def row_conditional(model, arg):
+    """Tags the row named by the `arg` route argument with its version and
+    answers If-None-Match with 304 while it is unchanged
+    """
+    def row_conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            version = db.session.query(model.version) \
+                .filter(model.id == kwargs[arg]).scalar()
+            if version is None:
+                return f(*args, **kwargs)
+            return _not_modified_or(f, row_etag(version), args, kwargs)
+
+        return wrapper
+    return row_conditional_decorator
+
+
+def if_match_versions():
+    """Row versions listed in If-Match, or None when any version will do
+    """
+    if_match = request.if_match
+    if not if_match or if_match.star_tag:
+        return None
+    # compression weakens tags in transit, so a weak tag still names its
+    # version; a tag minted for another row names none
+    versions = []
+    for tag in if_match.as_set(include_weak=True):
+        version = tag.split('-', 1)[0]
+        if version.isdigit() and tag == row_etag(int(version)):
+            versions.append(int(version))
+    return versions
+
+
+def abort_missing(model, id, versions):
+    """404 for a row that does not exist, 412 for one whose version did
+    not match If-Match
+    """
+    if versions is not None and db.session.query(model.id) \
+            .filter(model.id == id).first() is not None:
+        abort(412)
+    abort(404)
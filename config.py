@@ -8,4 +8,148 @@ DEBUG = True
 
 # Connect to the database
 SQLALCHEMY_TRACK_MODIFICATIONS = False
-SQLALCHEMY_DATABASE_URI = 'postgresql://postgres:1@localhost:5432/heroku'
+SQLALCHEMY_DATABASE_URI = os.environ.get(
+    'DATABASE_URL', 'postgresql://postgres:1@localhost:5432/heroku')
+
+# Engine/pool profile, picked with DB_PROFILE. Timeouts are in milliseconds
+# and applied per connection on Postgres; 0 disables one. DB_POOL_SIZE and
+# DB_MAX_OVERFLOW override the profile's pool sizing.
+DB_PROFILE = os.environ.get('DB_PROFILE', 'web')
+ENGINE_PROFILES = {
+    # gunicorn workers: small pool, fail fast rather than queue
+    'web': {
+        'pool_size': 5,
+        'max_overflow': 5,
+        'pool_timeout': 5,
+        'pool_recycle': 1800,
+        'pool_pre_ping': True,
+        'statement_timeout': 5000,
+        'lock_timeout': 2000
+    },
+    # manage.py commands and nightly jobs: few long-running connections
+    'batch': {
+        'pool_size': 2,
+        'max_overflow': 0,
+        'pool_timeout': 60,
+        'pool_recycle': 3600,
+        'pool_pre_ping': True,
+        'statement_timeout': 0,
+        'lock_timeout': 30000
+    },
+    # test suite: one connection, surface hangs quickly
+    'test': {
+        'pool_size': 1,
+        'max_overflow': 2,
+        'pool_timeout': 10,
+        'pool_recycle': -1,
+        'pool_pre_ping': False,
+        'statement_timeout': 10000,
+        'lock_timeout': 5000
+    }
+}
+
+# List endpoints: page size used when only a cursor is sent, and the hard
+# cap applied to any requested limit
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+# Rows fetched per round-trip by the streaming (?stream=true) list mode
+STREAM_CHUNK_SIZE = 1000
+
+# Largest array accepted by POST /movies/bulk and POST /actors/bulk
+MAX_BULK_SIZE = 1000
+
+# Shared response cache for the GET routes, on by default when REDIS_URL
+# is set. CACHE=1 turns it on without Redis, as an in-process LRU bounded
+# to CACHE_MAX_BYTES per worker: a write only invalidates the cache of the
+# worker that made it, so with several workers the others can serve stale
+# responses for up to CACHE_TTL seconds. Only use it with one worker.
+CACHE_REDIS_URL = os.environ.get('REDIS_URL')
+CACHE_ENABLED = bool(CACHE_REDIS_URL) or os.environ.get('CACHE') == '1'
+CACHE_TTL = 60
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Read replica for GET routes. A subject that writes reads from the primary
+# for REPLICA_STICKY_SECONDS; replica health and lag are checked at most
+# every REPLICA_CHECK_INTERVAL seconds. The pins live in Redis at
+# REPLICA_PIN_REDIS_URL, whether or not the response cache is on; without
+# it each worker keeps its own, and a writer's next read may land on a
+# worker that never saw the write, so only run one worker that way.
+REPLICA_DATABASE_URL = os.environ.get('REPLICA_DATABASE_URL')
+REPLICA_PIN_REDIS_URL = os.environ.get('REPLICA_PIN_REDIS_URL',
+                                       os.environ.get('REDIS_URL'))
+REPLICA_STICKY_SECONDS = 5
+REPLICA_MAX_LAG_SECONDS = 10
+REPLICA_CHECK_INTERVAL = 5
+
+# A replica read may predate the write that started the current cache
+# generation, so the response cache keeps it for REPLICA_CACHE_TTL seconds
+# rather than CACHE_TTL: other subjects can see a response that old, on top
+# of the replica's own lag
+REPLICA_CACHE_TTL = 2
+
+# Prometheus metrics on /metrics; set prometheus_multiproc_dir under
+# gunicorn so every worker is counted
+METRICS_ENABLED = True
+
+# Request SQL recorder: statements slower than SQL_SLOW_QUERY_MS are logged
+# with their plan, one repeated SQL_REPEAT_THRESHOLD times in a request is
+# reported as a probable N+1, and @query_budget overruns are logged (raised
+# when TESTING)
+SQL_RECORDER_ENABLED = True
+SQL_SLOW_QUERY_MS = 200
+SQL_REPEAT_THRESHOLD = 5
+
+# JSON encoder for the read routes: auto uses orjson when it is installed,
+# orjson requires it, stdlib always uses Flask's encoder
+JSON_PROVIDER = os.environ.get('JSON_PROVIDER', 'auto')
+
+# Response compression negotiated from Accept-Encoding. br and zstd are only
+# offered when the brotli / zstandard packages are installed; the order of
+# COMPRESS_ALGORITHMS breaks ties between equally weighted encodings.
+# Compressed bodies of ETag'd responses are kept in a per-worker LRU.
+COMPRESS_ENABLED = True
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_ALGORITHMS = ['br', 'zstd', 'gzip']
+COMPRESS_LEVELS = {'gzip': 6, 'br': 4, 'zstd': 3}
+COMPRESS_MIMETYPES = ['application/json', 'text/plain', 'text/html']
+COMPRESS_CACHE_MAX_BYTES = 16 * 1024 * 1024
+
+# Group commit: single-row writes from concurrent requests in one worker
+# share a transaction, committed GROUP_COMMIT_WINDOW_MS after the first one
+# queues or as soon as GROUP_COMMIT_MAX_SIZE have. Only pays off with
+# threaded or gevent workers; a sync worker serves one write at a time.
+# Every write to a table also updates that table's TableVersion row, so
+# writers to the same table serialize on its row lock from the bump to the
+# commit; a group bumps each table once, right before committing.
+GROUP_COMMIT_ENABLED = os.environ.get('GROUP_COMMIT') == '1'
+GROUP_COMMIT_WINDOW_MS = 2
+GROUP_COMMIT_MAX_SIZE = 64
+
+# Idempotency-Key on POST /movies/add and /actors/add: the first response
+# for a key is kept IDEMPOTENCY_TTL seconds, in Redis at
+# IDEMPOTENCY_REDIS_URL (shared by the workers; the server must not evict
+# keys for memory) or otherwise in each worker's memory, apart from the
+# response cache so GET traffic never evicts it. Duplicates wait up to
+# IDEMPOTENCY_WAIT_SECONDS for the one in flight, whose claim lapses after
+# IDEMPOTENCY_LOCK_TTL seconds if its worker dies.
+IDEMPOTENCY_REDIS_URL = os.environ.get('IDEMPOTENCY_REDIS_URL',
+                                       os.environ.get('REDIS_URL'))
+IDEMPOTENCY_TTL = 24 * 60 * 60
+IDEMPOTENCY_LOCK_TTL = 30
+IDEMPOTENCY_WAIT_SECONDS = 10
+
+# Admission control (ADMISSION_CONTROL=1): each worker runs at most
+# ADMISSION_MAX_CONCURRENT requests at once, its pool size plus overflow
+# when None, and answers the rest with 503. A token bucket per subject and
+# class (read for get:* permissions, write otherwise) refills at
+# ADMISSION_RATES requests per second up to ADMISSION_BURSTS; past it the
+# answer is 429. Buckets are shared through Redis when ADMISSION_REDIS_URL
+# is set. Retry-After on a 503 is ADMISSION_RETRY_AFTER seconds.
+ADMISSION_ENABLED = os.environ.get('ADMISSION_CONTROL') == '1'
+ADMISSION_MAX_CONCURRENT = None
+ADMISSION_RATES = {'read': 20, 'write': 5}
+ADMISSION_BURSTS = {'read': 40, 'write': 10}
+ADMISSION_REDIS_URL = os.environ.get('ADMISSION_REDIS_URL')
+ADMISSION_RETRY_AFTER = 1
+ADMISSION_EXEMPT_ENDPOINTS = ['health', 'metrics']
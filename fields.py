@@ -0,0 +1,73 @@
+from flask import request, abort
+from models import db
+
+'''
+Sparse fieldsets
+    ?fields=id,title selects just those columns in SQL. Reads serialize
+    plain row tuples either way, skipping ORM instances and the identity
+    map; a full row serializes to the same keys as the model's format().
+    The row version is only part of a full row on the item routes, which
+    also send it as the ETag
+'''
+
+
+def requested_fields(model):
+    """Returns the column names listed in ?fields=, or None for all of them
+
+    Unknown or empty field lists are rejected with 422.
+    """
+    fields = request.args.get('fields')
+    if fields is None:
+        return None
+
+    names = [name.strip() for name in fields.split(',') if name.strip()]
+    columns = model.__table__.columns
+    if not names or any(name not in columns for name in names):
+        abort(422)
+    return list(dict.fromkeys(names))
+
+
+def requested_includes(*allowed):
+    """Returns the related collections listed in ?include=
+
+    Names outside `allowed`, or an empty list, are rejected with 422.
+    """
+    include = request.args.get('include')
+    if include is None:
+        return set()
+
+    names = {name.strip() for name in include.split(',') if name.strip()}
+    if not names or not names.issubset(allowed):
+        abort(422)
+    return names
+
+
+def select_columns(model, names=None, version=False):
+    """A query over the model's columns as plain tuples; without `names`,
+    every column but the row version unless `version` is set
+    """
+    table = model.__table__
+    if names is None:
+        names = [name for name in table.columns.keys()
+                 if version or name != 'version']
+    return db.session.query(*[table.columns[name] for name in names])
+
+
+def select_fields(model, fields, keys=('id',), version=False):
+    """Returns (query, serialize) for the requested fields
+
+    Without a field list every column is selected, the row version only
+    with `version`. Otherwise only the listed columns are, plus `keys` so
+    callers can still order and paginate on them, and serialize() drops
+    them again.
+    """
+    if fields is None:
+        return select_columns(model, version=version), \
+            lambda row: row._asdict()
+
+    names = list(dict.fromkeys(fields + list(keys)))
+
+    def serialize(row):
+        return {name: getattr(row, name) for name in fields}
+
+    return select_columns(model, names), serialize
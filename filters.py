@@ -0,0 +1,149 @@
+from flask import request, abort
+from sqlalchemy import String, and_, func, tuple_
+from models import db, Movie, Actor
+
+'''
+Filtering and sorting
+    The list routes narrow their rows with query-string filters, run as
+    WHERE clauses on indexed columns: exact matches on Movie.category and
+    Actor.gender, an Actor.age range and case-insensitive title/name
+    prefixes on the lower(...) indexes. ?sort= orders by a whitelisted
+    NOT NULL column (prefix - for descending), ties broken by id, so the
+    sort position always makes a keyset for pagination.
+'''
+
+
+def _equal(column):
+    return lambda value: column == value
+
+
+def _age_bound(compare):
+    def criterion(value):
+        try:
+            value = int(value)
+        except ValueError:
+            abort(422)
+        return compare(Actor.age, value)
+    return criterion
+
+
+def _prefix(column):
+    def criterion(value):
+        if not value:
+            abort(422)
+        return prefix_match(column, value)
+    return criterion
+
+
+FILTERS = {
+    Movie: {
+        'category': _equal(Movie.category),
+        'title_prefix': _prefix(Movie.title)
+    },
+    Actor: {
+        'gender': _equal(Actor.gender),
+        'min_age': _age_bound(lambda column, value: column >= value),
+        'max_age': _age_bound(lambda column, value: column <= value),
+        'name_prefix': _prefix(Actor.name)
+    }
+}
+
+SORT_KEYS = {
+    Movie: ('id', 'title'),
+    Actor: ('id', 'name')
+}
+
+
+def prefix_match(column, prefix):
+    """lower(column) starts with `prefix`, in a form the lower(column)
+    index can serve
+    """
+    prefix = prefix.lower()
+    lowered = func.lower(column)
+    if db.session.get_bind().dialect.name == 'postgresql':
+        # the Postgres index uses text_pattern_ops, which serves LIKE
+        escaped = prefix.replace('\\', '\\\\').replace('%', '\\%') \
+            .replace('_', '\\_')
+        return lowered.like(escaped + '%', escape='\\')
+    # every string starting with the prefix sorts between it and the
+    # prefix with its last character bumped
+    upper = prefix.rstrip(chr(0x10ffff))
+    if not upper:
+        return lowered >= prefix
+    upper = upper[:-1] + chr(ord(upper[-1]) + 1)
+    return and_(lowered >= prefix, lowered < upper)
+
+
+def requested_filters(model):
+    """Returns the WHERE criteria for the filters in the query string
+
+    A filter given an empty or malformed value is rejected with 422.
+    """
+    return [criterion(request.args[name])
+            for name, criterion in FILTERS[model].items()
+            if name in request.args]
+
+
+class Sort:
+    """An ORDER BY on one column of `model` and id; text columns sort
+    case-insensitively, on their lower(...) index
+    """
+
+    def __init__(self, model, name='id', descending=False):
+        self.id = model.__table__.c.id
+        self.column = model.__table__.c[name]
+        self.descending = descending
+        self.fold_case = isinstance(self.column.type, String)
+
+    @property
+    def names(self):
+        """Columns a row needs for position()
+        """
+        return list(dict.fromkeys([self.column.key, self.id.key]))
+
+    def key(self, value):
+        return func.lower(value) if self.fold_case else value
+
+    def order_by(self):
+        columns = [self.key(self.column)]
+        if self.column is not self.id:
+            columns.append(self.id)
+        return [column.desc() if self.descending else column
+                for column in columns]
+
+    def position(self, row):
+        return {name: getattr(row, name) for name in self.names}
+
+    def after(self, position):
+        """Criterion for the rows that follow `position` in this order;
+        422 when it does not come from position()
+        """
+        last_id = position.get(self.id.key)
+        if not isinstance(last_id, int):
+            abort(422)
+        if self.column is self.id:
+            return self.id < last_id if self.descending else self.id > last_id
+
+        value = position.get(self.column.key)
+        if not isinstance(value, str):
+            abort(422)
+        key, last = self.key(self.column), self.key(value)
+        # the plain bound lets SQLite seek the index; the row value breaks
+        # ties on id
+        if self.descending:
+            return and_(key <= last,
+                        tuple_(key, self.id) < tuple_(last, last_id))
+        return and_(key >= last, tuple_(key, self.id) > tuple_(last, last_id))
+
+
+def requested_sort(model):
+    """Returns the Sort for ?sort=, by id when absent
+
+    Keys outside SORT_KEYS are rejected with 422.
+    """
+    sort = request.args.get('sort', 'id')
+    descending = sort.startswith('-')
+    name = sort[1:] if descending else sort
+    if name not in SORT_KEYS[model]:
+        abort(422)
+    return Sort(model, name, descending)
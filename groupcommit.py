@@ -0,0 +1,124 @@
+import threading
+from models import db, bump_version
+
+'''
+Group commit
+    Single-row writes (models.run_write) from concurrent requests in one
+    worker are queued and committed together: the first write to
+    arrive leads a group, waits up to GROUP_COMMIT_WINDOW_MS for others (or
+    until GROUP_COMMIT_MAX_SIZE have queued) and commits them all in one
+    transaction on its own session. Each write is flushed inside its own
+    SAVEPOINT, so a row that fails only fails its own request. The group's
+    statements are left out of the leader's query budget.
+'''
+
+
+class Write:
+    """One queued apply(session) call and its outcome
+    """
+
+    def __init__(self, apply, tables):
+        self.apply = apply
+        self.tables = tables
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class Group:
+
+    def __init__(self):
+        self.writes = []
+        self.full = threading.Event()
+
+
+class GroupCommitter:
+
+    def __init__(self, window_ms, max_size):
+        self.window = window_ms / 1000.0
+        self.max_size = max_size
+        self.groups = 0
+        self.writes = 0
+        self._open = None
+        self._lock = threading.Lock()
+
+    def submit(self, apply, tables):
+        """Queues apply(session) and returns its result once the group has
+        committed, or raises the error that failed it
+        """
+        write = Write(apply, tables)
+        with self._lock:
+            group = self._open
+            leader = group is None
+            if leader:
+                group = self._open = Group()
+            group.writes.append(write)
+            if len(group.writes) >= self.max_size:
+                self._open = None
+                group.full.set()
+
+        if leader:
+            group.full.wait(self.window)
+            with self._lock:
+                if self._open is group:
+                    self._open = None
+            self.commit(group.writes)
+
+        write.done.wait()
+        if write.error is not None:
+            raise write.error
+        return write.result
+
+    def commit(self, writes):
+        session = db.session.session_factory(expire_on_commit=False)
+        try:
+            connection = session.connection(
+                execution_options={'query_recorder': False})
+            if connection.dialect.name == 'sqlite':
+                # the driver only opens a transaction at the first write
+                # statement, and would commit at the first RELEASE SAVEPOINT
+                connection.execute('BEGIN')
+            applied = []
+            for write in writes:
+                try:
+                    with session.begin_nested():
+                        write.result = write.apply(session)
+                    if write.result is not None:
+                        applied.append(write)
+                except Exception as error:
+                    write.error = error
+            if applied:
+                # bumped last, once per table for the whole group, so each
+                # TableVersion row is only locked for the commit itself
+                bump_version(*sorted(set().union(
+                    *(write.tables for write in applied))), session=session)
+                session.commit()
+            else:
+                session.rollback()
+        except Exception as error:
+            session.rollback()
+            for write in writes:
+                write.error = write.error or error
+        finally:
+            session.expunge_all()
+            session.close()
+            with self._lock:
+                self.groups += 1
+                self.writes += len(writes)
+            for write in writes:
+                write.done.set()
+
+    def stats(self):
+        return {
+            'groups': self.groups,
+            'writes': self.writes,
+            'mean_group_size': self.writes / self.groups if self.groups
+            else 0.0
+        }
+
+
+def init_group_commit(app):
+    if app.config['GROUP_COMMIT_ENABLED']:
+        app.extensions['group_commit'] = GroupCommitter(
+            app.config['GROUP_COMMIT_WINDOW_MS'],
+            app.config['GROUP_COMMIT_MAX_SIZE'])
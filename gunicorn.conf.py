@@ -0,0 +1,111 @@
+import multiprocessing
+import os
+import tempfile
+import time
+
+'''
+gunicorn settings
+    gunicorn -c gunicorn.conf.py app:app
+
+GUNICORN_WORKER_CLASS picks sync (default), gthread or gevent; worker and
+thread counts follow the CPUs available to the process unless
+WEB_CONCURRENCY / GUNICORN_THREADS say otherwise. The app is preloaded in
+the master (except under gevent, which has to patch before the app is
+imported) and each worker opens its pool connections and fetches the auth
+key set before it accepts traffic.
+'''
+
+WORKER_CLASSES = ('sync', 'gthread', 'gevent')
+
+
+def cpu_count():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return multiprocessing.cpu_count()
+
+
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'sync')
+if worker_class not in WORKER_CLASSES:
+    raise ValueError('GUNICORN_WORKER_CLASS must be one of {}, not {!r}'
+                     .format(', '.join(WORKER_CLASSES), worker_class))
+
+# sync workers handle one request each, so oversubscribe the CPUs; threads
+# and greenlets spend their waits on the database inside one worker
+if worker_class == 'sync':
+    default_workers = 2 * cpu_count() + 1
+elif worker_class == 'gthread':
+    default_workers = cpu_count() + 1
+else:
+    default_workers = cpu_count()
+workers = int(os.environ.get('WEB_CONCURRENCY', default_workers))
+threads = int(os.environ.get(
+    'GUNICORN_THREADS', 4 if worker_class == 'gthread' else 1))
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 100))
+
+# one pooled connection per thread; engine_options reads DB_POOL_SIZE when
+# the app is loaded, which happens after this file runs
+if worker_class == 'gthread':
+    os.environ.setdefault('DB_POOL_SIZE', str(threads))
+
+bind = '0.0.0.0:' + os.environ.get('PORT', '8000')
+preload_app = os.environ.get(
+    'GUNICORN_PRELOAD', '0' if worker_class == 'gevent' else '1') == '1'
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = 30
+keepalive = 5
+
+# recycle workers after a jittered number of requests so slow memory growth
+# never builds up, and they don't all restart at the same moment
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 2000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER',
+                                         max_requests // 10))
+
+if os.path.isdir('/dev/shm'):
+    worker_tmp_dir = '/dev/shm'
+
+# metrics.py aggregates across workers through this directory; it has to be
+# set before prometheus_client is imported by the preloaded app
+if 'prometheus_multiproc_dir' not in os.environ:
+    os.environ['prometheus_multiproc_dir'] = tempfile.mkdtemp(
+        prefix='prometheus-')
+from prometheus_client import multiprocess  # noqa: E402
+
+warm_up = os.environ.get('GUNICORN_WARM_UP', '1') == '1'
+
+
+def post_worker_init(worker):
+    """Opens pool connections and primes the JWKS cache before the worker
+    takes its first request
+    """
+    if worker_class == 'gevent':
+        try:
+            from psycogreen.gevent import patch_psycopg
+            patch_psycopg()
+        except ImportError:
+            worker.log.warning('psycogreen is not installed; database '
+                               'calls will block the gevent worker')
+    if not warm_up:
+        return
+
+    import auth
+    from models import warm_pools
+
+    started = time.perf_counter()
+    try:
+        warm_pools(worker.wsgi, threads if worker_class != 'gevent'
+                   else worker_connections)
+    except Exception:
+        worker.log.exception('Unable to open pool connections')
+    try:
+        auth.key_store.refresh()
+    except Exception:
+        worker.log.exception('Unable to prime the JWKS key store')
+    worker.log.info('Worker %s warmed up in %.0f ms', worker.pid,
+                    (time.perf_counter() - started) * 1000)
+
+
+def child_exit(server, worker):
+    """Drops the live gauges of a worker that exited
+    """
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,168 @@
+import hashlib
+import json
+import threading
+import time
+from functools import wraps
+from flask import abort, current_app, request, make_response
+from cache import RedisBackend, dump_response, load_response
+
+'''
+Idempotency keys
+    A create route under @idempotent runs once per Idempotency-Key header
+    and caller. The first request claims the key in the response cache's
+    backend (Redis when REDIS_URL is set, so the claim holds across
+    workers) and its response is kept for IDEMPOTENCY_TTL seconds; a retry
+    replays it, and a duplicate that arrives while the first is still
+    running waits for its response instead of running again. Reusing a
+    key with a different body is rejected with 422. A request that raises
+    releases its key, so it can be retried.
+
+    Keys live in their own store, never the response cache, whose LRU
+    would evict them to make room for GET responses: Redis at
+    IDEMPOTENCY_REDIS_URL (REDIS_URL by default), which shares them
+    between workers, or else a dict in each worker that only drops a key
+    once its TTL has run out.
+'''
+
+MAX_KEY_LENGTH = 255
+REPLAYED_HEADER = 'Idempotent-Replayed'
+
+
+class MemoryStore:
+    """Keys held in this worker until they expire; never evicted for space
+    """
+
+    PRUNE_INTERVAL = 60
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+        self._pruned_at = time.monotonic()
+
+    def get(self, key):
+        with self._lock:
+            item = self._values.get(key)
+            if item is None:
+                return None
+            if item[0] <= time.monotonic():
+                del self._values[key]
+                return None
+            return item[1]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._set(key, value, ttl)
+
+    def add(self, key, value, ttl):
+        """Stores `value` unless `key` holds a live one; True if stored
+        """
+        with self._lock:
+            item = self._values.get(key)
+            if item is not None and item[0] > time.monotonic():
+                return False
+            self._set(key, value, ttl)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._values.pop(key, None)
+
+    def _set(self, key, value, ttl):
+        now = time.monotonic()
+        if now - self._pruned_at >= self.PRUNE_INTERVAL:
+            self._pruned_at = now
+            self._values = {name: item for name, item in self._values.items()
+                            if item[0] > now}
+        self._values[key] = (now + ttl, value)
+
+
+def init_idempotency(app):
+    """Builds the store for idempotency keys from the app config
+    """
+    url = app.config.get('IDEMPOTENCY_REDIS_URL')
+    if url:
+        import redis
+        store = RedisBackend(redis.StrictRedis.from_url(url),
+                             prefix='casting:idempotency:')
+    else:
+        store = MemoryStore()
+    app.extensions['idempotency'] = store
+
+
+def fingerprint():
+    """Digest of the method, path and body of the current request; JSON
+    bodies are compared by value, not by layout
+    """
+    body = request.get_json(silent=True)
+    body = json.dumps(body, sort_keys=True) if body is not None else \
+        request.get_data(as_text=True)
+    return hashlib.sha256(json.dumps(
+        [request.method, request.path, body]).encode('utf-8')) \
+        .hexdigest().encode('ascii')
+
+
+def storage_key(subject, key):
+    digest = hashlib.sha1(json.dumps(
+        [request.endpoint, subject, key]).encode('utf-8')).hexdigest()
+    return 'idempotency:' + digest
+
+
+def wait_for(backend, key, digest, timeout):
+    """Polls until the request holding `key` stores its response; returns
+    the stored value, or None once the key is released
+    """
+    deadline = time.monotonic() + timeout
+    delay = 0.005
+    while True:
+        value = backend.get(key)
+        if value is None:
+            return None
+        stored_digest, stored = value.split(b'\n', 1)
+        if stored_digest != digest:
+            abort(422)
+        if stored:
+            return stored
+        if time.monotonic() >= deadline:
+            abort(409)
+        time.sleep(delay)
+        delay = min(delay * 2, 0.1)
+
+
+def idempotent(f):
+    """Runs the route once per Idempotency-Key; goes below @requires_auth
+    """
+    @wraps(f)
+    def wrapper(payload, *args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if key is None:
+            return f(payload, *args, **kwargs)
+        if not key or len(key) > MAX_KEY_LENGTH:
+            abort(422)
+
+        config = current_app.config
+        backend = current_app.extensions['idempotency']
+        key = storage_key(payload.get('sub'), key)
+        digest = fingerprint()
+
+        while not backend.add(key, digest + b'\n',
+                              config['IDEMPOTENCY_LOCK_TTL']):
+            stored = wait_for(backend, key, digest,
+                              config['IDEMPOTENCY_WAIT_SECONDS'])
+            if stored is not None:
+                response = load_response(stored)
+                response.headers[REPLAYED_HEADER] = 'true'
+                return response
+
+        try:
+            response = make_response(f(payload, *args, **kwargs))
+        except Exception:
+            backend.delete(key)
+            raise
+        if response.status_code >= 500 or response.is_streamed:
+            backend.delete(key)
+        else:
+            backend.set(key, digest + b'\n' + dump_response(response),
+                        config['IDEMPOTENCY_TTL'])
+        return response
+
+    return wrapper
@@ -3,6 +3,7 @@ from flask_migrate import Migrate, MigrateCommand
 
 from app import app
 from models import db, Movie, Actor
+from stats import rebuild_stats
 
 migrate = Migrate(app, db)
 manager = Manager(app)
@@ -10,5 +11,11 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
+@manager.command
+def rebuild_catalog_stats():
+    """Recounts the GET /stats summary from the Movie and Actor tables"""
+    rebuild_stats()
+
+
 if __name__ == '__main__':
     manager.run()
\ No newline at end of file
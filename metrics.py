@@ -0,0 +1,176 @@
+import os
+import time
+from flask import g, request, Response
+from prometheus_client import (CollectorRegistry, Counter, Gauge, Histogram,
+                               REGISTRY, CONTENT_TYPE_LATEST, generate_latest,
+                               multiprocess)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool
+from queries import query_budget
+
+'''
+Prometheus metrics
+    Request latency and response size per route, time spent authenticating,
+    SQL statement timings and connection pool usage, served on /metrics.
+    Labels only ever hold route endpoints, HTTP methods and status codes,
+    SQL verbs, auth stages and cache results, so their cardinality stays
+    bounded.
+
+    Under gunicorn, prometheus_multiproc_dir points at a directory shared
+    by the workers (gunicorn.conf.py sets one up) and /metrics sums the
+    figures of every worker.
+'''
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0,
+                   2.5, 5.0, 10.0)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+METHODS = frozenset(['GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE',
+                     'OPTIONS'])
+SQL_OPERATIONS = frozenset(['select', 'insert', 'update', 'delete', 'with'])
+
+REQUEST_SECONDS = Histogram(
+    'http_request_duration_seconds',
+    'Time to produce a response, by route and status',
+    ['endpoint', 'method', 'status'], buckets=LATENCY_BUCKETS)
+RESPONSE_BYTES = Histogram(
+    'http_response_size_bytes',
+    'Size of non-streamed response bodies, by route',
+    ['endpoint'], buckets=SIZE_BUCKETS)
+AUTH_SECONDS = Histogram(
+    'auth_duration_seconds',
+    'Time spent verifying bearer tokens: "jwks" is the key lookup '
+    '(including any fetch), "decode" the signature and claims checks',
+    ['stage'], buckets=LATENCY_BUCKETS)
+AUTH_TOKEN_CACHE = Counter(
+    'auth_token_cache_total',
+    'Verified token cache lookups by result',
+    ['result'])
+SQL_SECONDS = Histogram(
+    'db_statement_duration_seconds',
+    'SQL statement execution time by verb',
+    ['operation'], buckets=LATENCY_BUCKETS)
+ADMISSION_REJECTED = Counter(
+    'http_requests_rejected_total',
+    'Requests turned away by admission control: "concurrency" past the '
+    'in-flight cap (503), "rate" past a subject\'s token bucket (429)',
+    ['reason'])
+CACHE_REQUESTS = Counter(
+    'cache_requests_total',
+    'Response cache lookups by result ("hit" or "miss")',
+    ['result'])
+CACHE_BYTES_SAVED = Counter(
+    'cache_bytes_saved_total',
+    'Response body bytes served from the response cache instead of '
+    'being rendered')
+POOL_CHECKED_OUT = Gauge(
+    'db_pool_checked_out_connections',
+    'Connections currently checked out of the pool',
+    multiprocess_mode='livesum')
+POOL_WAIT_SECONDS = Histogram(
+    'db_pool_wait_seconds',
+    'Time spent waiting for a pooled connection',
+    buckets=LATENCY_BUCKETS)
+
+
+def route_labels():
+    endpoint = request.url_rule.endpoint if request.url_rule else 'unmatched'
+    method = request.method if request.method in METHODS else 'other'
+    return endpoint, method
+
+
+def sql_operation(statement):
+    operation = statement.lstrip()[:6].lower()
+    return operation if operation in SQL_OPERATIONS else 'other'
+
+
+def render():
+    """Exposition text for this process, or for every worker in
+    multiprocess mode
+    """
+    if 'prometheus_multiproc_dir' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry)
+
+
+# ----------------------------------------------------------------------------#
+# Engine and pool events.
+# ----------------------------------------------------------------------------#
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('metrics_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    started = conn.info['metrics_started'].pop()
+    SQL_SECONDS.labels(sql_operation(statement)).observe(
+        time.perf_counter() - started)
+
+
+def _handle_error(context):
+    started = context.connection.info.get('metrics_started')
+    if started:
+        started.pop()
+
+
+def _checkout(dbapi_connection, connection_record, connection_proxy):
+    POOL_CHECKED_OUT.inc()
+    # set by models.TimedQueuePool when the connection came out of its queue
+    waited = connection_record.info.pop('checkout_wait', None)
+    if waited is not None:
+        POOL_WAIT_SECONDS.observe(waited)
+
+
+def _checkin(dbapi_connection, connection_record):
+    POOL_CHECKED_OUT.dec()
+
+
+LISTENERS = [
+    (Engine, 'before_cursor_execute', _before_cursor_execute),
+    (Engine, 'after_cursor_execute', _after_cursor_execute),
+    (Engine, 'handle_error', _handle_error),
+    (Pool, 'checkout', _checkout),
+    (Pool, 'checkin', _checkin)
+]
+
+
+def init_metrics(app):
+    """Times every request of `app` and adds the /metrics route
+    """
+    if not app.config['METRICS_ENABLED']:
+        return
+
+    for target, name, listener in LISTENERS:
+        if not event.contains(target, name, listener):
+            event.listen(target, name, listener)
+
+    @app.before_request
+    def start_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def observe_request(response):
+        started = g.pop('metrics_started', None)
+        if started is None:
+            return response
+        endpoint, method = route_labels()
+        REQUEST_SECONDS.labels(endpoint, method, response.status_code) \
+            .observe(time.perf_counter() - started)
+        if not response.is_streamed:
+            RESPONSE_BYTES.labels(endpoint).observe(
+                response.calculate_content_length() or 0)
+        return response
+
+    @app.route('/metrics')
+    @query_budget(0)
+    def metrics():
+        """
+            Prometheus scrape endpoint
+        """
+
+        return Response(render(), content_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,38 @@
+"""index the list filters and sort keys
+
+Revision ID: 3d6a9e2f4b17
+Revises: 7b3e5f1a9c20
+Create Date: 2026-10-18 22:31:05.640718
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3d6a9e2f4b17'
+down_revision = '7b3e5f1a9c20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(op.f('ix_Movie_category'), 'Movie', ['category'],
+                    unique=False)
+    op.create_index(op.f('ix_Actor_gender'), 'Actor', ['gender'],
+                    unique=False)
+    op.create_index(op.f('ix_Actor_age'), 'Actor', ['age'], unique=False)
+    # text_pattern_ops lets LIKE 'prefix%' use the index whatever the
+    # database collation
+    op.create_index('ix_Movie_title_lower', 'Movie',
+                    [sa.text('lower(title) text_pattern_ops')])
+    op.create_index('ix_Actor_name_lower', 'Actor',
+                    [sa.text('lower(name) text_pattern_ops')])
+
+
+def downgrade():
+    op.drop_index('ix_Actor_name_lower', table_name='Actor')
+    op.drop_index('ix_Movie_title_lower', table_name='Movie')
+    op.drop_index(op.f('ix_Actor_age'), table_name='Actor')
+    op.drop_index(op.f('ix_Actor_gender'), table_name='Actor')
+    op.drop_index(op.f('ix_Movie_category'), table_name='Movie')
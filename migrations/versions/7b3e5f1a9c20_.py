@@ -0,0 +1,29 @@
+"""add row versions to Movie and Actor for If-Match
+
+Revision ID: 7b3e5f1a9c20
+Revises: e2d94b7a6c31
+Create Date: 2026-10-18 21:10:44.902316
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7b3e5f1a9c20'
+down_revision = 'e2d94b7a6c31'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # existing rows start at version 1, like new ones
+    op.add_column('Movie', sa.Column('version', sa.Integer(),
+                                     server_default='1', nullable=False))
+    op.add_column('Actor', sa.Column('version', sa.Integer(),
+                                     server_default='1', nullable=False))
+
+
+def downgrade():
+    op.drop_column('Actor', 'version')
+    op.drop_column('Movie', 'version')
@@ -0,0 +1,32 @@
+"""add table versions
+
+Revision ID: 9b1f3c2d7e4a
+Revises: 5e432a618505
+Create Date: 2026-10-18 09:12:40.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9b1f3c2d7e4a'
+down_revision = '5e432a618505'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    table_version = op.create_table('TableVersion',
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+    op.bulk_insert(table_version, [
+        {'name': 'Movie', 'version': 0},
+        {'name': 'Actor', 'version': 0}
+    ])
+
+
+def downgrade():
+    op.drop_table('TableVersion')
@@ -0,0 +1,87 @@
+"""add the CatalogStat summary and the triggers that maintain it
+
+Revision ID: a81c4d7e93f2
+Revises: 3d6a9e2f4b17
+Create Date: 2026-10-18 23:48:26.107394
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a81c4d7e93f2'
+down_revision = '3d6a9e2f4b17'
+branch_labels = None
+depends_on = None
+
+# CatalogStat kind, table, column
+STATS = [
+    ('movie_category', 'Movie', 'category'),
+    ('actor_gender', 'Actor', 'gender'),
+    ('actor_age', 'Actor', 'age')
+]
+
+
+def upgrade():
+    op.create_table('CatalogStat',
+    sa.Column('kind', sa.String(), nullable=False),
+    sa.Column('value', sa.String(), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('kind', 'value')
+    )
+    op.execute("""
+        CREATE OR REPLACE FUNCTION catalog_stat_count() RETURNS trigger AS $$
+        DECLARE
+            old_value text;
+            new_value text;
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                old_value := (to_jsonb(OLD) -> TG_ARGV[1])::text;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                new_value := (to_jsonb(NEW) -> TG_ARGV[1])::text;
+            END IF;
+            IF old_value IS NOT DISTINCT FROM new_value THEN
+                RETURN NULL;
+            END IF;
+            IF old_value IS NOT NULL THEN
+                UPDATE "CatalogStat" SET count = count - 1
+                WHERE kind = TG_ARGV[0] AND value = old_value;
+            END IF;
+            IF new_value IS NOT NULL THEN
+                INSERT INTO "CatalogStat" (kind, value, count)
+                VALUES (TG_ARGV[0], new_value, 1)
+                ON CONFLICT (kind, value)
+                DO UPDATE SET count = "CatalogStat".count + 1;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    # counting and creating the triggers under one lock means no write
+    # lands between the backfill and the first trigger
+    op.execute('LOCK TABLE "Movie", "Actor" IN SHARE MODE')
+    for kind, table, column in STATS:
+        op.execute(
+            'CREATE TRIGGER "{table}_{column}_stat" AFTER INSERT OR '
+            'UPDATE OF {column} OR DELETE ON "{table}" FOR EACH ROW '
+            "EXECUTE PROCEDURE catalog_stat_count('{kind}', '{column}')"
+            .format(kind=kind, table=table, column=column))
+        op.execute(
+            'INSERT INTO "CatalogStat" (kind, value, count) '
+            "SELECT '{kind}', coalesce(to_jsonb({column})::text, 'null'), "
+            'count(*) FROM "{table}" '
+            "GROUP BY coalesce(to_jsonb({column})::text, 'null')"
+            .format(kind=kind, table=table, column=column))
+    op.execute('INSERT INTO "TableVersion" (name, version) '
+               "VALUES ('CatalogStat', 0)")
+
+
+def downgrade():
+    op.execute('DELETE FROM "TableVersion" WHERE name = \'CatalogStat\'')
+    for kind, table, column in STATS:
+        op.execute('DROP TRIGGER "{table}_{column}_stat" ON "{table}"'
+                   .format(table=table, column=column))
+    op.execute('DROP FUNCTION catalog_stat_count()')
+    op.drop_table('CatalogStat')
@@ -0,0 +1,36 @@
+"""add movie full-text search vector
+
+Revision ID: c4e8a1f05b92
+Revises: 9b1f3c2d7e4a
+Create Date: 2026-10-18 10:03:17.552931
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4e8a1f05b92'
+down_revision = '9b1f3c2d7e4a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The vector is a stored generated column (Postgres 12+), so it is kept
+    # in sync by the database and never written by the application.
+    op.execute("""
+        ALTER TABLE "Movie" ADD COLUMN search_vector tsvector
+        GENERATED ALWAYS AS (
+            setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+            setweight(to_tsvector('english', coalesce(description, '')),
+                      'B') ||
+            setweight(to_tsvector('english', coalesce(category, '')), 'C')
+        ) STORED
+    """)
+    op.create_index('ix_Movie_search_vector', 'Movie', ['search_vector'],
+                    postgresql_using='gin')
+
+
+def downgrade():
+    op.drop_index('ix_Movie_search_vector', table_name='Movie')
+    op.drop_column('Movie', 'search_vector')
@@ -0,0 +1,38 @@
+"""add the Cast association between movies and actors
+
+Revision ID: e2d94b7a6c31
+Revises: c4e8a1f05b92
+Create Date: 2026-10-18 20:05:12.530117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2d94b7a6c31'
+down_revision = 'c4e8a1f05b92'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the (movie_id, actor_id) primary key also indexes movie_id
+    op.create_table('Cast',
+    sa.Column('movie_id', sa.Integer(), nullable=False),
+    sa.Column('actor_id', sa.Integer(), nullable=False),
+    sa.Column('role', sa.String(), nullable=True),
+    sa.ForeignKeyConstraint(['actor_id'], ['Actor.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['movie_id'], ['Movie.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('movie_id', 'actor_id')
+    )
+    op.create_index(op.f('ix_Cast_actor_id'), 'Cast', ['actor_id'],
+                    unique=False)
+    op.execute('INSERT INTO "TableVersion" (name, version) '
+               "VALUES ('Cast', 0)")
+
+
+def downgrade():
+    op.execute('DELETE FROM "TableVersion" WHERE name = \'Cast\'')
+    op.drop_index(op.f('ix_Cast_actor_id'), table_name='Cast')
+    op.drop_table('Cast')
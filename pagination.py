@@ -0,0 +1,93 @@
+import base64
+import json
+from flask import request, abort, current_app
+
+'''
+Keyset pagination
+    pages through a table with WHERE key > :last ORDER BY key LIMIT n,
+    so every page costs the same no matter how deep the client goes; the
+    key is the sort column and id, so the cursor holds both
+'''
+
+
+def encode_cursor(position):
+    """Encodes the last seen sort key(s) into an opaque cursor
+    """
+    raw = json.dumps(position, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Decodes a cursor produced by encode_cursor, 422 when it is malformed
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        position = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except (ValueError, TypeError):
+        abort(422)
+    if not isinstance(position, dict):
+        abort(422)
+    return position
+
+
+def page_args():
+    """Returns (limit, cursor) from the query string.
+
+    Paging is opt-in: limit is None when the client sent neither `limit`
+    nor `cursor`, and the route keeps its original full-table response.
+    """
+    limit = request.args.get('limit')
+    cursor = request.args.get('cursor')
+    if limit is None and cursor is None:
+        return None, None
+
+    if limit is None:
+        limit = current_app.config['DEFAULT_PAGE_SIZE']
+    try:
+        limit = int(limit)
+    except ValueError:
+        abort(422)
+    if limit < 1:
+        abort(422)
+
+    return min(limit, current_app.config['MAX_PAGE_SIZE']), cursor
+
+
+def paginate(query, sort, limit, cursor=None):
+    """Returns one page of `query` in the order of `sort` (a filters.Sort)
+    and the next cursor
+    """
+    if cursor:
+        query = query.filter(sort.after(decode_cursor(cursor)))
+
+    rows = query.order_by(*sort.order_by()).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(sort.position(rows[-1]))
+
+    return rows, next_cursor
+
+
+def paginate_ranked(query, limit, cursor=None):
+    """Pages through a relevance-ordered query.
+
+    Ranks are floats computed per query, so they make a poor keyset; the
+    cursor carries the offset instead, which search results (read a few
+    pages deep at most) can afford.
+    """
+    offset = 0
+    if cursor:
+        offset = decode_cursor(cursor).get('offset')
+        if not isinstance(offset, int) or offset < 0:
+            abort(422)
+
+    rows = query.offset(offset).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor({'offset': offset + limit})
+
+    return rows, next_cursor
@@ -0,0 +1,173 @@
+import logging
+import time
+from collections import Counter
+from functools import wraps
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+'''
+Request SQL recorder
+    Counts the statements each request executes. Slow statements are logged
+    with their parameters and query plan, a statement repeated within one
+    request is reported as a probable N+1, and a route that runs more
+    statements than its @query_budget warns, or raises under TESTING.
+    Statements run with execution_options(query_recorder=False) are not
+    counted
+'''
+
+logger = logging.getLogger(__name__)
+
+EXPLAIN = {
+    'postgresql': 'EXPLAIN ',
+    'mysql': 'EXPLAIN ',
+    'sqlite': 'EXPLAIN QUERY PLAN '
+}
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class RequestRecorder:
+    """Statements run while serving one request
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.statements = Counter()
+        self.budget = None
+        self.allowance = 0
+
+    def record(self, statement):
+        self.count += 1
+        self.statements[statement] += 1
+
+    def repeated(self, threshold):
+        return [(statement, count)
+                for statement, count in self.statements.items()
+                if count >= threshold]
+
+    def over_budget(self):
+        return self.budget is not None and \
+            self.count > self.budget + self.allowance
+
+
+def current_recorder():
+    if not has_request_context():
+        return None
+    return g.get('sql_recorder')
+
+
+def query_budget(limit):
+    """Caps the statements a route may run per request
+    """
+    def query_budget_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            recorder = current_recorder()
+            if recorder is not None:
+                recorder.budget = limit
+            return f(*args, **kwargs)
+
+        wrapper.query_budget = limit
+        return wrapper
+    return query_budget_decorator
+
+
+def expect_queries(count):
+    """Raises the current route's budget by `count` statements, for code
+    paths that knowingly run one statement per item
+    """
+    recorder = current_recorder()
+    if recorder is not None:
+        recorder.allowance += count
+
+
+def explain(conn, cursor, statement, parameters):
+    prefix = EXPLAIN.get(conn.dialect.name)
+    if prefix is None or \
+            statement.lstrip()[:6].lower() not in ('select', 'with'):
+        return None
+    # a raw cursor on the same connection keeps the plan out of the
+    # recorder and inside the request's transaction
+    explain_cursor = cursor.connection.cursor()
+    try:
+        explain_cursor.execute(prefix + statement, parameters)
+        return '\n'.join(' '.join(str(column) for column in row)
+                         for row in explain_cursor.fetchall())
+    except Exception:
+        logger.debug('Unable to explain %s', statement, exc_info=True)
+        return None
+    finally:
+        explain_cursor.close()
+
+
+# ----------------------------------------------------------------------------#
+# Engine events.
+# ----------------------------------------------------------------------------#
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    recorder = current_recorder()
+    if recorder is not None and \
+            context.execution_options.get('query_recorder', True):
+        recorder.record(statement)
+        conn.info.setdefault('recorder_started', []).append(
+            time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    started = conn.info.get('recorder_started')
+    if not started:
+        return
+    elapsed_ms = (time.perf_counter() - started.pop()) * 1000
+    if elapsed_ms < current_app.config['SQL_SLOW_QUERY_MS']:
+        return
+    plan = None if executemany else \
+        explain(conn, cursor, statement, parameters)
+    logger.warning('Slow query (%.1f ms) in %s: %s %r\n%s', elapsed_ms,
+                   request.endpoint, statement, parameters, plan or '')
+
+
+def _handle_error(context):
+    started = context.connection.info.get('recorder_started')
+    if started:
+        started.pop()
+
+
+def init_query_recorder(app):
+    """Records the statements of every request to `app`
+    """
+    if not app.config['SQL_RECORDER_ENABLED']:
+        return
+
+    for name, listener in [('before_cursor_execute', _before_cursor_execute),
+                           ('after_cursor_execute', _after_cursor_execute),
+                           ('handle_error', _handle_error)]:
+        if not event.contains(Engine, name, listener):
+            event.listen(Engine, name, listener)
+
+    @app.before_request
+    def start_recorder():
+        g.sql_recorder = RequestRecorder()
+
+    @app.teardown_request
+    def check_recorder(exc):
+        recorder = g.pop('sql_recorder', None)
+        if recorder is None or exc is not None:
+            return
+
+        for statement, count in recorder.repeated(
+                app.config['SQL_REPEAT_THRESHOLD']):
+            logger.warning('Probable N+1 in %s: %d x %s', request.endpoint,
+                           count, statement)
+
+        if recorder.over_budget():
+            message = '{} ran {} statements, budget is {}'.format(
+                request.endpoint, recorder.count,
+                recorder.budget + recorder.allowance)
+            if app.testing:
+                raise QueryBudgetExceeded(message)
+            logger.warning(message)
@@ -0,0 +1,135 @@
+import logging
+import threading
+import time
+from flask import request, has_request_context, _request_ctx_stack
+from sqlalchemy import text
+from cache import RedisBackend
+from models import db
+
+'''
+Read-replica routing
+    GET requests read from the replica bind; writes and everything else use
+    the primary. A subject that just wrote is pinned to the primary for
+    REPLICA_STICKY_SECONDS so it reads its own changes, and reads fall back
+    to the primary while the replica is down or lagging past
+    REPLICA_MAX_LAG_SECONDS. The response cache is skipped for pinned
+    subjects, and keeps a read the replica served for REPLICA_CACHE_TTL
+    seconds only: it may predate the write that started the current cache
+    generation
+'''
+
+READ_METHODS = ('GET', 'HEAD')
+WRITE_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+
+LAG_QUERIES = {
+    'postgresql': text(
+        'SELECT CASE WHEN pg_is_in_recovery() THEN COALESCE(EXTRACT(EPOCH '
+        'FROM now() - pg_last_xact_replay_timestamp()), 0) ELSE 0 END'),
+}
+
+logger = logging.getLogger(__name__)
+
+
+class ReadRouter:
+
+    def __init__(self, app, backend=None):
+        self.app = app
+        self.sticky_seconds = app.config['REPLICA_STICKY_SECONDS']
+        self.max_lag = app.config['REPLICA_MAX_LAG_SECONDS']
+        self.check_interval = app.config['REPLICA_CHECK_INTERVAL']
+        self.backend = backend
+        self._pinned = {}
+        self._healthy = False
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def read_engine(self):
+        """The replica engine when the current request may read from it
+        """
+        if not has_request_context() or request.method not in READ_METHODS:
+            return None
+        if self.current_user_pinned() or not self.replica_available():
+            return None
+        return db.get_engine(self.app, bind='replica')
+
+    def current_user_pinned(self):
+        user = getattr(_request_ctx_stack.top, 'current_user', None)
+        return user is not None and self.is_pinned(user.get('sub'))
+
+    def pin(self, subject):
+        if subject is None:
+            return
+        if self.backend is not None:
+            self.backend.set('pinned:' + subject, b'1', self.sticky_seconds)
+            return
+        now = time.monotonic()
+        with self._lock:
+            if len(self._pinned) > 10000:
+                self._pinned = {name: until for name, until
+                                in self._pinned.items() if until > now}
+            self._pinned[subject] = now + self.sticky_seconds
+
+    def is_pinned(self, subject):
+        if subject is None:
+            return False
+        if self.backend is not None:
+            return self.backend.get('pinned:' + subject) is not None
+        with self._lock:
+            until = self._pinned.get(subject)
+            if until is not None and until <= time.monotonic():
+                del self._pinned[subject]
+                until = None
+        return until is not None
+
+    def replica_available(self):
+        now = time.monotonic()
+        if self._checked_at is None or \
+                now - self._checked_at >= self.check_interval:
+            self._checked_at = now
+            self._healthy = self.check_replica()
+        return self._healthy
+
+    def check_replica(self):
+        """True when the replica answers and is within the lag threshold
+        """
+        engine = db.get_engine(self.app, bind='replica')
+        query = LAG_QUERIES.get(engine.dialect.name, text('SELECT 0')) \
+            .execution_options(query_recorder=False)
+        try:
+            with engine.connect() as connection:
+                lag = connection.execute(query).scalar() or 0
+        except Exception:
+            logger.exception('Read replica is unavailable')
+            return False
+        if lag > self.max_lag:
+            logger.warning('Read replica is %.1fs behind, reading from the '
+                           'primary', lag)
+            return False
+        return True
+
+
+def init_routing(app):
+    """Turns replica routing on when a replica database is configured
+    """
+    if not app.config.get('REPLICA_DATABASE_URL'):
+        return
+    app.config.setdefault('SQLALCHEMY_BINDS', {})
+    app.config['SQLALCHEMY_BINDS'] = dict(
+        app.config['SQLALCHEMY_BINDS'] or {},
+        replica=app.config['REPLICA_DATABASE_URL'])
+
+    backend = None
+    url = app.config.get('REPLICA_PIN_REDIS_URL')
+    if url:
+        import redis
+        backend = RedisBackend(redis.StrictRedis.from_url(url))
+    router = ReadRouter(app, backend=backend)
+    app.extensions['read_router'] = router
+
+    @app.after_request
+    def pin_writers(response):
+        if request.method in WRITE_METHODS and response.status_code < 400:
+            user = getattr(_request_ctx_stack.top, 'current_user', None)
+            if user is not None:
+                router.pin(user.get('sub'))
+        return response
@@ -0,0 +1,52 @@
+from sqlalchemy import case, func, literal_column, or_
+from models import db, Movie
+
+'''
+Movie search
+    Postgres ranks matches with ts_rank over the GIN-indexed search_vector
+    column; any other engine (SQLite in the tests) falls back to LIKE
+    matching with a simple field-weighted rank
+'''
+
+SEARCH_CONFIG = 'english'
+
+
+def search_movies(q):
+    """Returns a query of (Movie, rank) rows matching `q`, best first
+    """
+    if db.session.get_bind().dialect.name == 'postgresql':
+        return _search_tsvector(q)
+    return _search_like(q)
+
+
+def _search_tsvector(q):
+    vector = literal_column('"Movie".search_vector')
+    tsquery = func.plainto_tsquery(SEARCH_CONFIG, q)
+    rank = func.ts_rank(vector, tsquery).label('rank')
+    return db.session.query(Movie, rank) \
+        .filter(vector.op('@@')(tsquery)) \
+        .order_by(rank.desc(), Movie.id)
+
+
+def _like_pattern(term):
+    escaped = term.replace('\\', '\\\\').replace('%', '\\%') \
+        .replace('_', '\\_')
+    return '%' + escaped + '%'
+
+
+def _search_like(q):
+    weights = ((Movie.title, 3), (Movie.description, 2), (Movie.category, 1))
+    conditions = []
+    score = []
+    for term in q.split():
+        pattern = _like_pattern(term)
+        matches = [column.ilike(pattern, escape='\\')
+                   for column, _ in weights]
+        conditions.append(or_(*matches))
+        score.extend(case([(match, weight)], else_=0)
+                     for match, (_, weight) in zip(matches, weights))
+
+    rank = sum(score[1:], score[0]).label('rank')
+    return db.session.query(Movie, rank) \
+        .filter(*conditions) \
+        .order_by(rank.desc(), Movie.id)
@@ -0,0 +1,70 @@
+from flask import current_app, json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+'''
+JSON providers
+    json_response() encodes with orjson when it is installed and with
+    Flask's own encoder otherwise. The stdlib provider produces the same
+    bytes as jsonify(); orjson produces the same documents, but writes
+    non-ASCII characters as UTF-8 rather than \\u escapes
+'''
+
+
+class StdlibProvider:
+    """flask.json with jsonify()'s formatting
+    """
+    name = 'stdlib'
+
+    def dumps(self, data, pretty=False):
+        if pretty:
+            text = json.dumps(data, indent=2, separators=(', ', ': '))
+        else:
+            text = json.dumps(data, indent=None, separators=(',', ':'))
+        return (text + '\n').encode('utf-8')
+
+
+class OrjsonProvider:
+    """orjson, several times faster on large lists
+    """
+    name = 'orjson'
+
+    def __init__(self, sort_keys=True):
+        self.option = orjson.OPT_NON_STR_KEYS
+        if sort_keys:
+            self.option |= orjson.OPT_SORT_KEYS
+
+    def dumps(self, data, pretty=False):
+        option = (self.option | orjson.OPT_INDENT_2) if pretty else \
+            self.option
+        return orjson.dumps(data, option=option) + b'\n'
+
+
+def init_json(app):
+    """Picks the JSON_PROVIDER for `app`: orjson, stdlib, or auto to use
+    orjson when it can be imported
+    """
+    choice = app.config['JSON_PROVIDER']
+    if choice == 'orjson' and orjson is None:
+        raise RuntimeError('JSON_PROVIDER is orjson but it is not installed')
+    if choice == 'stdlib' or orjson is None:
+        provider = StdlibProvider()
+    else:
+        provider = OrjsonProvider(app.config['JSON_SORT_KEYS'])
+    app.extensions['json_provider'] = provider
+
+
+def dumps(data, pretty=False):
+    return current_app.extensions['json_provider'].dumps(data, pretty)
+
+
+def json_response(data):
+    """jsonify(data) through the app's JSON provider
+    """
+    pretty = current_app.config['JSONIFY_PRETTYPRINT_REGULAR'] or \
+        current_app.debug
+    return current_app.response_class(
+        dumps(data, pretty), mimetype=current_app.config['JSONIFY_MIMETYPE'])
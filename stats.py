@@ -0,0 +1,77 @@
+import json
+from sqlalchemy import Text, cast, func, literal, select
+from models import db, bump_version, CatalogStat, STAT_COLUMNS
+
+'''
+Catalog statistics
+    GET /stats reads the CatalogStat summary, which triggers keep current
+    as movies and actors are written, so serving it costs one query over a
+    few dozen rows however large the tables grow. rebuild_stats() recounts
+    the summary from the tables, to repair it or fill it in after a bulk
+    load that bypassed the triggers
+'''
+
+# response section -> (name, CatalogStat kind, value key) per distribution
+SECTIONS = {
+    'movies': [('by_category', 'movie_category', 'category')],
+    'actors': [('by_gender', 'actor_gender', 'gender'),
+               ('by_age', 'actor_age', 'age')]
+}
+
+
+def _sort_key(entry):
+    value = entry[0]
+    return (value is None, value)
+
+
+def catalog_stats():
+    """Counts per movie category and actor gender and age, with totals
+    """
+    counts = {}
+    for kind, value, count in db.session.query(
+            CatalogStat.kind, CatalogStat.value, CatalogStat.count) \
+            .filter(CatalogStat.count > 0):
+        counts.setdefault(kind, []).append((json.loads(value), count))
+
+    stats = {}
+    for section, distributions in SECTIONS.items():
+        data = stats[section] = {}
+        for name, kind, key in distributions:
+            entries = sorted(counts.get(kind, []), key=_sort_key)
+            data[name] = [{key: value, 'count': count}
+                          for value, count in entries]
+        # every row falls in exactly one value of each distribution
+        data['total'] = sum(entry['count']
+                            for entry in data[distributions[0][0]])
+    return stats
+
+
+def json_text(column, dialect):
+    """`column` as the JSON text the triggers store
+    """
+    if dialect == 'postgresql':
+        return func.coalesce(cast(func.to_jsonb(column), Text), 'null')
+    return func.json_quote(column)
+
+
+def rebuild_stats():
+    """Recounts CatalogStat from the tables in one transaction
+    """
+    session = db.session
+    delete = CatalogStat.__table__.delete()
+    # a write statement pins the session's connection to the primary
+    connection = session.connection(clause=delete)
+    dialect = connection.dialect.name
+    if dialect == 'postgresql':
+        # hold writers off, so none is counted twice or missed
+        connection.execute('LOCK TABLE "Movie", "Actor" IN SHARE MODE')
+    session.execute(delete)
+    tables = db.metadata.tables
+    for kind, (table, column) in STAT_COLUMNS.items():
+        value = json_text(tables[table].c[column], dialect)
+        session.execute(CatalogStat.__table__.insert().from_select(
+            ['kind', 'value', 'count'],
+            select([literal(kind), value, func.count()])
+            .group_by(value)))
+    bump_version(CatalogStat.__tablename__)
+    session.commit()
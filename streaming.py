@@ -0,0 +1,45 @@
+from flask import Response, json, request, stream_with_context
+from serialization import dumps
+
+'''
+Streaming list responses
+    writes the usual {"success": true, "<key>": [...]} envelope a chunk of
+    rows at a time, so worker memory stays flat whatever the table size
+'''
+
+
+def wants_stream():
+    """True when the client asked for the streaming list mode
+    """
+    return request.args.get('stream', '').lower() in ('1', 'true')
+
+
+def stream_rows(query, chunk_size):
+    """Yields the rows of `query` through a server-side cursor
+    """
+    return query.execution_options(stream_results=True).yield_per(chunk_size)
+
+
+def stream_list(key, query, chunk_size):
+    """Returns a response streaming `query` as a JSON array under `key`
+
+    `query` should select plain columns; each row is serialized from its
+    named tuple, so no ORM instance or intermediate list is ever built.
+    """
+
+    def generate():
+        yield ('{"success": true, %s: [' % json.dumps(key)).encode('utf-8')
+        separator = b''
+        chunk = []
+        for row in stream_rows(query, chunk_size):
+            chunk.append(dumps(row._asdict()).rstrip())
+            if len(chunk) == chunk_size:
+                yield separator + b', '.join(chunk)
+                separator = b', '
+                chunk = []
+        if chunk:
+            yield separator + b', '.join(chunk)
+        yield b']}'
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/json')
@@ -1,11 +1,26 @@
+import asyncio
+import importlib.util
 import os
 import unittest
 import json
 import random
+import tempfile
+import threading
+import time
+from collections import Counter
+from unittest import mock
+from flask import Flask, jsonify
 from flask_sqlalchemy import SQLAlchemy
+from jose import jwk, jwt
+from sqlalchemy import event, exc, text
 
+import admission
+import auth
+import cache
+import models
 from app import create_app
-from models import setup_db, Actor, Movie
+from conditional import row_etag
+from models import db, setup_db, get_version, Actor, CatalogStat, Movie
 
 
 TEST_DATABASE_URI = os.getenv('TEST_DATABASE_URI')
@@ -259,5 +274,2045 @@ class CastingAgencyTest(unittest.TestCase):
         self.assertEqual(data['code'], 'unauthorized')
 
 
+'''
+OFFLINE AUTH
+'''
+
+# Tokens below are signed with a locally generated key and verified against
+# a JWKS file, so these tests need neither Auth0 nor the network.
+TEST_KID = 'test-key'
+_signing_key = None
+
+
+def signing_key():
+    global _signing_key
+    if _signing_key is None:
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        private_key = rsa.generate_private_key(
+            public_exponent=65537, key_size=2048, backend=default_backend())
+        _signing_key = private_key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.TraditionalOpenSSL,
+            serialization.NoEncryption()).decode('utf-8')
+    return _signing_key
+
+
+def write_jwks(path, kids=(TEST_KID,)):
+    public_key = jwk.construct(signing_key(), 'RS256').public_key().to_dict()
+    public_key = {name: value.decode('utf-8') if isinstance(value, bytes)
+                  else value for name, value in public_key.items()}
+    keys = [dict(public_key, kid=kid, use='sig') for kid in kids]
+    with open(path, 'w') as f:
+        json.dump({'keys': keys}, f)
+
+
+def sign_token(permissions, kid=TEST_KID, expires_in=3600, **claims):
+    now = int(time.time())
+    claims = dict({
+        'iss': 'https://' + auth.AUTH0_DOMAIN + '/',
+        'sub': 'auth0|test',
+        'aud': auth.API_AUDIENCE,
+        'iat': now,
+        'exp': now + expires_in,
+        'permissions': list(permissions)
+    }, **claims)
+    return jwt.encode(claims, signing_key(), algorithm='RS256',
+                      headers={'kid': kid})
+
+
+class OfflineAuthMixin:
+
+    def setUp(self):
+        super().setUp()
+        handle, self.jwks_path = tempfile.mkstemp(suffix='.json')
+        os.close(handle)
+        write_jwks(self.jwks_path)
+        self.key_store = auth.JWKSKeyStore('file://' + self.jwks_path)
+        patcher = mock.patch.object(auth, 'key_store', self.key_store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(os.remove, self.jwks_path)
+
+
+class JWKSKeyStoreTest(OfflineAuthMixin, unittest.TestCase):
+
+    def test_key_set_is_fetched_once(self):
+        token = sign_token(['get:movies'])
+        with mock.patch.object(self.key_store, '_load_keys',
+                               wraps=self.key_store._load_keys) as load:
+            for _ in range(5):
+                payload = auth.verify_decode_jwt(token)
+
+        self.assertEqual(load.call_count, 1)
+        self.assertEqual(payload['permissions'], ['get:movies'])
+
+    def test_unknown_kid_forces_rate_limited_refresh(self):
+        self.key_store.get_key(TEST_KID)
+        self.key_store._last_attempt = time.monotonic() - 60
+        write_jwks(self.jwks_path, kids=(TEST_KID, 'rotated'))
+
+        with mock.patch.object(self.key_store, '_load_keys',
+                               wraps=self.key_store._load_keys) as load:
+            self.assertIsNotNone(self.key_store.get_key('rotated'))
+            self.assertIsNone(self.key_store.get_key('bogus'))
+            self.assertIsNone(self.key_store.get_key('bogus-again'))
+
+        self.assertEqual(load.call_count, 1)
+
+    def test_failed_refresh_keeps_serving_old_keys(self):
+        self.key_store.get_key(TEST_KID)
+        os.remove(self.jwks_path)
+        self.addCleanup(write_jwks, self.jwks_path)
+
+        self.key_store.refresh(force=True)
+
+        self.assertIsNotNone(self.key_store.get_key(TEST_KID))
+
+    def test_tampered_token_is_rejected(self):
+        token = sign_token(['get:movies'])
+        header, payload, signature = token.split('.')
+        forged = sign_token(['delete:movies']).split('.')[1]
+
+        with self.assertRaises(auth.AuthError):
+            auth.verify_decode_jwt('.'.join([header, forged, signature]))
+
+
+class VerifiedTokenCacheTest(OfflineAuthMixin, unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.cache = auth.VerifiedTokenCache(maxsize=2)
+        patcher = mock.patch.object(auth, 'token_cache', self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_repeat_token_skips_verification(self):
+        app = Flask(__name__)
+
+        @app.route('/protected')
+        @auth.requires_auth('get:movies')
+        def protected(payload):
+            return payload['sub']
+
+        headers = {'Authorization': 'Bearer ' + sign_token(['get:movies'])}
+        with mock.patch.object(auth, 'verify_decode_jwt',
+                               wraps=auth.verify_decode_jwt) as verify:
+            for _ in range(3):
+                response = app.test_client().get('/protected',
+                                                 headers=headers)
+                self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(verify.call_count, 1)
+        self.assertEqual(self.cache.stats()['hits'], 2)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_permissions_are_a_frozenset(self):
+        entry = self.cache.put('token', {
+            'exp': time.time() + 60,
+            'permissions': ['get:movies']
+        })
+
+        self.assertEqual(entry.permissions, frozenset(['get:movies']))
+        self.assertTrue(auth.check_permissions(
+            'get:movies', entry.payload, entry.permissions))
+        with self.assertRaises(auth.AuthError):
+            auth.check_permissions(
+                'delete:movies', entry.payload, entry.permissions)
+
+    def test_expired_entry_is_never_returned(self):
+        self.cache.put('token', {'exp': time.time() + 60, 'permissions': []})
+        with mock.patch('auth.time.time', return_value=time.time() + 61):
+            self.assertIsNone(self.cache.get('token'))
+        self.assertEqual(self.cache.stats()['size'], 0)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        for token in ('a', 'b'):
+            self.cache.put(token, {'exp': time.time() + 60})
+        self.cache.get('a')
+        self.cache.put('c', {'exp': time.time() + 60})
+
+        self.assertIsNotNone(self.cache.get('a'))
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+
+class OfflineAppMixin(OfflineAuthMixin):
+    """Runs create_app against an in-memory SQLite database
+    """
+
+    test_config = {}
+
+    def setUp(self):
+        super().setUp()
+        self.app = create_app(dict({
+            'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+            'TESTING': True
+        }, **self.test_config))
+        self.client = self.app.test_client
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        db.create_all()
+        self.addCleanup(self.ctx.pop)
+        self.addCleanup(db.drop_all)
+        self.addCleanup(db.session.remove)
+
+    def headers(self, *permissions, **claims):
+        return {'Authorization': 'Bearer ' + sign_token(permissions, **claims)}
+
+    def record_statements(self):
+        """Returns a list that collects every SQL statement executed
+        """
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        self.addCleanup(event.remove, db.engine, 'before_cursor_execute',
+                        before_cursor_execute)
+        return statements
+
+    def seed(self, movies=0, actors=0):
+        for i in range(movies):
+            db.session.add(Movie(title='Movie {}'.format(i),
+                                 description='About movie {}'.format(i),
+                                 category='drama' if i % 2 else 'comedy'))
+        for i in range(actors):
+            db.session.add(Actor(name='Actor {}'.format(i),
+                                 gender='female' if i % 2 else 'male',
+                                 age=20 + i))
+        db.session.commit()
+
+
+class PaginationTest(OfflineAppMixin, unittest.TestCase):
+
+    def test_default_response_is_the_full_table(self):
+        self.seed(movies=3)
+        response = self.client().get('/movies',
+                                     headers=self.headers('get:movies'))
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(data['all_movies']), 3)
+        self.assertNotIn('next_cursor', data)
+
+    def test_pages_follow_next_cursor(self):
+        self.seed(actors=5)
+        seen, cursor = [], None
+        while True:
+            url = '/actors?limit=2' + ('&cursor=' + cursor if cursor else '')
+            data = json.loads(self.client().get(
+                url, headers=self.headers('get:actors')).data)
+            seen.extend(actor['id'] for actor in data['all_actors'])
+            cursor = data['next_cursor']
+            if cursor is None:
+                break
+
+        self.assertEqual(seen, sorted(actor.id for actor in Actor.query))
+
+    def test_limit_is_capped(self):
+        self.app.config['MAX_PAGE_SIZE'] = 2
+        self.seed(movies=3)
+        data = json.loads(self.client().get(
+            '/movies?limit=100', headers=self.headers('get:movies')).data)
+
+        self.assertEqual(len(data['all_movies']), 2)
+        self.assertIsNotNone(data['next_cursor'])
+
+    def test_malformed_cursor_422(self):
+        for query in ('limit=0', 'limit=x', 'cursor=not-a-cursor'):
+            response = self.client().get('/movies?' + query,
+                                         headers=self.headers('get:movies'))
+            self.assertEqual(response.status_code, 422)
+
+
+class StreamingTest(OfflineAppMixin, unittest.TestCase):
+
+    test_config = {'STREAM_CHUNK_SIZE': 2}
+
+    def test_streamed_list_matches_buffered_list(self):
+        self.seed(movies=5, actors=3)
+        for url, key, permission in (('/movies', 'all_movies', 'get:movies'),
+                                     ('/actors', 'all_actors', 'get:actors')):
+            headers = self.headers(permission)
+            buffered = json.loads(self.client().get(url, headers=headers).data)
+            response = self.client().get(url + '?stream=true',
+                                         headers=headers)
+
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.is_streamed)
+            self.assertEqual(json.loads(response.data), buffered)
+
+    def test_empty_table_streams_empty_list(self):
+        response = self.client().get('/movies?stream=1',
+                                     headers=self.headers('get:movies'))
+
+        self.assertEqual(json.loads(response.data),
+                         {'success': True, 'all_movies': []})
+
+
+class ConditionalGetTest(OfflineAppMixin, unittest.TestCase):
+
+    test_config = {'CACHE_ENABLED': False}
+
+    def test_unchanged_table_304_without_reading_rows(self):
+        self.seed(movies=3)
+        headers = self.headers('get:movies')
+        response = self.client().get('/movies', headers=headers)
+        etag = response.headers['ETag']
+
+        statements = self.record_statements()
+        response = self.client().get(
+            '/movies', headers=dict(headers, **{'If-None-Match': etag}))
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertEqual(len(statements), 1)
+        self.assertIn('TableVersion', statements[0])
+
+    def test_write_changes_etag(self):
+        self.seed(actors=1)
+        headers = self.headers('get:actors', 'add:actors')
+        etag = self.client().get('/actors', headers=headers).headers['ETag']
+
+        self.client().post('/actors/add', headers=headers,
+                           json={'name': 'Edward', 'age': 25})
+        response = self.client().get(
+            '/actors', headers=dict(headers, **{'If-None-Match': etag}))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertEqual(len(json.loads(response.data)['all_actors']), 2)
+
+    def test_etag_depends_on_query_string(self):
+        self.seed(movies=3)
+        headers = self.headers('get:movies')
+        full = self.client().get('/movies', headers=headers)
+        page = self.client().get('/movies?limit=1', headers=headers)
+
+        self.assertNotEqual(full.headers['ETag'], page.headers['ETag'])
+
+    def test_unauthorized_request_never_gets_304(self):
+        self.seed(movies=1)
+        etag = self.client().get(
+            '/movies', headers=self.headers('get:movies')).headers['ETag']
+        response = self.client().get(
+            '/movies', headers={'If-None-Match': etag})
+
+        self.assertEqual(response.status_code, 401)
+
+
+class BulkCreateTest(OfflineAppMixin, unittest.TestCase):
+
+    test_config = {'MAX_BULK_SIZE': 3}
+
+    def test_bulk_movies_single_commit_returns_ids(self):
+        response = self.client().post(
+            '/movies/bulk', headers=self.headers('add:movies'),
+            json=[{'title': 'Iron Man'}, {'title': 'Joker', 'category': 'x'}])
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(data['ids'],
+                         [movie.id for movie in Movie.query.order_by('id')])
+        self.assertEqual(get_version('Movie'), 1)
+
+    def test_bulk_actors_returns_ids(self):
+        response = self.client().post(
+            '/actors/bulk', headers=self.headers('add:actors'),
+            json=[{'name': 'Edward', 'age': 25}, {'name': 'David'}])
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(json.loads(response.data)['ids']), 2)
+        self.assertEqual(Actor.query.count(), 2)
+
+    def test_missing_title_rejects_whole_batch_422(self):
+        response = self.client().post(
+            '/movies/bulk', headers=self.headers('add:movies'),
+            json=[{'title': 'Iron Man'}, {'description': 'untitled'}])
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(Movie.query.count(), 0)
+
+    def test_batch_over_limit_413(self):
+        response = self.client().post(
+            '/actors/bulk', headers=self.headers('add:actors'),
+            json=[{'name': str(i)} for i in range(4)])
+
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(json.loads(response.data)['error'], 413)
+
+    def test_bulk_requires_add_permission_403(self):
+        response = self.client().post(
+            '/movies/bulk', headers=self.headers('get:movies'),
+            json=[{'title': 'Iron Man'}])
+
+        self.assertEqual(response.status_code, 403)
+
+
+class SearchTest(OfflineAppMixin, unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        for title, description, category in (
+                ('Joker', 'A failed comedian', 'drama'),
+                ('Iron Man', 'Billionaire builds a suit', 'action'),
+                ('The Comedian', 'Stand-up drama', 'comedy'),
+                ('100% Pure', 'Literal percent sign', 'drama')):
+            db.session.add(Movie(title=title, description=description,
+                                 category=category))
+        db.session.commit()
+
+    def search(self, query):
+        response = self.client().get('/movies/search?' + query,
+                                     headers=self.headers('get:movies'))
+        return response, json.loads(response.data)
+
+    def test_results_are_ranked(self):
+        response, data = self.search('q=comedian')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([movie['title'] for movie in data['movies']],
+                         ['The Comedian', 'Joker'])
+        self.assertGreater(data['movies'][0]['rank'],
+                           data['movies'][1]['rank'])
+
+    def test_every_term_must_match(self):
+        _, data = self.search('q=drama+comedian')
+
+        self.assertEqual([movie['title'] for movie in data['movies']],
+                         ['The Comedian', 'Joker'])
+
+    def test_like_wildcards_are_literal(self):
+        _, data = self.search('q=%25')
+
+        self.assertEqual([movie['title'] for movie in data['movies']],
+                         ['100% Pure'])
+
+    def test_results_are_paginated(self):
+        _, first = self.search('q=drama&limit=2')
+        _, second = self.search('q=drama&limit=2&cursor=' +
+                                first['next_cursor'])
+
+        titles = [movie['title']
+                  for movie in first['movies'] + second['movies']]
+        self.assertEqual(len(titles), 3)
+        self.assertEqual(len(set(titles)), 3)
+        self.assertIsNone(second['next_cursor'])
+
+    def test_missing_query_422(self):
+        response, _ = self.search('q=+')
+
+        self.assertEqual(response.status_code, 422)
+
+
+class SparseFieldsTest(OfflineAppMixin, unittest.TestCase):
+
+    def test_list_returns_only_requested_fields(self):
+        self.seed(movies=3)
+        statements = self.record_statements()
+        data = json.loads(self.client().get(
+            '/movies?fields=title', headers=self.headers('get:movies')).data)
+
+        self.assertEqual(data['all_movies'],
+                         [{'title': 'Movie {}'.format(i)} for i in range(3)])
+        select = [s for s in statements if s.startswith('SELECT')][-1]
+        self.assertNotIn('description', select)
+
+    def test_fields_compose_with_pagination_and_streaming(self):
+        self.seed(actors=3)
+        headers = self.headers('get:actors')
+        page = json.loads(self.client().get(
+            '/actors?fields=name,age&limit=2', headers=headers).data)
+        rest = json.loads(self.client().get(
+            '/actors?fields=name,age&cursor=' + page['next_cursor'],
+            headers=headers).data)
+        streamed = json.loads(self.client().get(
+            '/actors?fields=name,age&stream=true', headers=headers).data)
+
+        self.assertEqual(page['all_actors'] + rest['all_actors'],
+                         streamed['all_actors'])
+        self.assertEqual(set(streamed['all_actors'][0]), {'name', 'age'})
+
+    def test_single_item_route(self):
+        self.seed(actors=1)
+        actor_id = Actor.query.first().id
+        headers = self.headers('get:actors')
+        full = json.loads(self.client().get(
+            '/actors/{}'.format(actor_id), headers=headers).data)
+        sparse = json.loads(self.client().get(
+            '/actors/{}?fields=id,name'.format(actor_id), headers=headers).data)
+        missing = self.client().get('/actors/9999', headers=headers)
+
+        self.assertEqual(full['actor'],
+                         dict(Actor.query.first().format(), version=1))
+        self.assertEqual(sparse['actor'], {'id': actor_id, 'name': 'Actor 0'})
+        self.assertEqual(missing.status_code, 404)
+
+    def test_only_item_routes_return_the_row_version(self):
+        self.seed(movies=1)
+        headers = self.headers('get:movies')
+        rows = [json.loads(self.client().get(url, headers=headers).data)
+                ['all_movies'][0]
+                for url in ('/movies', '/movies?limit=1',
+                            '/movies?stream=true', '/movies?include=cast')]
+        item = json.loads(self.client().get(
+            '/movies/1', headers=headers).data)['movie']
+
+        self.assertEqual(rows, [Movie.query.first().format()] * 3 +
+                         [dict(Movie.query.first().format(), cast=[])])
+        self.assertEqual(item['version'], 1)
+
+    def test_unknown_field_422(self):
+        for query in ('fields=title,password', 'fields=,'):
+            response = self.client().get('/movies?' + query,
+                                         headers=self.headers('get:movies'))
+            self.assertEqual(response.status_code, 422)
+
+
+class FilterTest(OfflineAppMixin, unittest.TestCase):
+
+    test_config = {'CACHE_ENABLED': False}
+
+    def get(self, url, permission):
+        response = self.client().get(url, headers=self.headers(permission))
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.data)
+
+    def ids(self, url, permission, key):
+        return [row['id'] for row in self.get(url, permission)[key]]
+
+    def pages(self, url, permission, key):
+        seen, cursor = [], None
+        while True:
+            data = self.get(url + ('&cursor=' + cursor if cursor else ''),
+                            permission)
+            seen.extend(row['id'] for row in data[key])
+            cursor = data['next_cursor']
+            if cursor is None:
+                return seen
+
+    def plan(self, url, permission, table):
+        """EXPLAIN QUERY PLAN of the route's SELECT from `table`
+        """
+        executed = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters,
+                                  *args):
+            executed.append((statement, parameters))
+
+        event.listen(db.engine, 'before_cursor_execute',
+                     before_cursor_execute)
+        try:
+            self.get(url, permission)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute',
+                         before_cursor_execute)
+        statement, parameters = next(
+            (statement, parameters) for statement, parameters in executed
+            if statement.startswith('SELECT') and
+            'FROM "{}"'.format(table) in statement)
+        connection = db.session.connection().connection
+        return ' '.join(row[-1] for row in connection.execute(
+            'EXPLAIN QUERY PLAN ' + statement, parameters))
+
+    def test_movie_filters(self):
+        self.seed(movies=4)
+        Movie.query.get(4).title = 'Heat'
+        db.session.commit()
+
+        self.assertEqual(
+            self.ids('/movies?category=drama', 'get:movies', 'all_movies'),
+            [2, 4])
+        self.assertEqual(self.get(
+            '/movies?category=drama&title_prefix=MOV&fields=title',
+            'get:movies')['all_movies'], [{'title': 'Movie 1'}])
+        self.assertEqual(self.ids('/movies?title_prefix=he&include=cast',
+                                  'get:movies', 'all_movies'), [4])
+
+    def test_actor_filters(self):
+        self.seed(actors=6)
+
+        self.assertEqual(self.ids('/actors?min_age=21&max_age=23',
+                                  'get:actors', 'all_actors'), [2, 3, 4])
+        self.assertEqual(self.ids('/actors?gender=female&min_age=22',
+                                  'get:actors', 'all_actors'), [4, 6])
+        self.assertEqual(self.ids('/actors?name_prefix=actor%203',
+                                  'get:actors', 'all_actors'), [4])
+
+    def test_sorted_pages_compose_with_filters(self):
+        for name in ('bob', 'Alice', 'carol', 'alice', 'Bob', 'Dave', 'bob'):
+            db.session.add(Actor(name=name, gender='female', age=30))
+        db.session.add(Actor(name='Aaron', gender='male', age=30))
+        db.session.commit()
+        expected = [actor.id for actor in sorted(
+            Actor.query.filter_by(gender='female'),
+            key=lambda actor: (actor.name.lower(), actor.id))]
+
+        self.assertEqual(self.pages('/actors?gender=female&sort=name&limit=2',
+                                    'get:actors', 'all_actors'), expected)
+        self.assertEqual(self.pages('/actors?gender=female&sort=-name&limit=3',
+                                    'get:actors', 'all_actors'),
+                         expected[::-1])
+        self.assertEqual(self.ids('/actors?gender=female&sort=name',
+                                  'get:actors', 'all_actors'), expected)
+        self.assertEqual(self.pages('/actors?sort=-id&limit=3', 'get:actors',
+                                    'all_actors'), list(range(8, 0, -1)))
+
+    def test_bad_filters_and_sorts_422(self):
+        self.seed(actors=3)
+        cursor = self.get('/actors?limit=1', 'get:actors')['next_cursor']
+        for query in ('sort=age', 'sort=-gender', 'min_age=old',
+                      'name_prefix=', 'sort=name&cursor=' + cursor):
+            response = self.client().get('/actors?' + query,
+                                         headers=self.headers('get:actors'))
+            self.assertEqual(response.status_code, 422, query)
+
+    def test_filters_are_served_by_indexes(self):
+        self.seed(movies=10, actors=10)
+        cursor = self.get('/movies?sort=title&limit=2',
+                          'get:movies')['next_cursor']
+
+        for url, table, index in [
+                ('/movies?category=drama', 'Movie', 'ix_Movie_category'),
+                ('/movies?title_prefix=mov', 'Movie', 'ix_Movie_title_lower'),
+                ('/movies?sort=title&limit=2&cursor=' + cursor, 'Movie',
+                 'ix_Movie_title_lower'),
+                ('/actors?gender=male', 'Actor', 'ix_Actor_gender'),
+                ('/actors?min_age=21&max_age=25', 'Actor', 'ix_Actor_age'),
+                ('/actors?name_prefix=act', 'Actor', 'ix_Actor_name_lower')]:
+            permission = 'get:' + table.lower() + 's'
+            plan = self.plan(url, permission, table)
+            self.assertIn('SEARCH', plan, url)
+            self.assertIn(index, plan, url)
+
+
+class MemoryBackendTest(unittest.TestCase):
+
+    def test_size_is_bounded_in_bytes(self):
+        backend = cache.MemoryBackend(max_bytes=10)
+        backend.set('a', b'12345', ttl=60)
+        backend.set('b', b'12345', ttl=60)
+        backend.get('a')
+        backend.set('c', b'12345', ttl=60)
+
+        self.assertEqual(backend.get('a'), b'12345')
+        self.assertIsNone(backend.get('b'))
+        self.assertEqual(backend.size, 10)
+
+    def test_entries_expire(self):
+        backend = cache.MemoryBackend(max_bytes=10)
+        backend.set('a', b'1', ttl=-1)
+
+        self.assertIsNone(backend.get('a'))
+        self.assertEqual(backend.size, 0)
+
+    def test_add_only_stores_absent_keys(self):
+        backend = cache.MemoryBackend(max_bytes=10)
+
+        self.assertTrue(backend.add('a', b'1', ttl=60))
+        self.assertFalse(backend.add('a', b'2', ttl=60))
+        backend.delete('a')
+        self.assertTrue(backend.add('a', b'3', ttl=60))
+        self.assertEqual(backend.get('a'), b'3')
+
+
+class CacheConfigTest(unittest.TestCase):
+
+    def config(self, **env):
+        import config
+        self.addCleanup(importlib.reload, config)
+        environ = {name: value for name, value in os.environ.items()
+                   if name not in ('REDIS_URL', 'CACHE')}
+        with mock.patch.dict(os.environ, dict(environ, **env), clear=True):
+            return importlib.reload(config)
+
+    def test_cache_is_only_on_by_default_when_shared(self):
+        self.assertFalse(self.config().CACHE_ENABLED)
+        self.assertTrue(
+            self.config(REDIS_URL='redis://cache:6379/0').CACHE_ENABLED)
+        self.assertTrue(self.config(CACHE='1').CACHE_ENABLED)
+
+
+class ResponseCacheTest(OfflineAppMixin, unittest.TestCase):
+
+    test_config = {'CACHE_ENABLED': True}
+
+    def setUp(self):
+        super().setUp()
+        import fakeredis
+        self.cache = cache.ResponseCache(
+            cache.RedisBackend(fakeredis.FakeStrictRedis()), ttl=60)
+        self.app.extensions['response_cache'] = self.cache
+        self.seed(movies=2)
+
+    def get(self, url, *permissions, **headers):
+        headers.update(self.headers(*(permissions or ('get:movies',))))
+        return self.client().get(url, headers=headers)
+
+    def test_repeat_request_is_served_from_cache(self):
+        first = self.get('/movies')
+        statements = self.record_statements()
+        second = self.get('/movies')
+
+        self.assertEqual(first.headers['X-Cache'], 'MISS')
+        self.assertEqual(second.headers['X-Cache'], 'HIT')
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(second.headers['ETag'], first.headers['ETag'])
+        self.assertEqual(statements, [])
+        self.assertEqual(self.cache.stats()['hit_ratio'], 0.5)
+        self.assertEqual(self.cache.stats()['bytes_saved'], len(first.data))
+
+    def test_lookups_are_exported_to_prometheus(self):
+        from prometheus_client import REGISTRY
+
+        def sample(name, **labels):
+            return REGISTRY.get_sample_value(name, labels) or 0
+
+        before = [sample('cache_requests_total', result='hit'),
+                  sample('cache_requests_total', result='miss'),
+                  sample('cache_bytes_saved_total')]
+        first = self.get('/movies')
+        self.get('/movies')
+        self.get('/movies')
+
+        self.assertEqual([sample('cache_requests_total', result='hit'),
+                          sample('cache_requests_total', result='miss'),
+                          sample('cache_bytes_saved_total')],
+                         [before[0] + 2, before[1] + 1,
+                          before[2] + 2 * len(first.data)])
+
+    def test_write_invalidates_only_its_table(self):
+        self.get('/movies')
+        self.get('/actors', 'get:actors')
+        self.client().post('/movies/add', headers=self.headers('add:movies'),
+                           json={'title': 'Joker'})
+
+        movies = self.get('/movies')
+        actors = self.get('/actors', 'get:actors')
+
+        self.assertEqual(movies.headers['X-Cache'], 'MISS')
+        self.assertEqual(len(json.loads(movies.data)['all_movies']), 3)
+        self.assertEqual(actors.headers['X-Cache'], 'HIT')
+
+    def test_plain_movie_list_survives_actor_writes(self):
+        self.get('/movies')
+        self.get('/movies?include=cast')
+        self.client().post('/actors/add', headers=self.headers('add:actors'),
+                           json={'name': 'Joaquin', 'gender': 'male'})
+
+        self.assertEqual(self.get('/movies').headers['X-Cache'], 'HIT')
+        self.assertEqual(
+            self.get('/movies?include=cast').headers['X-Cache'], 'MISS')
+
+    def test_key_covers_query_args_and_permissions(self):
+        self.get('/movies')
+
+        self.assertEqual(
+            self.get('/movies?fields=id').headers['X-Cache'], 'MISS')
+        self.assertEqual(
+            self.get('/movies', 'get:movies', 'add:movies')
+            .headers['X-Cache'], 'MISS')
+
+    def test_cached_response_honours_if_none_match(self):
+        etag = self.get('/movies').headers['ETag']
+        response = self.get('/movies', **{'If-None-Match': etag})
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['X-Cache'], 'HIT')
+
+
+class ASGITest(OfflineAppMixin, unittest.TestCase):
+
+    def call(self, scope, messages):
+        import asgi
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        application = asgi.Lifespan(asgi.WsgiToAsgi(self.app))
+        asyncio.run(application(scope, receive, send))
+        return sent
+
+    def test_startup_primes_the_key_store(self):
+        sent = self.call({'type': 'lifespan'}, [
+            {'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}])
+
+        self.assertEqual([message['type'] for message in sent],
+                         ['lifespan.startup.complete',
+                          'lifespan.shutdown.complete'])
+        self.assertIsNotNone(self.key_store.get_key(TEST_KID))
+
+    def test_routes_and_error_envelopes_are_unchanged(self):
+        self.seed(movies=1)
+        token = sign_token(['get:movies'])
+        for headers in ({}, {'Authorization': 'Bearer ' + token}):
+            expected = self.client().get('/movies', headers=headers)
+            sent = self.call({
+                'type': 'http', 'http_version': '1.1', 'method': 'GET',
+                'path': '/movies', 'raw_path': b'/movies', 'root_path': '',
+                'scheme': 'http', 'query_string': b'',
+                'headers': [(name.lower().encode('latin-1'),
+                             value.encode('latin-1'))
+                            for name, value in headers.items()],
+                'server': ('testserver', 80), 'client': ('127.0.0.1', 1)
+            }, [{'type': 'http.request', 'body': b'', 'more_body': False}])
+
+            self.assertEqual(sent[0]['status'], expected.status_code)
+            body = b''.join(message.get('body', b'') for message in sent[1:])
+            self.assertEqual(json.loads(body), json.loads(expected.data))
+
+
+class EngineProfileTest(unittest.TestCase):
+
+    def pool(self, **kwargs):
+        import sqlite3
+        return models.TimedQueuePool(
+            lambda: sqlite3.connect(':memory:', check_same_thread=False),
+            **kwargs)
+
+    def test_postgres_profile_sets_pool_and_timeouts(self):
+        import config
+        options = models.engine_options(
+            'postgresql://localhost/casting', config.ENGINE_PROFILES['web'])
+
+        self.assertIs(options['poolclass'], models.TimedQueuePool)
+        self.assertTrue(options['pool_pre_ping'])
+        self.assertEqual(options['pool_recycle'], 1800)
+        self.assertEqual(options['connect_args']['options'],
+                         '-c statement_timeout=5000 -c lock_timeout=2000')
+
+    def test_sqlite_keeps_default_pool(self):
+        import config
+        self.assertEqual(models.engine_options(
+            'sqlite://', config.ENGINE_PROFILES['web']), {})
+
+    def test_setup_db_uses_database_path_and_profile(self):
+        app = Flask(__name__)
+        setup_db(app, 'postgresql://localhost/other', profile='batch')
+
+        self.assertEqual(app.config['SQLALCHEMY_DATABASE_URI'],
+                         'postgresql://localhost/other')
+        self.assertEqual(
+            app.config['SQLALCHEMY_ENGINE_OPTIONS']['max_overflow'], 0)
+
+    def test_checkout_wait_and_saturation_are_recorded(self):
+        from sqlalchemy.exc import TimeoutError
+        pool = self.pool(pool_size=1, max_overflow=0, timeout=0.05)
+        connection = pool.connect()
+        with self.assertRaises(TimeoutError):
+            pool.connect()
+        stats = pool.stats()
+        connection.close()
+
+        self.assertEqual(stats['saturation'], 1.0)
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertGreaterEqual(stats['max_wait_seconds'], 0.05)
+        self.assertIn(pool.stats(), models.pool_stats())
+
+    def test_connection_from_parent_process_is_replaced(self):
+        pool = self.pool(pool_size=1, max_overflow=0)
+        connection = pool.connect()
+        inherited = connection.connection
+        connection.close()
+
+        with mock.patch('models.os.getpid', return_value=os.getpid() + 1):
+            connection = pool.connect()
+
+        self.assertIsNot(connection.connection, inherited)
+        connection.close()
+        # left open: it is still the parent's connection
+        self.assertEqual(inherited.execute('SELECT 1').fetchone(), (1,))
+
+    def test_warm_pools_opens_connections_up_front(self):
+        app = Flask(__name__)
+        app.config['TESTING'] = True
+        database = os.path.join(tempfile.mkdtemp(), 'warm.db')
+        with mock.patch('models.engine_options', return_value={
+                'poolclass': models.TimedQueuePool, 'pool_size': 3}):
+            setup_db(app, 'sqlite:///' + database)
+        models.warm_pools(app, connections=2)
+
+        with app.app_context():
+            self.assertEqual(db.engine.pool.checkedin(), 2)
+            db.engine.dispose()
+
+
+class GunicornConfigTest(unittest.TestCase):
+
+    def load(self, **env):
+        import runpy
+        with mock.patch.dict(os.environ, env), \
+                mock.patch('os.sched_getaffinity', return_value={0, 1}):
+            settings = runpy.run_path('gunicorn.conf.py')
+            settings['DB_POOL_SIZE'] = os.environ.get('DB_POOL_SIZE')
+        return settings
+
+    def test_sync_workers_follow_the_cpu_count(self):
+        settings = self.load(GUNICORN_WORKER_CLASS='sync')
+
+        self.assertEqual(settings['workers'], 5)
+        self.assertEqual(settings['threads'], 1)
+        self.assertTrue(settings['preload_app'])
+        self.assertGreater(settings['max_requests_jitter'], 0)
+
+    def test_gthread_sizes_the_pool_to_its_threads(self):
+        settings = self.load(GUNICORN_WORKER_CLASS='gthread',
+                             GUNICORN_THREADS='8', WEB_CONCURRENCY='2')
+
+        self.assertEqual(settings['workers'], 2)
+        self.assertEqual(settings['threads'], 8)
+        self.assertEqual(settings['DB_POOL_SIZE'], '8')
+
+    def test_gevent_is_not_preloaded(self):
+        self.assertFalse(
+            self.load(GUNICORN_WORKER_CLASS='gevent')['preload_app'])
+
+    def test_unknown_worker_class_is_refused(self):
+        with self.assertRaises(ValueError):
+            self.load(GUNICORN_WORKER_CLASS='eventlet')
+
+
+class ReplicaRoutingTest(OfflineAppMixin, unittest.TestCase):
+
+    def setUp(self):
+        handle, path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        self.test_config = {
+            'REPLICA_DATABASE_URL': 'sqlite:///' + path,
+            'CACHE_ENABLED': False
+        }
+        super().setUp()
+        self.replica = db.get_engine(self.app, bind='replica')
+        db.metadata.create_all(self.replica)
+        self.replica.execute(Movie.__table__.insert(), title='On replica')
+        self.addCleanup(self.replica.dispose)
+
+    def titles(self, sub='auth0|reader'):
+        data = json.loads(self.client().get(
+            '/movies', headers=self.headers('get:movies', sub=sub)).data)
+        return [movie['title'] for movie in data['all_movies']]
+
+    def test_reads_go_to_the_replica(self):
+        self.assertEqual(self.titles(), ['On replica'])
+
+    def test_writer_reads_its_own_writes(self):
+        response = self.client().post(
+            '/movies/add', json={'title': 'On primary'},
+            headers=self.headers('add:movies', sub='auth0|writer'))
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.titles('auth0|writer'), ['On primary'])
+        self.assertEqual(self.titles('auth0|reader'), ['On replica'])
+
+    def test_pin_expires(self):
+        router = self.app.extensions['read_router']
+        router.sticky_seconds = 0
+        router.pin('auth0|writer')
+
+        self.assertEqual(self.titles('auth0|writer'), ['On replica'])
+
+    def test_pins_are_shared_through_redis_without_the_cache(self):
+        import fakeredis
+        client = fakeredis.FakeStrictRedis()
+        config = dict(self.test_config, REPLICA_PIN_REDIS_URL='redis://pins')
+        with mock.patch('redis.StrictRedis.from_url', return_value=client):
+            first, second = (create_app(config).extensions['read_router']
+                             for _ in range(2))
+        first.pin('auth0|writer')
+
+        self.assertTrue(second.is_pinned('auth0|writer'))
+
+    def test_falls_back_to_primary_when_replica_is_down(self):
+        self.replica.dispose()
+        with mock.patch.object(self.replica, 'connect',
+                               side_effect=Exception('connection refused')):
+            self.assertEqual(self.titles(), [])
+
+    def test_falls_back_to_primary_when_replica_lags(self):
+        from sqlalchemy import text
+        with mock.patch.dict('routing.LAG_QUERIES',
+                             {'sqlite': text('SELECT 3600')}):
+            self.assertEqual(self.titles(), [])
+
+    def test_cache_never_serves_replica_reads_to_a_writer(self):
+        self.app.config['CACHE_ENABLED'] = True
+        self.client().post(
+            '/movies/add', json={'title': 'On primary'},
+            headers=self.headers('add:movies', sub='auth0|writer'))
+
+        self.assertEqual(self.titles('auth0|reader'), ['On replica'])
+        self.assertEqual(self.titles('auth0|writer'), ['On primary'])
+        self.assertEqual(self.app.extensions['response_cache'].hits, 0)
+
+    def test_cache_keeps_replica_reads_briefly(self):
+        self.app.config.update(CACHE_ENABLED=True, REPLICA_CACHE_TTL=2)
+        self.titles()
+        self.assertEqual(self.titles(), ['On replica'])
+        expired = time.monotonic() + 3
+        with mock.patch('time.monotonic', return_value=expired):
+            self.titles()
+
+        self.assertEqual(self.app.extensions['response_cache'].hits, 1)
+
+    def test_cache_still_serves_primary_reads(self):
+        self.app.config['CACHE_ENABLED'] = True
+        with mock.patch.dict('routing.LAG_QUERIES',
+                             {'sqlite': text('SELECT 3600')}):
+            self.titles()
+            self.assertEqual(self.titles(), [])
+
+        self.assertEqual(self.app.extensions['response_cache'].hits, 1)
+
+
+class MetricsTest(OfflineAppMixin, unittest.TestCase):
+
+    def sample(self, name, **labels):
+        from prometheus_client import REGISTRY
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_requests_sql_and_auth_are_measured(self):
+        self.seed(movies=3)
+        auth.token_cache.clear()
+        requests = self.sample('http_request_duration_seconds_count',
+                               endpoint='get_movies', method='GET',
+                               status='200')
+        selects = self.sample('db_statement_duration_seconds_count',
+                              operation='select')
+        decodes = self.sample('auth_duration_seconds_count', stage='decode')
+        lookups = self.sample('auth_duration_seconds_count', stage='jwks')
+
+        response = self.client().get('/movies',
+                                     headers=self.headers('get:movies'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.sample('http_request_duration_seconds_count',
+                                     endpoint='get_movies', method='GET',
+                                     status='200'), requests + 1)
+        self.assertGreater(self.sample('db_statement_duration_seconds_count',
+                                       operation='select'), selects)
+        self.assertEqual(self.sample('auth_duration_seconds_count',
+                                     stage='decode'), decodes + 1)
+        self.assertEqual(self.sample('auth_duration_seconds_count',
+                                     stage='jwks'), lookups + 1)
+
+    def test_unknown_paths_share_one_label(self):
+        before = self.sample('http_request_duration_seconds_count',
+                             endpoint='unmatched', method='GET', status='404')
+
+        for i in range(3):
+            self.client().get('/no-such-route/{}'.format(i))
+
+        self.assertEqual(self.sample('http_request_duration_seconds_count',
+                                     endpoint='unmatched', method='GET',
+                                     status='404'), before + 3)
+
+    def test_exposition_format(self):
+        self.client().get('/')
+        response = self.client().get('/metrics')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        self.assertIn(b'http_request_duration_seconds_bucket{', response.data)
+        self.assertIn(b'db_pool_checked_out_connections', response.data)
+
+    def test_multiprocess_mode_reads_the_shared_directory(self):
+        import metrics
+        directory = tempfile.mkdtemp()
+        with mock.patch.dict(os.environ,
+                             {'prometheus_multiproc_dir': directory}), \
+                mock.patch('metrics.multiprocess.MultiProcessCollector') \
+                as collector:
+            metrics.render()
+
+        self.assertEqual(collector.call_count, 1)
+
+
+class QueryBudgetTest(OfflineAppMixin, unittest.TestCase):
+
+    # statements per request on SQLite, with 3 rows sent to the bulk routes
+    expected = {
+        'welcome': 0, 'health': 0, 'metrics': 0,
+        'get_movies': 2, 'get_movies_filtered': 2, 'get_movie': 2,
+        'search_movies_route': 2,
+        'create_movies': 3, 'create_movies_bulk': 4, 'update_movie': 2,
+        'delete_movie': 2, 'get_movie_cast': 2, 'replace_movie_cast': 5,
+        'get_actors': 2, 'get_actors_filtered': 2, 'get_actor': 2,
+        'get_actor_movies': 2,
+        'create_actor': 3, 'create_actors_bulk': 4, 'update_actor': 2,
+        'delete_actor': 2, 'get_stats': 2
+    }
+
+    def add_route(self, budget, statements):
+        from queries import query_budget
+
+        def view():
+            for i in range(statements):
+                db.session.execute('SELECT 1')
+            return jsonify({'success': True})
+
+        self.app.add_url_rule('/test-route', 'test_route',
+                              query_budget(budget)(view))
+
+    def test_every_route_has_a_budget(self):
+        for rule in self.app.url_map.iter_rules():
+            if rule.endpoint != 'static':
+                view = self.app.view_functions[rule.endpoint]
+                self.assertTrue(hasattr(view, 'query_budget'), rule.endpoint)
+
+    def test_query_count_per_route(self):
+        from benchmarks.loadtest import Scenarios
+        from benchmarks.tokens import ALL_PERMISSIONS
+        self.seed(movies=20, actors=20)
+        # one request first so every TableVersion row exists
+        self.client().post('/movies/add', json={'title': 'Warm up'},
+                           headers=self.headers('add:movies'))
+        self.client().post('/actors/add', json={'name': 'Warm up'},
+                           headers=self.headers('add:actors'))
+        self.client().put('/movies/1/cast', json=[],
+                          headers=self.headers('patch:movies'))
+        headers = self.headers(*ALL_PERMISSIONS)
+        builders = Scenarios(20, 20).builders
+        self.assertEqual(set(builders), set(self.expected))
+        statements = self.record_statements()
+
+        for endpoint, build in builders.items():
+            method, url, body = build(random.Random(0))
+            if isinstance(body, list):
+                body = body[:3]
+            del statements[:]
+
+            response = self.client().open(url, method=method, json=body,
+                                          headers=headers)
+
+            self.assertLess(response.status_code, 300, endpoint)
+            self.assertEqual(len(statements), self.expected[endpoint],
+                             endpoint)
+
+    def test_over_budget_raises_in_tests(self):
+        from queries import QueryBudgetExceeded
+        self.add_route(budget=1, statements=2)
+
+        with self.assertRaises(QueryBudgetExceeded):
+            self.client().get('/test-route')
+
+    def test_over_budget_warns_in_production(self):
+        self.app.testing = False
+        self.add_route(budget=1, statements=2)
+
+        with self.assertLogs('queries', 'WARNING') as logs:
+            response = self.client().get('/test-route')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('ran 2 statements, budget is 1', logs.output[0])
+
+    def test_repeated_statements_are_reported(self):
+        self.add_route(budget=10, statements=5)
+
+        with self.assertLogs('queries', 'WARNING') as logs:
+            self.client().get('/test-route')
+
+        self.assertIn('Probable N+1 in test_route: 5 x SELECT 1',
+                      logs.output[0])
+
+    def test_slow_statements_are_logged_with_their_plan(self):
+        self.app.config['SQL_SLOW_QUERY_MS'] = 0
+        self.seed(movies=1)
+
+        with self.assertLogs('queries', 'WARNING') as logs:
+            self.client().get('/movies', headers=self.headers('get:movies'))
+
+        slow = [line for line in logs.output if 'FROM "Movie"' in line]
+        self.assertEqual(len(slow), 1)
+        self.assertIn('SCAN', slow[0])
+
+
+class SerializationTest(OfflineAppMixin, unittest.TestCase):
+
+    data = {'success': True, 'all_movies': [
+        {'id': 1, 'title': 'Amélie', 'description': None, 'rank': 0.5}]}
+
+    def provider(self, name):
+        import serialization
+        self.app.config['JSON_PROVIDER'] = name
+        serialization.init_json(self.app)
+
+    def test_stdlib_provider_matches_jsonify(self):
+        from serialization import json_response
+        self.provider('stdlib')
+        for debug in (False, True):
+            self.app.debug = debug
+            with self.app.test_request_context():
+                self.assertEqual(json_response(self.data).get_data(),
+                                 jsonify(self.data).get_data())
+
+    @unittest.skipUnless(importlib.util.find_spec('orjson'),
+                         'orjson is not installed')
+    def test_orjson_provider_matches_the_document(self):
+        from serialization import json_response
+        self.provider('auto')
+        self.assertEqual(self.app.extensions['json_provider'].name, 'orjson')
+        with self.app.test_request_context():
+            expected = jsonify(self.data)
+            response = json_response(self.data)
+
+        self.assertEqual(response.mimetype, expected.mimetype)
+        self.assertEqual(json.loads(response.get_data()),
+                         json.loads(expected.get_data()))
+
+    def test_rows_serialize_like_format(self):
+        from fields import select_fields
+        self.seed(movies=2, actors=2)
+        for model in (Movie, Actor):
+            query, serialize = select_fields(model, None)
+            rows = [serialize(row) for row in query.order_by(model.id)]
+
+            self.assertEqual(rows, [instance.format() for instance in
+                                    model.query.order_by(model.id)])
+
+    def test_list_routes_are_unchanged(self):
+        self.provider('stdlib')
+        self.seed(movies=3, actors=3)
+        for path, model, key in (('/movies', Movie, 'all_movies'),
+                                 ('/actors', Actor, 'all_actors')):
+            with self.app.test_request_context():
+                expected = jsonify({
+                    'success': True,
+                    key: [item.format()
+                          for item in model.query.order_by(model.id)]
+                }).get_data()
+
+            response = self.client().get(
+                path, headers=self.headers('get:movies', 'get:actors'))
+
+            self.assertEqual(response.get_data(), expected)
+
+
+class CompressionTest(OfflineAppMixin, unittest.TestCase):
+
+    test_config = {'CACHE_ENABLED': False}
+
+    def get(self, path, encoding, **headers):
+        headers.update(self.headers('get:movies'))
+        if encoding is not None:
+            headers['Accept-Encoding'] = encoding
+        return self.client().get(path, headers=headers)
+
+    def test_gzip_is_negotiated(self):
+        import gzip
+        self.seed(movies=50)
+        plain = self.get('/movies', None)
+
+        response = self.get('/movies', 'gzip, deflate')
+
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertLess(len(response.data), len(plain.data))
+        self.assertEqual(gzip.decompress(response.data), plain.data)
+
+    @unittest.skipUnless(importlib.util.find_spec('brotli'),
+                         'brotli is not installed')
+    def test_brotli_is_preferred_when_weights_tie(self):
+        import brotli
+        self.seed(movies=50)
+
+        response = self.get('/movies', 'gzip, br')
+
+        self.assertEqual(response.headers['Content-Encoding'], 'br')
+        self.assertEqual(json.loads(brotli.decompress(response.data))
+                         ['all_movies'][0]['title'], 'Movie 0')
+
+    def test_small_and_refused_bodies_are_sent_as_they_are(self):
+        self.seed(movies=50)
+        small = self.get('/movies/1', 'gzip')
+        refused = self.get('/movies', 'gzip;q=0')
+
+        for response in (small, refused):
+            self.assertNotIn('Content-Encoding', response.headers)
+            self.assertIn('Accept-Encoding', response.headers['Vary'])
+            json.loads(response.data)
+
+    def test_streamed_lists_are_compressed(self):
+        import zlib
+        self.app.config['STREAM_CHUNK_SIZE'] = 10
+        self.seed(movies=25)
+
+        response = self.get('/movies?stream=true', 'gzip')
+
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', response.headers)
+        body = zlib.decompress(response.data, 31)
+        self.assertEqual(len(json.loads(body)['all_movies']), 25)
+
+    def test_rows_at_the_same_version_keep_their_own_bodies(self):
+        import gzip
+        for i in range(2):
+            db.session.add(Movie(title='Movie {}'.format(i),
+                                 description=str(i) * 2000))
+        db.session.commit()
+
+        first = self.get('/movies/1', 'gzip')
+        second = self.get('/movies/2', 'gzip')
+
+        self.assertNotEqual(first.headers['ETag'], second.headers['ETag'])
+        self.assertEqual(json.loads(gzip.decompress(first.data))['movie']['id'],
+                         1)
+        self.assertEqual(
+            json.loads(gzip.decompress(second.data))['movie']['id'], 2)
+
+    def test_compressed_tag_still_validates(self):
+        self.seed(movies=50)
+        etag = self.get('/movies', 'gzip').headers['ETag']
+
+        response = self.get('/movies', 'gzip', **{'If-None-Match': etag})
+
+        self.assertTrue(etag.startswith('W/'))
+        self.assertEqual(response.status_code, 304)
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+
+    def test_unchanged_bodies_are_compressed_once(self):
+        import compression
+        self.seed(movies=50)
+        with mock.patch.object(compression.Gzip, 'compress',
+                               autospec=True,
+                               side_effect=compression.Gzip.compress) \
+                as compress:
+            first = self.get('/movies', 'gzip')
+            second = self.get('/movies', 'gzip')
+            self.client().post('/movies/add', json={'title': 'New'},
+                               headers=self.headers('add:movies'))
+            third = self.get('/movies', 'gzip')
+
+        self.assertEqual(first.data, second.data)
+        self.assertNotEqual(second.data, third.data)
+        self.assertEqual(compress.call_count, 2)
+
+
+class CastTest(OfflineAppMixin, unittest.TestCase):
+
+    test_config = {'CACHE_ENABLED': False}
+
+    def put_cast(self, movie_id, members):
+        return self.client().put('/movies/{}/cast'.format(movie_id),
+                                 json=members,
+                                 headers=self.headers('patch:movies'))
+
+    def test_replace_and_read_a_cast(self):
+        self.seed(movies=2, actors=3)
+
+        response = self.put_cast(1, [{'actor_id': 3, 'role': 'Lead'},
+                                     {'actor_id': 1, 'role': 'Villain'}])
+        cast = self.client().get('/movies/1/cast',
+                                 headers=self.headers('get:movies'))
+        movies = self.client().get('/actors/3/movies',
+                                   headers=self.headers('get:actors'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([(member['id'], member['role'])
+                          for member in json.loads(cast.data)['cast']],
+                         [(1, 'Villain'), (3, 'Lead')])
+        self.assertEqual(json.loads(cast.data)['cast'][0]['name'], 'Actor 0')
+        self.assertEqual(json.loads(movies.data)['movies'],
+                         [{'id': 1, 'title': 'Movie 0',
+                           'description': 'About movie 0',
+                           'category': 'comedy', 'role': 'Lead'}])
+
+        self.put_cast(1, [{'actor_id': 2, 'role': 'Extra'}])
+        cast = self.client().get('/movies/1/cast',
+                                 headers=self.headers('get:movies'))
+        self.assertEqual([member['id'] for member in
+                          json.loads(cast.data)['cast']], [2])
+
+        self.assertEqual(self.put_cast(1, []).status_code, 200)
+        self.assertEqual(models.Cast.query.count(), 0)
+
+    def test_invalid_casts_are_rejected(self):
+        self.seed(movies=1, actors=2)
+
+        self.assertEqual(self.put_cast(1, [{'actor_id': 9}]).status_code, 422)
+        self.assertEqual(self.put_cast(1, [{'actor_id': 1}, {'actor_id': 1}])
+                         .status_code, 422)
+        self.assertEqual(self.put_cast(1, [{'role': 'Lead'}]).status_code,
+                         422)
+        self.assertEqual(self.put_cast(5, [{'actor_id': 1}]).status_code, 404)
+        self.assertEqual(models.Cast.query.count(), 0)
+
+    def test_deleting_a_movie_or_actor_removes_its_roles(self):
+        self.seed(movies=2, actors=2)
+        self.put_cast(1, [{'actor_id': 1}, {'actor_id': 2}])
+        self.put_cast(2, [{'actor_id': 1}])
+        version = get_version('Cast')
+
+        self.client().delete('/movies/1',
+                             headers=self.headers('delete:movies'))
+        self.client().delete('/actors/1',
+                             headers=self.headers('delete:actors'))
+
+        self.assertEqual(models.Cast.query.count(), 0)
+        self.assertEqual(get_version('Cast'), version + 2)
+
+    def test_a_page_of_movies_with_casts_takes_constant_queries(self):
+        self.seed(movies=30, actors=5)
+        for movie_id in range(1, 31):
+            self.put_cast(movie_id, [{'actor_id': actor_id, 'role': 'Role'}
+                                     for actor_id in range(1, 4)])
+        counts = []
+        for limit in (2, 25):
+            statements = self.record_statements()
+            response = self.client().get(
+                '/movies?include=cast&limit={}'.format(limit),
+                headers=self.headers('get:movies'))
+            counts.append(len(statements))
+
+            movies = json.loads(response.data)['all_movies']
+            self.assertEqual(len(movies), limit)
+            self.assertEqual(len(movies[0]['cast']), 3)
+
+        self.assertEqual(counts, [3, 3])
+
+    def test_unknown_includes_are_rejected(self):
+        for query in ('include=crew', 'include=cast&stream=true'):
+            response = self.client().get('/movies?' + query,
+                                         headers=self.headers('get:movies'))
+            self.assertEqual(response.status_code, 422)
+
+    def test_cast_tag_changes_when_the_cast_is_replaced(self):
+        self.seed(movies=1, actors=2)
+        headers = self.headers('get:movies')
+        etag = self.client().get('/movies/1/cast', headers=headers) \
+            .headers['ETag']
+
+        self.put_cast(1, [{'actor_id': 2, 'role': 'Lead'}])
+        response = self.client().get(
+            '/movies/1/cast', headers=dict(headers, **{'If-None-Match': etag}))
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_actor_writes_only_change_the_tag_of_listings_with_casts(self):
+        self.seed(movies=1, actors=1)
+        headers = self.headers('get:movies')
+        etags = {url: self.client().get(url, headers=headers).headers['ETag']
+                 for url in ('/movies', '/movies?include=cast')}
+
+        self.client().post('/actors/add', headers=self.headers('add:actors'),
+                           json={'name': 'Joaquin', 'gender': 'male'})
+        status = {url: self.client().get(
+            url, headers=dict(headers, **{'If-None-Match': etag}))
+            .status_code for url, etag in etags.items()}
+
+        self.assertEqual(status, {'/movies': 304,
+                                  '/movies?include=cast': 200})
+
+
+class RowWriteTest(OfflineAppMixin, unittest.TestCase):
+
+    test_config = {'CACHE_ENABLED': False}
+
+    def setUp(self):
+        super().setUp()
+        self.seed(movies=3)
+        # one write of each kind first so the TableVersion rows exist
+        self.patch(2, {'title': 'Warm up'})
+        self.delete(3)
+
+    def patch(self, movie_id, body, if_match=None):
+        headers = self.headers('patch:movies')
+        if if_match is not None:
+            headers['If-Match'] = if_match
+        return self.client().patch('/movies/{}'.format(movie_id), json=body,
+                                   headers=headers)
+
+    def delete(self, movie_id, if_match=None):
+        headers = self.headers('delete:movies')
+        if if_match is not None:
+            headers['If-Match'] = if_match
+        return self.client().delete('/movies/{}'.format(movie_id),
+                                    headers=headers)
+
+    def test_update_is_one_statement_returning_the_row(self):
+        statements = self.record_statements()
+
+        response = self.patch(1, {'title': 'Heat', 'category': 'crime'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)['movie'], {
+            'id': 1, 'title': 'Heat', 'description': 'About movie 0',
+            'category': 'crime', 'version': 2})
+        self.assertEqual(response.headers['ETag'],
+                         '"{}"'.format(row_etag(2, '/movies/1')))
+        self.assertEqual(len(statements), 2)
+        self.assertTrue(statements[0].startswith('UPDATE "Movie"'))
+        self.assertIn('RETURNING', statements[0])
+
+    def test_delete_is_one_statement_returning_the_row(self):
+        statements = self.record_statements()
+
+        response = self.delete(1)
+
+        self.assertEqual(json.loads(response.data)['message'],
+                         'Movie Movie 0 successfully deleted.')
+        self.assertEqual(len(statements), 2)
+        self.assertTrue(statements[0].startswith('DELETE FROM "Movie"'))
+        self.assertEqual(self.delete(1).status_code, 404)
+        self.assertEqual(self.patch(1, {'title': 'Gone'}).status_code, 404)
+
+    def test_without_returning_a_second_statement_reads_the_row(self):
+        with mock.patch.object(models, 'SQLITE_RETURNING', False):
+            updated = self.patch(1, {'title': 'Heat'})
+            deleted = self.delete(2)
+
+        self.assertEqual(json.loads(updated.data)['movie']['title'], 'Heat')
+        self.assertEqual(json.loads(deleted.data)['message'],
+                         'Movie Warm up successfully deleted.')
+        self.assertEqual(Movie.query.count(), 1)
+
+    def test_if_match_refuses_a_lost_update(self):
+        etag = self.client().get(
+            '/movies/1', headers=self.headers('get:movies')).headers['ETag']
+
+        first = self.patch(1, {'title': 'Heat'}, if_match=etag)
+        second = self.patch(1, {'title': 'Ronin'}, if_match=etag)
+
+        self.assertEqual(etag, '"{}"'.format(row_etag(1, '/movies/1')))
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.status_code, 412)
+        self.assertEqual(json.loads(second.data)['error'], 412)
+        self.assertEqual(self.delete(1, if_match=etag).status_code, 412)
+        self.assertEqual(self.patch(1, {'title': 'Ronin'}, if_match='W/"{}"'
+                                    .format(row_etag(2, '/movies/1')))
+                         .status_code, 200)
+        self.assertEqual(self.delete(1, if_match='*').status_code, 200)
+        self.assertEqual(self.delete(1, if_match='"{}"'.format(
+            row_etag(3, '/movies/1'))).status_code, 404)
+
+    def test_if_match_only_takes_the_rows_own_tags(self):
+        other = self.client().get(
+            '/movies/2', headers=self.headers('get:movies')).headers['ETag']
+
+        for if_match in (other, '"2"'):
+            self.assertEqual(self.patch(1, {'title': 'Heat'},
+                                        if_match=if_match).status_code, 412)
+        self.assertEqual(Movie.query.get(1).title, 'Movie 0')
+
+    def test_item_etag_follows_the_row_version(self):
+        headers = self.headers('get:movies')
+        etag = self.client().get('/movies/1', headers=headers).headers['ETag']
+
+        cached = self.client().get(
+            '/movies/1', headers=dict(headers, **{'If-None-Match': etag}))
+        self.patch(1, {'title': 'Heat'})
+        changed = self.client().get(
+            '/movies/1', headers=dict(headers, **{'If-None-Match': etag}))
+
+        self.assertEqual(cached.status_code, 304)
+        self.assertEqual(changed.status_code, 200)
+        self.assertEqual(changed.headers['ETag'],
+                         '"{}"'.format(row_etag(2, '/movies/1')))
+
+    def test_orm_writes_bump_the_version_too(self):
+        movie = Movie.query.get(1)
+        movie.title = 'Heat'
+        movie.update()
+
+        self.assertEqual(Movie.query.get(1).version, 2)
+
+
+class StatsTest(OfflineAppMixin, unittest.TestCase):
+
+    test_config = {'CACHE_ENABLED': False}
+
+    def stats(self):
+        response = self.client().get('/stats',
+                                     headers=self.headers('get:stats'))
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.data)['stats']
+
+    @staticmethod
+    def distribution(key, values):
+        counts = Counter(values)
+        return [{key: value, 'count': counts[value]} for value in sorted(
+            counts, key=lambda value: (value is None, value))]
+
+    def recount(self):
+        db.session.expire_all()
+        movies, actors = Movie.query.all(), Actor.query.all()
+        return {
+            'movies': {
+                'total': len(movies),
+                'by_category': self.distribution(
+                    'category', [movie.category for movie in movies])
+            },
+            'actors': {
+                'total': len(actors),
+                'by_gender': self.distribution(
+                    'gender', [actor.gender for actor in actors]),
+                'by_age': self.distribution(
+                    'age', [actor.age for actor in actors])
+            }
+        }
+
+    def test_stats_follow_every_write_path(self):
+        self.seed(movies=4, actors=4)
+        client = self.client()
+        client.post('/movies/add', json={'title': 'Heat', 'category': None},
+                    headers=self.headers('add:movies'))
+        client.post('/actors/bulk', json=[
+            {'name': 'Ann', 'gender': 'female', 'age': 20},
+            {'name': 'Bo', 'age': 41}], headers=self.headers('add:actors'))
+        client.patch('/movies/1', json={'title': 'Ronin', 'category': 'crime'},
+                     headers=self.headers('patch:movies'))
+        client.patch('/actors/2', json={'name': 'Cy', 'gender': 'female',
+                                        'age': 20},
+                     headers=self.headers('patch:actors'))
+        client.delete('/movies/2', headers=self.headers('delete:movies'))
+        client.delete('/actors/3', headers=self.headers('delete:actors'))
+
+        self.assertEqual(self.stats(), self.recount())
+        self.assertEqual(self.stats()['movies']['by_category'], [
+            {'category': 'comedy', 'count': 1},
+            {'category': 'crime', 'count': 1},
+            {'category': 'drama', 'count': 1},
+            {'category': None, 'count': 1}])
+
+    def test_rolled_back_writes_leave_stats_alone(self):
+        self.seed(movies=2)
+        before = self.stats()
+
+        db.session.add(Movie(title='Heat', category='crime'))
+        Movie.query.get(1).category = 'crime'
+        db.session.flush()
+        db.session.rollback()
+
+        self.assertEqual(self.stats(), before)
+        self.assertEqual(self.stats(), self.recount())
+
+    def test_null_and_empty_values_are_distinct(self):
+        for category in (None, '', 'drama', None):
+            db.session.add(Movie(title='Heat', category=category))
+        db.session.commit()
+
+        self.assertEqual(self.stats()['movies']['by_category'], [
+            {'category': '', 'count': 1},
+            {'category': 'drama', 'count': 1},
+            {'category': None, 'count': 2}])
+
+    def test_read_does_not_scan_the_tables(self):
+        self.seed(movies=30, actors=30)
+        statements = self.record_statements()
+
+        self.stats()
+
+        self.assertEqual(len(statements), 2)
+        self.assertTrue(all('FROM "Movie"' not in statement and
+                            'FROM "Actor"' not in statement
+                            for statement in statements))
+
+    def test_rebuild_repairs_the_summary(self):
+        from stats import rebuild_stats
+        self.app.config['CACHE_ENABLED'] = True
+        self.seed(movies=3, actors=3)
+        CatalogStat.query.filter_by(kind='actor_age').delete()
+        CatalogStat.query.update({CatalogStat.count: 7})
+        db.session.commit()
+        self.assertNotEqual(self.stats(), self.recount())
+
+        rebuild_stats()
+
+        self.assertEqual(self.stats(), self.recount())
+
+    def test_stats_need_their_own_permission(self):
+        response = self.client().get(
+            '/stats', headers=self.headers('get:movies', 'get:actors'))
+        self.assertEqual(response.status_code, 403)
+
+
+class GroupCommitTest(OfflineAppMixin, unittest.TestCase):
+
+    def setUp(self):
+        handle, path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        # groups only close once full, so every test batch is one group
+        self.test_config = {
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path,
+            'CACHE_ENABLED': False,
+            'GROUP_COMMIT_ENABLED': True,
+            'GROUP_COMMIT_WINDOW_MS': 10000,
+            'GROUP_COMMIT_MAX_SIZE': 4
+        }
+        super().setUp()
+        self.committer = self.app.extensions['group_commit']
+
+    def count_commits(self):
+        commits = []
+
+        def commit(conn):
+            commits.append(conn)
+
+        event.listen(db.engine, 'commit', commit)
+        self.addCleanup(event.remove, db.engine, 'commit', commit)
+        return commits
+
+    def concurrently(self, *requests):
+        """Sends each (method, path, body, permission) from its own thread
+        and returns the responses, or the exceptions raised, in order
+        """
+        results = [None] * len(requests)
+
+        def send(index, method, path, body, permission):
+            try:
+                results[index] = self.client().open(
+                    path, method=method, json=body,
+                    headers=self.headers(permission))
+            except Exception as error:
+                results[index] = error
+
+        threads = [threading.Thread(target=send, args=(index,) + request)
+                   for index, request in enumerate(requests)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(30)
+        return results
+
+    def test_concurrent_inserts_share_one_commit(self):
+        commits = self.count_commits()
+
+        responses = self.concurrently(*[
+            ('POST', '/movies/add', {'title': 'Movie {}'.format(i)},
+             'add:movies') for i in range(4)])
+
+        self.assertEqual([response.status_code for response in responses],
+                         [201] * 4)
+        ids = [json.loads(response.data)['movie']['id']
+               for response in responses]
+        self.assertEqual(sorted(ids), [1, 2, 3, 4])
+        self.assertEqual(len(commits), 1)
+        self.assertEqual(get_version('Movie'), 1)
+        self.assertEqual(self.committer.stats()['mean_group_size'], 4)
+
+    def test_versions_are_bumped_once_as_the_group_commits(self):
+        db.session.add(models.TableVersion(name='Movie', version=1))
+        db.session.commit()
+        statements = self.record_statements()
+
+        self.concurrently(*[
+            ('POST', '/movies/add', {'title': 'Movie {}'.format(i)},
+             'add:movies') for i in range(4)])
+
+        writes = [statement.split()[:3] for statement in statements
+                  if statement.startswith(('INSERT', 'UPDATE'))]
+        self.assertEqual(writes, [['INSERT', 'INTO', '"Movie"']] * 4 +
+                         [['UPDATE', '"TableVersion"', 'SET']])
+        self.assertEqual(get_version('Movie'), 2)
+
+    def test_updates_and_deletes_join_the_group(self):
+        self.seed(movies=3)
+        commits = self.count_commits()
+
+        responses = self.concurrently(
+            ('PATCH', '/movies/1', {'title': 'Renamed'}, 'patch:movies'),
+            ('PATCH', '/movies/2', {'title': 'Also renamed'}, 'patch:movies'),
+            ('DELETE', '/movies/3', None, 'delete:movies'),
+            ('POST', '/movies/add', {'title': 'New'}, 'add:movies'))
+
+        self.assertEqual([response.status_code for response in responses],
+                         [200, 200, 200, 201])
+        self.assertEqual(json.loads(responses[0].data)['movie']['title'],
+                         'Renamed')
+        self.assertEqual(len(commits), 1)
+        db.session.remove()
+        self.assertEqual(sorted(movie.title for movie in Movie.query),
+                         ['Also renamed', 'New', 'Renamed'])
+
+    def test_a_failing_row_only_fails_its_own_request(self):
+        self.seed(actors=1)
+
+        results = self.concurrently(
+            ('POST', '/actors/add', {'name': 'A'}, 'add:actors'),
+            ('PATCH', '/actors/1', {'name': None, 'gender': 'x'},
+             'patch:actors'),
+            ('POST', '/actors/add', {'name': 'B'}, 'add:actors'),
+            ('POST', '/actors/add', {'name': 'C'}, 'add:actors'))
+
+        self.assertIsInstance(results[1], exc.IntegrityError)
+        self.assertEqual([results[i].status_code for i in (0, 2, 3)],
+                         [201] * 3)
+        db.session.remove()
+        self.assertEqual(sorted(actor.name for actor in Actor.query),
+                         ['A', 'Actor 0', 'B', 'C'])
+
+    def test_a_lone_write_commits_after_the_window(self):
+        self.committer.window = 0.01
+
+        response = self.client().post('/movies/add', json={'title': 'Solo'},
+                                      headers=self.headers('add:movies'))
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Movie.query.count(), 1)
+        self.assertEqual(self.committer.stats()['groups'], 1)
+
+
+class IdempotencyTest(OfflineAppMixin, unittest.TestCase):
+
+    test_config = {'CACHE_ENABLED': False}
+
+    def post(self, body, key='key-1', sub='auth0|test'):
+        headers = self.headers('add:movies', sub=sub)
+        if key is not None:
+            headers['Idempotency-Key'] = key
+        return self.client().post('/movies/add', json=body, headers=headers)
+
+    def hold_inserts(self):
+        """Makes Movie.insert block until the returned event is set
+        """
+        started, release = threading.Event(), threading.Event()
+        insert = Movie.insert
+
+        def held_insert(movie):
+            started.set()
+            release.wait(10)
+            insert(movie)
+
+        patcher = mock.patch.object(Movie, 'insert', held_insert)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(release.set)
+        return started, release
+
+    def test_a_retry_replays_the_first_response(self):
+        first = self.post({'title': 'Heat'})
+        retry = self.post({'title': 'Heat'})
+
+        self.assertEqual(retry.status_code, 201)
+        self.assertEqual(retry.data, first.data)
+        self.assertEqual(retry.headers['Idempotent-Replayed'], 'true')
+        self.assertNotIn('Idempotent-Replayed', first.headers)
+        self.assertEqual(Movie.query.count(), 1)
+
+    def test_cached_responses_never_evict_a_key(self):
+        self.app.config['CACHE_ENABLED'] = True
+        self.app.extensions['response_cache'].backend.max_bytes = 512
+        self.seed(movies=20)
+        first = self.post({'title': 'Heat'})
+        for limit in range(1, 6):
+            self.client().get('/movies?limit={}'.format(limit),
+                              headers=self.headers('get:movies'))
+
+        retry = self.post({'title': 'Heat'})
+
+        self.assertEqual(retry.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(retry.data, first.data)
+        self.assertEqual(Movie.query.filter_by(title='Heat').count(), 1)
+
+    def test_memory_store_only_drops_expired_keys(self):
+        from idempotency import MemoryStore
+        store = MemoryStore()
+        store.set('kept', b'1', 60)
+        self.assertTrue(store.add('lapsed', b'1', 0))
+
+        self.assertTrue(store.add('lapsed', b'2', 60))
+        self.assertFalse(store.add('kept', b'2', 60))
+        self.assertEqual(store.get('kept'), b'1')
+
+    def test_keys_are_scoped_to_the_caller(self):
+        self.post({'title': 'Heat'}, sub='auth0|one')
+        self.post({'title': 'Heat'}, sub='auth0|two')
+        self.post({'title': 'Heat'}, key=None)
+
+        self.assertEqual(Movie.query.count(), 3)
+
+    def test_reusing_a_key_with_another_body_is_rejected(self):
+        self.post({'title': 'Heat', 'category': 'crime'})
+
+        self.assertEqual(self.post({'category': 'crime', 'title': 'Heat'})
+                         .status_code, 201)
+        self.assertEqual(self.post({'title': 'Ronin'}).status_code, 422)
+        self.assertEqual(Movie.query.count(), 1)
+
+    def test_a_failed_request_releases_its_key(self):
+        self.assertEqual(self.post({'description': 'untitled'})
+                         .status_code, 422)
+
+        self.assertEqual(self.post({'title': 'Heat'}).status_code, 201)
+
+    def test_a_concurrent_duplicate_waits_for_the_first(self):
+        started, release = self.hold_inserts()
+        responses = []
+        threads = [threading.Thread(
+            target=lambda: responses.append(self.post({'title': 'Heat'})))
+            for _ in range(2)]
+
+        threads[0].start()
+        self.assertTrue(started.wait(5))
+        threads[1].start()
+        time.sleep(0.1)
+        self.assertEqual(responses, [])
+        release.set()
+        for thread in threads:
+            thread.join(10)
+
+        self.assertEqual([response.status_code for response in responses],
+                         [201, 201])
+        self.assertEqual(responses[0].data, responses[1].data)
+        self.assertEqual(Movie.query.count(), 1)
+
+    def test_a_duplicate_gives_up_waiting_with_409(self):
+        self.app.config['IDEMPOTENCY_WAIT_SECONDS'] = 0.05
+        started, release = self.hold_inserts()
+        first = threading.Thread(target=self.post, args=({'title': 'Heat'},))
+        first.start()
+        self.assertTrue(started.wait(5))
+
+        self.assertEqual(self.post({'title': 'Heat'}).status_code, 409)
+        release.set()
+        first.join(10)
+
+
+class AdmissionTest(OfflineAppMixin, unittest.TestCase):
+
+    test_config = {
+        'CACHE_ENABLED': False,
+        'ADMISSION_ENABLED': True,
+        'ADMISSION_MAX_CONCURRENT': 2,
+        'ADMISSION_RATES': {'read': 0.5, 'write': 0.5},
+        'ADMISSION_BURSTS': {'read': 2, 'write': 1}
+    }
+
+    def get(self, sub='auth0|test'):
+        return self.client().get('/movies',
+                                 headers=self.headers('get:movies', sub=sub))
+
+    def test_a_subject_past_its_burst_gets_429(self):
+        statuses = [self.get().status_code for _ in range(3)]
+        response = self.get()
+
+        self.assertEqual(statuses, [200, 200, 429])
+        self.assertEqual(json.loads(response.data), {
+            'success': False, 'error': 429, 'message': 'Too Many Requests'})
+        self.assertIn(int(response.headers['Retry-After']), (1, 2))
+
+    def test_buckets_are_per_subject_and_class(self):
+        for _ in range(3):
+            self.get()
+
+        write = self.client().post('/movies/add', json={'title': 'Heat'},
+                                   headers=self.headers('add:movies'))
+
+        self.assertEqual(self.get(sub='auth0|other').status_code, 200)
+        self.assertEqual(write.status_code, 201)
+
+    def test_buckets_refill_at_the_configured_rate(self):
+        buckets = admission.MemoryBuckets()
+        with mock.patch('admission.time.monotonic', return_value=100.0):
+            self.assertEqual(buckets.take('key', 2, 1), 0)
+            self.assertAlmostEqual(buckets.take('key', 2, 1), 0.5)
+        with mock.patch('admission.time.monotonic', return_value=100.5):
+            self.assertEqual(buckets.take('key', 2, 1), 0)
+
+    @unittest.skipUnless(importlib.util.find_spec('fakeredis') and
+                         importlib.util.find_spec('lupa'),
+                         'fakeredis with Lua support is not installed')
+    def test_redis_buckets_share_the_same_limits(self):
+        import fakeredis
+        client = fakeredis.FakeStrictRedis()
+        first, second = (admission.RedisBuckets(client) for _ in range(2))
+
+        self.assertEqual(first.take('key', 1, 1), 0)
+        self.assertGreater(second.take('key', 1, 1), 0)
+
+    def test_requests_past_the_concurrency_cap_get_503(self):
+        controller = self.app.extensions['admission']
+        for _ in range(2):
+            controller.enter()
+
+        response = self.get()
+        health = self.client().get('/health')
+        controller.leave()
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '1')
+        self.assertEqual(json.loads(response.data)['error'], 503)
+        self.assertEqual(health.status_code, 200)
+        self.assertEqual(self.get().status_code, 200)
+
+    def test_slots_are_released_after_every_response(self):
+        statuses = [self.client().get(
+            '/movies/{}'.format(movie_id), headers=self.headers(
+                'get:movies', sub='auth0|{}'.format(movie_id))).status_code
+            for movie_id in range(5)]
+
+        self.assertEqual(statuses, [404] * 5)
+        self.assertEqual(self.get().status_code, 200)
+
+    def test_load_test_counts_rejections_apart_from_errors(self):
+        from benchmarks.loadtest import StatementCounter, run_scenario
+        result = run_scenario(
+            self.app, lambda rng: ('GET', '/movies', None),
+            [self.headers('get:movies')], 1, 5,
+            StatementCounter(db.engine))
+
+        self.assertEqual((result['requests'], result['rejected'],
+                          result['errors']), (5, 3, 0))
+        self.assertIsNotNone(result['rejected_p95_ms'])
+
+    def test_disabled_by_default(self):
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://'})
+
+        self.assertNotIn('admission', app.extensions)
+
+
+class LoadTestTest(OfflineAppMixin, unittest.TestCase):
+    """Every route needs a load-test scenario
+    """
+
+    def test_every_route_has_a_scenario(self):
+        from benchmarks.loadtest import Scenarios
+        self.assertEqual(Scenarios(100, 100).uncovered(self.app), [])
+
+    def test_compare_reports_regressions(self):
+        from benchmarks.loadtest import compare
+        row = {'endpoint': 'get_movies', 'concurrency': 1, 'p95_ms': 10.0,
+               'throughput_rps': 100.0, 'queries_per_request': 2.0}
+        slower = dict(row, p95_ms=20.0, queries_per_request=3.0)
+
+        regressions = compare({'results': [slower]}, {'results': [row]}, 0.2)
+
+        self.assertEqual(sorted(r['metric'] for r in regressions),
+                         ['p95_ms', 'queries_per_request'])
+        self.assertEqual(compare({'results': [row]}, {'results': [row]}, 0.2),
+                         [])
+
+    def test_scenarios_sample_rss_while_they_run(self):
+        from benchmarks import loadtest
+        rss = iter([1000, 3000, 2000])
+        with mock.patch('benchmarks.loadtest.current_rss_kb',
+                        side_effect=lambda: next(rss, 2000)):
+            sampler = loadtest.RSSSampler(interval=0.001)
+            sampler.start()
+            time.sleep(0.05)
+            sampler.stop()
+
+        self.assertEqual((sampler.start_kb, sampler.peak_kb), (1000, 3000))
+
+    def test_baseline_covers_every_route(self):
+        from benchmarks.loadtest import Scenarios
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'benchmarks', 'baseline.json')
+        with open(path) as f:
+            baseline = json.load(f)
+
+        self.assertEqual(
+            {item['endpoint'] for item in baseline['results']},
+            set(Scenarios(baseline['movies'], baseline['actors']).builders))
+
+
 if __name__ == '__main__':
     unittest.main()